@@ -0,0 +1,251 @@
+#!/usr/bin/env bash
+#
+# Micro-benchmarks for the interpreter loop, as opposed to the parser or
+# process creation.  Unlike osh-runtime.sh, these don't need any tarballs.
+#
+# Usage:
+#   ./interpreter.sh <function name>
+#
+# Example:
+#   ./interpreter.sh compare
+
+set -o nounset
+set -o pipefail
+set -o errexit
+
+readonly TIMEFORMAT='%R'
+
+# Loops, conditionals and simple builtins.  Exercises Executor._Dispatch().
+readonly LOOP_CODE='
+n=0
+while test $n -lt 20000; do
+  case $n in
+    *0) x=zero ;;
+    *) x=other ;;
+  esac
+  if test $x = zero; then
+    : done
+  fi
+  n=$((n + 1))
+done
+for i in a b c d e f g h i j; do
+  for j in 1 2 3 4 5 6 7 8 9 10; do
+    : $i $j
+  done
+done
+'
+
+# Arithmetic.  Exercises ArithEvaluator.Eval() and the binary operators.
+readonly ARITH_CODE='
+sum=0
+for (( i = 0; i < 20000; i++ )); do
+  (( sum += i * 3 % 7 + (i << 1) - (i >> 1) ))
+  (( i & 1 )) && (( sum ^= i ))
+done
+echo $sum
+'
+
+# Pattern substitution with globs.  Exercises libstr._GlobReplacer and the
+# compiled regex cache.  dash doesn't have ${x//pat/rep}.
+readonly PATSUB_CODE='
+s=abcabcabcabcabcabcabcabcabcabc
+for (( i = 0; i < 10000; i++ )); do
+  x=${s//a?c/-}
+  y=${s/#a*b/-}
+  [[ $s =~ (b+)c ]]
+done
+echo $x $y
+'
+
+# Strip operators with glob patterns on a long, PATH-like string.  Exercises
+# libstr.DoUnarySuffixOp().  Patterns that don't match or match late are the
+# worst case for trying every prefix or suffix.
+readonly STRIP_CODE='
+p=/usr/local/bin
+for (( i = 0; i < 9; i++ )); do
+  p=$p:$p
+done
+q=$p=
+for (( i = 0; i < 20; i++ )); do
+  a=${p%%:*}
+  b=${p#*:}
+  c=${p#*x}
+  d=${p%x*}
+  e=${q#*=}
+done
+echo ${#a} ${#b} ${#c} ${#d} ${#e}
+'
+
+# ${#x} and ${x:i:n} on long ASCII and UTF-8 strings.  Exercises
+# libstr.CountUtf8Chars() and Utf8Slice().  dash doesn't have them.
+readonly UTF8_CODE='
+a=abcdefghij
+u=$(printf "\316\274\342\202\254")
+for (( i = 0; i < 10; i++ )); do
+  a=$a$a
+  u=$u$u
+done
+n=0
+for (( i = 0; i < 2000; i++ )); do
+  x=${a:i:10}
+  y=${u:i:10}
+  n=$(( n + ${#a} + ${#u} ))
+done
+echo $n
+'
+
+# Brace expansion in a loop, and a 'for' loop over a big expansion.  Exercises
+# braces.BraceCache and Executor._EvalForEachWords().  dash doesn't have brace
+# expansion.
+readonly BRACES_CODE='
+for (( i = 0; i < 2000; i++ )); do
+  : {a,b,c}{0,1,2,3,4,5,6,7,8,9}{0,1,2,3,4,5,6,7,8,9}
+done
+n=0
+for x in {0,1,2,3,4,5,6,7,8,9}{0,1,2,3,4,5,6,7,8,9}{0,1,2,3,4,5,6,7,8,9}{0,1,2,3,4,5,6,7,8,9}{0,1,2,3,4,5,6,7,8,9}; do
+  n=$((n + 1))
+done
+echo $n
+'
+
+# The shells to compare.  osh is run with and without the closure compiler.
+shells() {
+  echo 'bash'
+  echo 'dash'
+  echo 'bin/osh'
+  echo 'bin/osh -o compile-commands'
+}
+
+run-code() {
+  local code=$1
+  shells | while read -r sh; do
+    if ! which ${sh%% *} >/dev/null; then
+      continue
+    fi
+    echo "--- $sh"
+    # The timing still goes to stderr.  dash doesn't have (( )).
+    time $sh -c "$code" >/dev/null 2>&1 || echo "FAILED"
+  done
+}
+
+loop() {
+  run-code "$LOOP_CODE"
+}
+
+arith() {
+  run-code "$ARITH_CODE"
+}
+
+patsub() {
+  run-code "$PATSUB_CODE"
+}
+
+strip() {
+  run-code "$STRIP_CODE"
+}
+
+utf8() {
+  run-code "$UTF8_CODE"
+}
+
+braces() {
+  run-code "$BRACES_CODE"
+}
+
+# Throughput of reading a big command sub.  Exercises
+# Executor._RunCommandSubProcess().
+#
+# Usage:
+#   ./interpreter.sh command-sub [size_mb]
+command-sub() {
+  local size_mb=${1:-50}
+  local big=_tmp/command-sub-$size_mb.txt
+  mkdir -p _tmp
+  if ! test -f $big; then
+    # Lines of 99 bytes plus a newline.  'yes' gets SIGPIPE.
+    yes "$(printf '%099d' 0)" | head -c $((size_mb * 1024 * 1024)) > $big \
+      || true
+  fi
+
+  local code='x=$(cat '$big')'
+  shells | while read -r sh; do
+    if ! which ${sh%% *} >/dev/null; then
+      continue
+    fi
+    local start=$(date +%s.%N)
+    $sh -c "$code" >/dev/null 2>&1 || echo "FAILED"
+    local end=$(date +%s.%N)
+    echo "--- $sh"
+    awk -v start=$start -v end=$end -v mb=$size_mb \
+      'BEGIN { secs = end - start; printf "%.3f s, %.1f MB/s\n", secs, mb / secs }'
+  done
+}
+
+# A 'for' loop over a big command sub, with and without set -o stream-for.
+# Streaming starts the loop body right away, and keeps memory bounded.
+#
+# Usage:
+#   ./interpreter.sh stream-for [num_lines]
+stream-for() {
+  local num_lines=${1:-200000}
+  local code='for x in $(seq '$num_lines'); do : $x; done'
+  for sh in bash 'bin/osh' 'bin/osh -o stream-for'; do
+    echo "--- $sh"
+    time $sh -c "$code" || echo "FAILED"
+  done
+}
+
+# Glob expansion in a big directory.  Several patterns over the same directory
+# in one command exercise the Globber's directory listing cache.
+#
+# Usage:
+#   ./interpreter.sh glob-dir [num_files]
+glob-dir() {
+  local num_files=${1:-100000}
+  local dir=_tmp/glob-dir-$num_files
+  if ! test -d $dir; then
+    mkdir -p $dir
+    # Split into a few extensions so the patterns match different subsets.
+    (cd $dir && seq $num_files | sed 's/$/.c/' | xargs touch &&
+                seq 1000 | sed 's/$/.h/' | xargs touch)
+  fi
+
+  local code='
+set -- '$dir'/*.c '$dir'/*.h '$dir'/1*.c '$dir'/*9.?
+echo $#
+n=0
+for f in '$dir'/*; do
+  n=$((n + 1))
+done
+echo $n
+'
+  run-code "$code"
+}
+
+# Recursive globbing of a source tree with shopt -s globstar.  dash doesn't
+# have it.
+#
+# Usage:
+#   ./interpreter.sh globstar [dir]
+globstar() {
+  local dir=${1:-.}
+
+  local code='
+shopt -s globstar
+set -- '$dir'/**/*.py
+echo $#
+set -- '$dir'/**
+echo $#
+'
+  for sh in bash bin/osh; do
+    echo "--- $sh"
+    time $sh -c "$code" 2>&1 || echo "FAILED"
+  done
+}
+
+compare() {
+  loop
+  arith
+}
+
+"$@"
@@ -332,6 +332,84 @@ abuild-h() {
   done
 }
 
+#
+# Fork counts
+#
+
+# Compare the number of processes a configure script starts, and its elapsed
+# time, with and without 'set -o inline-builtins'.  Run 'extract' first.
+#
+# Usage:
+#   ./osh-runtime.sh count-forks [conf_dir]
+count-forks() {
+  local conf_dir=${1:-$TAR_DIR/yash-2.46}
+  local out_dir=$PWD/$BASE_DIR/count-forks
+  mkdir -p $out_dir
+
+  local times_out=$out_dir/times.csv
+  echo 'status,elapsed_secs,sh_opts' > $times_out
+  local time_tool=$PWD/benchmarks/time.py
+
+  pushd $conf_dir >/dev/null
+  local opts
+  for opts in '+o inline-builtins' '-o inline-builtins'; do
+    local trace_out="$out_dir/${opts:0:1}inline-builtins.strace"
+
+    $time_tool --output $times_out --field "$opts" -- \
+      $OSH_OVM $opts ./configure > /dev/null
+
+    strace -f -e trace=fork,vfork,clone -o $trace_out -- \
+      $OSH_OVM $opts ./configure > /dev/null
+    echo "$opts: $(grep -c -E '(fork|clone)\(' $trace_out) forks"
+  done
+  popd >/dev/null
+
+  cat $times_out
+}
+
+# Count execve() calls, including failed ones, with and without 'set -o
+# hashall'.  Without the hash table, each external command tries every $PATH
+# entry in the child until one succeeds.
+#
+# Usage:
+#   ./osh-runtime.sh count-execve [conf_dir]
+count-execve() {
+  local conf_dir=${1:-$TAR_DIR/yash-2.46}
+  local out_dir=$PWD/$BASE_DIR/count-execve
+  mkdir -p $out_dir
+
+  pushd $conf_dir >/dev/null
+  local opts
+  for opts in '+o hashall' '-o hashall'; do
+    local trace_out="$out_dir/${opts:0:1}hashall.strace"
+
+    strace -f -e trace=execve -o $trace_out -- \
+      $OSH_OVM $opts ./configure > /dev/null
+    local total=$(grep -c 'execve(' $trace_out)
+    local failed=$(grep -c 'execve(.* = -1 ' $trace_out)
+    echo "$opts: $total execve() calls, $failed failed"
+  done
+  popd >/dev/null
+}
+
+# How often word evaluation skips IFS splitting and globbing, because the
+# unquoted parts of a word have no IFS or glob characters.  The counts are
+# written to the --debug-file at exit.
+#
+# Usage:
+#   ./osh-runtime.sh word-frame-counters [conf_dir]
+word-frame-counters() {
+  local conf_dir=${1:-$TAR_DIR/yash-2.46}
+  local out_dir=$PWD/$BASE_DIR/word-frame-counters
+  mkdir -p $out_dir
+
+  local debug_out=$out_dir/debug.txt
+  pushd $conf_dir >/dev/null
+  $OSH_OVM --debug-file $debug_out ./configure > /dev/null
+  popd >/dev/null
+  grep 'Word frames' $debug_out
+}
+
 #
 # Misc
 #
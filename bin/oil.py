@@ -106,6 +106,7 @@ OSH_SPEC.LongFlag('--print-status')  # TODO: Replace with a shell hook
 OSH_SPEC.LongFlag('--hijack-shebang')  # TODO: Implement this
 OSH_SPEC.LongFlag('--debug-file', args.Str)
 OSH_SPEC.LongFlag('--xtrace-to-debug-file')
+OSH_SPEC.LongFlag('--profile-commands', args.Str)
 
 # For benchmarks/*.sh
 OSH_SPEC.LongFlag('--parser-mem-dump', args.Str)
@@ -175,7 +176,12 @@ def OshMain(argv0, argv, login_shell):
     trace_f = debug_f
   else:
     trace_f = util.DebugFile(sys.stderr)
-  devtools = dev.DevTools(dumper, debug_f, trace_f)
+  if opts.profile_commands:
+    profiler = dev.CommandProfiler(
+        fd_state.Open(opts.profile_commands, mode='w'), arena)
+  else:
+    profiler = None
+  devtools = dev.DevTools(dumper, debug_f, trace_f, profiler=profiler)
 
   ex = cmd_exec.Executor(mem, fd_state, funcs, comp_lookup, exec_opts,
                          parse_ctx, devtools)
@@ -280,6 +286,8 @@ def OshMain(argv0, argv, login_shell):
 
   _tlog('Execute(node)')
   status = main_loop.Batch(ex, c_parser, arena, nodes_out=nodes_out)
+  debug_f.log('Word frames: %d split and globbed, %d took the fast path',
+              ex.word_ev.num_slow_frames, ex.word_ev.num_fast_frames)
 
   if nodes_out is not None:
     ui.PrintAst(nodes_out, opts)
@@ -298,6 +306,9 @@ def OshMain(argv0, argv, login_shell):
       log('Wrote %s to %s (--runtime-mem-dump)', input_path,
           opts.runtime_mem_dump)
 
+  if profiler:
+    profiler.Close()
+
   # NOTE: We haven't closed the file opened with fd_state.Open
   return status
 
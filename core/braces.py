@@ -17,6 +17,7 @@ from __future__ import print_function
 
 import sys
 
+from core import util
 from osh.meta import Id
 from osh.meta import ast
 
@@ -156,24 +157,35 @@ def BraceDetectAll(words):
   return out
 
 
-# Possible optmization for later:
-def _TreeCount(tree_word):
-  """Count output size for allocation purposes.
+def _ExpansionSize(parts):
+  """Count the words a list of parts expands into, without expanding them."""
+  n = 1
+  for part in parts:
+    if part.tag == word_part_e.BracedAltPart:
+      n *= sum(_ExpansionSize(w.parts) for w in part.words)
+  return n
 
-  We can count the number of words expanded into, and the max number of parts
-  in a word.
 
-  Every word can have a differnt number of parts, e.g. -{'a'b,c}- expands into
-  words of 4 parts, then 3 parts.
-  """
-  # TODO: Copy the structure of _BraceExpand and _BraceExpandOne.
-  for part in tree_word.parts:
-    if part.tag == word_part_e.BracedAltPart:
-      for word in part.words:
-        pass
-  num_results = 2
-  max_parts = 5
-  return num_results, max_parts
+def BraceExpansionSize(words):
+  """Return the number of words that BraceExpandWords() would return."""
+  n = 0
+  for w in words:
+    if w.tag == word_e.BracedWordTree:
+      n += _ExpansionSize(w.parts)
+    else:
+      n += 1
+  return n
+
+
+def LeafParts(words):
+  """Yield every part of the words that isn't a BracedAltPart, recursively."""
+  for w in words:
+    for part in w.parts:
+      if part.tag == word_part_e.BracedAltPart:
+        for p in LeafParts(part.words):
+          yield p
+      else:
+        yield part
 
 
 def _BraceExpandOne(parts, first_alt_index, suffixes):
@@ -242,6 +254,73 @@ def BraceExpandWords(words):
   return out
 
 
+def _BraceExpandIter(parts):
+  """Like _BraceExpand, but yields the lists of parts lazily."""
+  for i, part in enumerate(parts):
+    if part.tag == word_part_e.BracedAltPart:
+      break
+  else:
+    yield parts
+    return
+
+  prefix = parts[:i]
+  tail = parts[i+1:]
+  for w in part.words:
+    for alt_parts in _BraceExpandIter(w.parts):
+      for suffix in _BraceExpandIter(tail):
+        yield prefix + alt_parts + suffix
+
+
+def IterBraceExpandWords(words):
+  """Like BraceExpandWords, but a generator.
+
+  For 'for' loops over big expansions, so they aren't all in memory at once.
+  """
+  for w in words:
+    if w.tag == word_e.BracedWordTree:
+      for parts in _BraceExpandIter(w.parts):
+        yield ast.CompoundWord(parts)
+    else:
+      yield w
+
+
+# Expansions with more words than this aren't cached.  'for' loops iterate over
+# them lazily when they can; see Executor._EvalForEachWords().
+MAX_CACHED_WORDS = 10000
+
+
+class BraceCache(object):
+  """Brace expansions of words, computed once.
+
+  Brace expansion depends only on the syntax, so a command in a loop doesn't
+  need to redo it every time.
+  """
+
+  def __init__(self):
+    self.cache = util.NodeCache()  # BracedWordTree -> list of CompoundWord
+
+  def ExpandWords(self, words):
+    """Like BraceExpandWords, but reuses previous expansions."""
+    for w in words:
+      if w.tag == word_e.BracedWordTree:
+        break
+    else:
+      return words  # common case: nothing to expand
+
+    out = []
+    for w in words:
+      if w.tag == word_e.BracedWordTree:
+        expanded = self.cache.Get(w)
+        if expanded is None:
+          expanded = [ast.CompoundWord(p) for p in _BraceExpand(w.parts)]
+          if len(expanded) <= MAX_CACHED_WORDS:
+            self.cache.Put(w, expanded)
+        out.extend(expanded)
+      else:
+        out.append(w)
+    return out
+
+
 def _Cartesian(tuples):
   if len(tuples) == 1:
     for x in tuples[0]:
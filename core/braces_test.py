@@ -144,6 +144,30 @@ class BracesTest(unittest.TestCase):
       _PrettyPrint(ast.CompoundWord(parts))
       print('')
 
+  def testBraceExpandIter(self):
+    for s in ['hi', 'B-{a,b}-E', 'B-{a,={b,c,d}=,e}-E', 'B-{a,b}-{c,d}-E',
+              '{a,b,}{c,{d,e}f,}']:
+      w = _assertReadWord(self, s)
+      tree = braces._BraceDetect(w) or w
+      expected = braces._BraceExpand(tree.parts)
+      self.assertEqual(expected, list(braces._BraceExpandIter(tree.parts)))
+      self.assertEqual(len(expected), braces._ExpansionSize(tree.parts))
+
+  def testBraceCache(self):
+    words = braces.BraceDetectAll([_assertReadWord(self, 'B-{a,b}-{c,d}-E'),
+                                   _assertReadWord(self, 'x')])
+    self.assertEqual(5, braces.BraceExpansionSize(words))
+
+    cache = braces.BraceCache()
+    expanded = cache.ExpandWords(words)
+    self.assertEqual(5, len(expanded))
+    self.assertEqual(1, len(cache.cache))
+    self.assertEqual(expanded, cache.ExpandWords(words))  # same word objects
+
+    # Words without braces are returned as is.
+    plain = words[1:]
+    self.assertIs(plain, cache.ExpandWords(plain))
+
 
 if __name__ == '__main__':
   unittest.main()
@@ -108,6 +108,7 @@ _NORMAL_BUILTINS = {
 
     "command": builtin_e.COMMAND,
     "type": builtin_e.TYPE,
+    "hash": builtin_e.HASH,
 
     "declare": builtin_e.DECLARE,
     "typeset": builtin_e.TYPESET,
@@ -236,6 +237,7 @@ def Echo(argv):
 
 WAIT_SPEC = _Register('wait')
 WAIT_SPEC.ShortFlag('-n')
+WAIT_SPEC.ShortFlag('-P', args.Int)  # OSH extension for bounded parallelism
 
 
 def Wait(argv, waiter, job_state, mem):
@@ -261,10 +263,28 @@ def Wait(argv, waiter, job_state, mem):
   http://mywiki.wooledge.org/BashGuide/JobControl#jobspec
 
   This is different than a PID?  But it does have a PID.
+
+  OSH extension:
+    wait -P N
+      Wait until fewer than N background jobs are running, so another one can
+      be started.  Returns the status of the last job that finished, or 0 if
+      there was no need to wait.
   """
   arg, i = WAIT_SPEC.Parse(argv)
   pids = argv[i:]
 
+  if arg.P is not None:
+    if arg.P < 1:
+      raise args.UsageError('-P expects a positive number, got %d' % arg.P)
+    status = 0
+    # Each Wait() blocks in wait4(-1) until a child exits, so there's no
+    # polling.
+    while job_state.NumRunning() >= arg.P:
+      if not waiter.Wait():
+        break  # nothing to wait for
+      status = waiter.last_status
+    return status
+
   if arg.n:
     # wait -n returns the exit status of the process.  But how do you know
     # WHICH process?  That doesn't seem useful.
@@ -278,12 +298,11 @@ def Wait(argv, waiter, job_state, mem):
     log('wait all')
     # TODO: get all background jobs from JobState?
     i = 0
-    while True:
+    while not job_state.AllDone():
       if not waiter.Wait():
         break  # nothing to wait for
       i += 1
-      if job_state.AllDone():
-        break
+    waiter.ReapFinished()  # e.g. the processes of a foreground pipeline
 
     log('waited for %d processes', i)
     return 0
@@ -316,8 +335,9 @@ def Wait(argv, waiter, job_state, mem):
   return status
 
 
-def Jobs(argv, job_state):
+def Jobs(argv, waiter, job_state):
   """List jobs."""
+  waiter.ReapFinished()  # so we don't show finished jobs as running
   job_state.List()
   return 0
 
@@ -848,12 +868,7 @@ def Unset(argv, mem, funcs):
   return 0
 
 
-def _ResolveNames(names, funcs, path_val):
-  if path_val.tag == value_e.Str:
-    path_list = path_val.s.split(':')
-  else:
-    path_list = []  # treat as empty path
-
+def _ResolveNames(names, funcs, search_path):
   results = []
   for name in names:
     if name in funcs:
@@ -868,14 +883,13 @@ def _ResolveNames(names, funcs, path_val):
       kind = ('keyword', name)
     else:
       # Now look for files.
-      found = False
-      for path_dir in path_list:
-        full_path = os.path.join(path_dir, name)
-        if os.path.exists(full_path):
-          kind = ('file', full_path)
-          found = True
-          break
-      if not found:  # Nothing printed, but status is 1.
+      if '/' in name:
+        full_path = search_path.Lookup(name)
+      else:
+        full_path = search_path.CachedLookup(name)
+      if full_path is not None:
+        kind = ('file', full_path)
+      else:  # Nothing printed, but status is 1.
         kind = (None, None)
     results.append(kind)
 
@@ -887,11 +901,11 @@ COMMAND_SPEC.ShortFlag('-v')
 #COMMAND_SPEC.ShortFlag('-V')  # Another verbose mode.
 
 
-def Command(argv, funcs, path_val):
+def Command(argv, funcs, search_path):
   arg, i = COMMAND_SPEC.Parse(argv)
   status = 0
   if arg.v:
-    for kind, arg in _ResolveNames(argv[i:], funcs, path_val):
+    for kind, arg in _ResolveNames(argv[i:], funcs, search_path):
       if kind is None:
         status = 1  # nothing printed, but we fail
       else:
@@ -907,11 +921,11 @@ TYPE_SPEC = _Register('type')
 TYPE_SPEC.ShortFlag('-t')
 
 
-def Type(argv, funcs, path_val):
+def Type(argv, funcs, search_path):
   arg, i = TYPE_SPEC.Parse(argv)
 
   status = 0
-  for kind, name in _ResolveNames(argv[i:], funcs, path_val):
+  for kind, name in _ResolveNames(argv[i:], funcs, search_path):
     if kind is None:
       status = 1  # nothing printed, but we fail
     else:
@@ -933,6 +947,48 @@ def Type(argv, funcs, path_val):
   return status
 
 
+HASH_SPEC = _Register('hash')
+HASH_SPEC.ShortFlag('-r')
+HASH_SPEC.ShortFlag('-t')
+
+
+def Hash(argv, search_path):
+  arg, i = HASH_SPEC.Parse(argv)
+  names = argv[i:]
+
+  if arg.r:
+    if names:
+      raise args.UsageError('got extra arguments after -r')
+    search_path.ClearCache()
+    return 0
+
+  if not names:
+    if arg.t:
+      raise args.UsageError('-t requires an argument')
+    # Print the table.
+    for name in search_path.CachedCommands():
+      print(search_path.CachedLookup(name))
+    sys.stdout.flush()
+    return 0
+
+  status = 0
+  for name in names:
+    if '/' in name and not arg.t:
+      continue  # Like bash, there's nothing to look up.
+    if arg.t:
+      # Only report what's already there.
+      full_path = search_path.cache.get(name)
+    else:
+      full_path = search_path.CachedLookup(name)
+    if full_path is None:
+      util.error('hash: %r not found', name)
+      status = 1
+    elif arg.t:
+      print(full_path)
+  sys.stdout.flush()
+  return status
+
+
 DECLARE_SPEC = _Register('declare')
 DECLARE_SPEC.ShortFlag('-f')
 DECLARE_SPEC.ShortFlag('-F')
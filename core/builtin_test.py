@@ -6,8 +6,12 @@ from __future__ import print_function
 
 import unittest
 
+from core import args
 from core import legacy
 from core import builtin  # module under test
+from core import process
+from core import state
+from core import test_lib
 
 
 class BuiltinTest(unittest.TestCase):
@@ -32,6 +36,40 @@ class BuiltinTest(unittest.TestCase):
 
       print('---')
 
+  def testWaitMaxJobs(self):
+    waiter = process.Waiter()
+    job_state = process.JobState()
+    for code in ['exit 1', 'exit 2', 'sleep 0.2; exit 3']:
+      p = process.Process(process.ExternalThunk(['sh', '-c', code], {}),
+                          job_state=job_state)
+      pid = p.Start()
+      waiter.Register(pid, p.WhenDone)
+      job_state.Register(pid, p)
+
+    # Two of them have to exit.  The sleeping one is last.
+    status = builtin.Wait(['-P', '2'], waiter, job_state, None)
+    self.assertTrue(status in (1, 2), status)
+    self.assertEqual(1, job_state.NumRunning())
+
+    # No need to wait.
+    self.assertEqual(0, builtin.Wait(['-P', '2'], waiter, job_state, None))
+
+    self.assertEqual(3, builtin.Wait(['-P', '1'], waiter, job_state, None))
+    self.assertEqual(True, job_state.AllDone())
+
+  def testHashUsage(self):
+    # The table isn't looked at.
+    self.assertRaises(args.UsageError, builtin.Hash, ['-t'], None)
+    self.assertRaises(args.UsageError, builtin.Hash, ['-r', 'ls'], None)
+
+  def testHashSlash(self):
+    arena = test_lib.MakeArena('<builtin_test.py>')
+    search_path = state.SearchPath(state.Mem('', [], {}, arena))
+    # Names with a slash aren't looked up, and aren't errors.
+    self.assertEqual(0, builtin.Hash(['/bin/ls', './nonexistent'], search_path))
+    self.assertEqual([], search_path.CachedCommands())
+    self.assertEqual(1, builtin.Hash(['-t', '/bin/ls'], search_path))
+
 
 if __name__ == '__main__':
   unittest.main()
@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+"""
+cmd_compile.py -- Compile command nodes into Python closures.
+
+This is the first step of the plan in core/compile.py.txt.  The tree-walking
+Executor re-examines node.tag on every execution, and it redoes static work
+like brace expansion for every iteration of a loop.  The compiler turns each
+command node into a closure ONCE, and caches it by node.
+
+- Dispatch on node.tag happens at compile time.
+- Brace expansion and $LINENO span lookup happen at compile time.
+- Loops, lists, && || and if call the closures of their children directly.
+- Everything else is delegated to the Executor, so the semantics are shared.
+
+It's enabled with 'set -o compile-commands'.
+"""
+
+from asdl import const
+
+from core import braces
+from core import state
+from core import util
+from core import word
+
+from osh.meta import ast, Id
+
+command_e = ast.command_e
+
+# Same as in Executor._Execute().  These nodes have no redirects, or their
+# redirects are evaluated elsewhere (FuncDef).
+_NO_REDIRECT_TAGS = (
+    command_e.NoOp, command_e.Assignment, command_e.ControlFlow,
+    command_e.Pipeline, command_e.AndOr, command_e.CommandList,
+    command_e.Sentence, command_e.TimeBlock,
+    command_e.FuncDef
+)
+
+
+class CommandCompiler(object):
+  """Compiles command nodes to closures, and caches them by node.
+
+  A compiled node is a function run(fork_external=True) -> status, which does
+  everything Executor._Execute() does.  Internally, each node is first
+  compiled to a "body" function body(fork_external) -> (status,
+  check_errexit), which is what Executor._Dispatch() does.
+  """
+
+  def __init__(self, ex, control_flow_exc):
+    """
+    Args:
+      ex: Executor, which we delegate to
+      control_flow_exc: the exception class for break/continue/return
+    """
+    self.ex = ex
+    self.control_flow_exc = control_flow_exc
+    self.cache = util.NodeCache()  # command node -> closure
+
+  def Compile(self, node):
+    """Return the closure for a node, compiling it on first use."""
+    run = self.cache.Get(node)
+    if run is None:
+      run = self._Finish(node, self._CompileBody(node))
+      self.cache.Put(node, run)
+    return run
+
+  def _CompileBody(self, node):
+    tag = node.tag
+    if tag == command_e.SimpleCommand:
+      return self._SimpleCommand(node)
+
+    if tag in (command_e.CommandList, command_e.BraceGroup,
+               command_e.DoGroup):
+      return self._List(node.children)
+
+    if tag == command_e.Sentence:
+      return self._Sentence(node)
+
+    if tag == command_e.AndOr:
+      return self._AndOr(node)
+
+    if tag == command_e.WhileUntil:
+      return self._WhileUntil(node)
+
+    if tag == command_e.ForEach:
+      return self._ForEach(node)
+
+    if tag == command_e.ForExpr:
+      return self._ForExpr(node)
+
+    if tag == command_e.If:
+      return self._If(node)
+
+    if tag == command_e.NoOp:
+      return lambda fork_external: (0, False)
+
+    # Everything else is executed by the tree-walking interpreter.  We look
+    # up its method now, rather than going through _Dispatch() every time.
+    method = self.ex.dispatch_table.get(tag)
+    if method is None:
+      raise NotImplementedError(node.__class__.__name__)
+    return lambda fork_external: method(node, fork_external)
+
+  def _Finish(self, node, body):
+    """Wrap a body with signal handling, redirects, and the errexit check."""
+    ex = self.ex
+    mem = ex.mem
+    fd_state = ex.fd_state
+
+    if node.tag in _NO_REDIRECT_TAGS or not node.redirects:
+      def run(fork_external=True):
+        if ex.nodes_to_run:
+          ex._RunPendingNodes()
+
+        ex.check_command_sub_status = False
+        status, check_errexit = body(fork_external)
+
+        mem.last_status = status
+        if check_errexit:
+          ex._CheckStatus(status, node)
+        return status
+
+    else:
+      def run(fork_external=True):
+        if ex.nodes_to_run:
+          ex._RunPendingNodes()
+
+        # Redirects have to be evaluated every time; see _EvalRedirects.
+        check_errexit = True
+        redirects = ex._EvalRedirects(node)
+        if redirects is None:  # evaluation error
+          status = 1
+        elif fd_state.Push(redirects, ex.waiter):
+          try:
+            ex.check_command_sub_status = False
+            status, check_errexit = body(fork_external)
+          finally:
+            fd_state.Pop()
+        else:  # Error applying redirects, e.g. bad file descriptor.
+          status = 1
+
+        mem.last_status = status
+        if check_errexit:
+          ex._CheckStatus(status, node)
+        return status
+
+    return run
+
+  def _SimpleCommand(self, node):
+    ex = self.ex
+
+    # Both of these depend only on the syntax.
+    span_id = const.NO_INTEGER
+    if node.words:
+      span_id = word.LeftMostSpanForWord(node.words[0])
+    words = braces.BraceExpandWords(node.words)
+
+    def body(fork_external):
+      return ex._RunSimpleCommandNode(node, words, span_id,
+                                      fork_external), True
+    return body
+
+  def _List(self, children):
+    runs = [self.Compile(child) for child in children]
+
+    def body(fork_external):
+      status = 0  # for empty list
+      for run in runs:
+        status = run()  # last status wins
+      return status, False
+    return body
+
+  def _Sentence(self, node):
+    ex = self.ex
+    child = node.child
+    if node.terminator.id == Id.Op_Semi:
+      run = self.Compile(child)
+      return lambda fork_external: (run(), False)
+    else:
+      return lambda fork_external: (ex._RunJobInBackground(child), False)
+
+  def _AndOr(self, node):
+    ex = self.ex
+    first = self.Compile(node.children[0])
+    rest = [(op_id, self.Compile(child))
+            for op_id, child in zip(node.ops, node.children[1:])]
+    last_index = len(rest) - 1
+
+    def body(fork_external):
+      # Suppress failure for every child except the last one.
+      ex._PushErrExit()
+      try:
+        status = first()
+      finally:
+        ex._PopErrExit()
+
+      check_errexit = False
+      for i, (op_id, run) in enumerate(rest):
+        if op_id == Id.Op_DPipe and status == 0:
+          continue  # short circuit
+        elif op_id == Id.Op_DAmp and status != 0:
+          continue  # short circuit
+
+        if i == last_index:  # errexit handled differently for last child
+          status = run()
+          check_errexit = True
+        else:
+          ex._PushErrExit()
+          try:
+            status = run()
+          finally:
+            ex._PopErrExit()
+      return status, check_errexit
+    return body
+
+  def _RunCond(self, cond):
+    """Return a function that runs a condition list with errexit disabled."""
+    ex = self.ex
+    cond_body = self._List(cond)
+
+    def run_cond():
+      ex._PushErrExit()
+      try:
+        status, _ = cond_body(True)
+      finally:
+        ex._PopErrExit()
+      return status
+    return run_cond
+
+  def _WhileUntil(self, node):
+    ex = self.ex
+    control_flow_exc = self.control_flow_exc
+    run_cond = self._RunCond(node.cond)
+    run_body = self.Compile(node.body)
+    is_while = node.keyword.id == Id.KW_While
+
+    def body(fork_external):
+      status = 0
+      ex.loop_level += 1
+      try:
+        while True:
+          cond_status = run_cond()
+          if (cond_status != 0) if is_while else (cond_status == 0):
+            break
+          try:
+            status = run_body()  # last one wins
+          except control_flow_exc as e:
+            if e.IsBreak():
+              status = 0
+              break
+            elif e.IsContinue():
+              status = 0
+            else:  # return needs to pop up more
+              raise
+      finally:
+        ex.loop_level -= 1
+      return status, False
+    return body
+
+  def _ForEach(self, node):
+    ex = self.ex
+    mem = ex.mem
+    control_flow_exc = self.control_flow_exc
+    iter_name = node.iter_name
+    do_arg_iter = node.do_arg_iter
+    words = None
+    if (not do_arg_iter and
+        braces.BraceExpansionSize(node.iter_words) <= braces.MAX_CACHED_WORDS):
+      words = braces.BraceExpandWords(node.iter_words)
+    run_body = self.Compile(node.body)
+
+    def body(fork_external):
+      if do_arg_iter:
+        iter_list = mem.GetArgv()
+      elif words is None or ex.exec_opts.stream_for:  # maybe iterate lazily
+        iter_list = ex._EvalForEachWords(node.iter_words)
+      else:
+        iter_list = ex.word_ev.EvalWordSequence(words)
+
+      status = 0  # in case we don't loop
+      ex.loop_level += 1
+      try:
+        for x in iter_list:
+          state.SetLocalString(mem, iter_name, x)
+          try:
+            status = run_body()  # last one wins
+          except control_flow_exc as e:
+            if e.IsBreak():
+              status = 0
+              break
+            elif e.IsContinue():
+              status = 0
+            else:  # return needs to pop up more
+              raise
+      finally:
+        ex.loop_level -= 1
+        # Stop a lazy iteration, e.g. of a command sub, if we broke out.
+        close = getattr(iter_list, 'close', None)
+        if close:
+          close()
+      return status, False
+    return body
+
+  def _ForExpr(self, node):
+    ex = self.ex
+    control_flow_exc = self.control_flow_exc
+    init, cond, update = node.init, node.cond, node.update
+    run_body = self.Compile(node.body)
+
+    def body(fork_external):
+      arith_ev = ex.arith_ev
+      status = 0
+      if init:
+        arith_ev.Eval(init)
+
+      ex.loop_level += 1
+      try:
+        while True:
+          if cond and not arith_ev.Eval(cond):
+            break
+
+          try:
+            status = run_body()
+          except control_flow_exc as e:
+            if e.IsBreak():
+              status = 0
+              break
+            elif e.IsContinue():
+              status = 0
+            else:  # return needs to pop up more
+              raise
+
+          if update:
+            arith_ev.Eval(update)
+      finally:
+        ex.loop_level -= 1
+      return status, False
+    return body
+
+  def _If(self, node):
+    arms = [(self._RunCond(arm.cond), self._List(arm.action))
+            for arm in node.arms]
+    # An if without an else is the same as an empty else.
+    else_body = self._List(node.else_action or [])
+
+    def body(fork_external):
+      for run_cond, action_body in arms:
+        status = run_cond()
+        if status == 0:
+          status, _ = action_body(True)
+          return status, False
+      if node.else_action is None:
+        return status, False
+      status, _ = else_body(True)
+      return status, False
+    return body
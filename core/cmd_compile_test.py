@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+"""
+cmd_compile_test.py: Tests for cmd_compile.py
+"""
+
+import unittest
+
+from core import cmd_compile  # module under test
+from core import cmd_exec_test
+from core import test_lib
+
+
+def _Execute(code_str):
+  arena = test_lib.MakeArena('<cmd_compile_test.py>')
+  c_parser = cmd_exec_test.InitCommandParser(code_str, arena=arena)
+  node = c_parser.ParseLogicalLine()
+
+  ex = cmd_exec_test.InitExecutor(arena)
+  ex.exec_opts.compile_commands = True
+  status = ex.Execute(node)
+  return ex, node, status
+
+
+class CommandCompilerTest(unittest.TestCase):
+
+  def testLoops(self):
+    ex, node, status = _Execute(
+        'x=; for i in a b c d; do if test $i = b; then continue; fi; '
+        'x=$x$i; if test $i = c; then break; fi; done')
+    self.assertEqual(0, status)
+    self.assertEqual('ac', ex.mem.GetVar('x').s)
+
+    ex, node, status = _Execute(
+        'n=0; while test $n -lt 5; do n=$((n+1)); done')
+    self.assertEqual('5', ex.mem.GetVar('n').s)
+
+    ex, node, status = _Execute(
+        'x=; for ((i=0; i<3; i++)); do x=$x$i; done')
+    self.assertEqual('012', ex.mem.GetVar('x').s)
+
+  def testAndOrStatus(self):
+    ex, node, status = _Execute('false && true')
+    self.assertEqual(1, status)
+    ex, node, status = _Execute('false || true')
+    self.assertEqual(0, status)
+    ex, node, status = _Execute('if false; then true; fi')
+    self.assertEqual(0, status)
+
+  def testCache(self):
+    ex, node, status = _Execute('for i in {a,b}{c,d}; do x=$i; done')
+    self.assertEqual('bd', ex.mem.GetVar('x').s)
+
+    # The node and all of its descendants were compiled once.
+    run = ex.compiler.Compile(node)
+    self.assertTrue(run is ex.compiler.Compile(node))
+    self.assertTrue(len(ex.compiler.cache) > 1)
+
+  def testNoRedirectTags(self):
+    self.assertTrue(cmd_compile.command_e.Pipeline in
+                    cmd_compile._NO_REDIRECT_TAGS)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -15,6 +15,7 @@ This just does head?  Last one wins.
 """
 from __future__ import print_function
 
+import io
 import os
 import resource
 import sys
@@ -27,8 +28,10 @@ from core import alloc
 from core import args
 from core import braces
 from core import builtin
+from core import cmd_compile
 from core import comp_builtins
 from core import expr_eval
+from core import glob_
 from core import legacy
 from core import main_loop
 from core import process
@@ -55,6 +58,8 @@ redir_arg_type_e = types.redir_arg_type_e
 
 command_e = ast.command_e
 redir_e = ast.redir_e
+word_e = ast.word_e
+word_part_e = ast.word_part_e
 lhs_expr_e = ast.lhs_expr_e
 assign_op_e = ast.assign_op_e
 
@@ -66,6 +71,105 @@ log = util.log
 e_die = util.e_die
 
 
+# Builtins that only read shell state and write to stdout.  A command sub or
+# subshell that runs just one of them doesn't need to fork.  See
+# Executor._InlineCommand().
+_INLINE_BUILTINS = (':', 'echo', 'pwd', 'true', 'false', 'test', '[')
+
+
+def _InlineBuiltinCommand(node):
+  """Return the SimpleCommand in node if it can be run without forking.
+
+  It must run a builtin in _INLINE_BUILTINS, with no redirects or temporary
+  bindings, and its words must have no side effects.  Whether the builtin is
+  shadowed by a function is checked later, at runtime.
+  """
+  node = _PureSimpleCommand(node)
+  if node is None:
+    return None
+
+  ok, arg0, _ = word.StaticEval(node.words[0])
+  if not ok or arg0 not in _INLINE_BUILTINS:
+    return None
+  return node
+
+
+def _PureSimpleCommand(node):
+  """If the node is a SimpleCommand whose argv can be evaluated anywhere,
+  return it.  Otherwise return None.
+
+  That means no redirects or temporary bindings, and words without side
+  effects.
+  """
+  # $(echo hi) is a CommandList, and $(echo hi;) has a Sentence.
+  while True:
+    if node.tag == command_e.CommandList and len(node.children) == 1:
+      node = node.children[0]
+    elif (node.tag == command_e.Sentence and
+          node.terminator.id == Id.Op_Semi):
+      node = node.child
+    else:
+      break
+
+  if node.tag != command_e.SimpleCommand:
+    return None
+  if not node.words or node.redirects or node.more_env:
+    return None
+
+  for w in node.words:
+    if not word.IsPureWord(w):
+      return None
+  return node
+
+
+def _StreamableCommandSub(words):
+  """For set -o stream-for.
+
+  Returns:
+    The command in 'for x in $(cmd)' or 'for x in `cmd`', or None if the words
+    are anything else.
+  """
+  if len(words) != 1:
+    return None
+  w = words[0]
+  if w.tag != word_e.CompoundWord or len(w.parts) != 1:
+    return None
+  part = w.parts[0]
+  if part.tag != word_part_e.CommandSubPart:
+    return None
+  if part.left_token.id not in (Id.Left_CommandSub, Id.Left_Backtick):
+    return None
+  return part.command_list
+
+
+# The first read() of a command sub asks for this many bytes.  The buffer
+# doubles each time it fills up, so big outputs take few system calls.
+_FIRST_READ_SIZE = 1 << 16  # 64 KiB
+
+
+def _ReadAllStripped(fd):
+  """Read a descriptor until EOF, and remove trailing newlines.
+
+  The output is read directly into a single growing buffer, and trailing
+  newlines are dropped before the one copy to a string.  This matters for
+  $(cat big.txt).
+  """
+  f = io.FileIO(fd, 'r', closefd=False)
+  buf = bytearray(_FIRST_READ_SIZE)
+  pos = 0
+  while True:
+    if pos == len(buf):
+      buf.extend('\0' * len(buf))
+    n = f.readinto(memoryview(buf)[pos:])
+    if not n:
+      break
+    pos += n
+
+  while pos and buf[pos - 1] == 10:  # '\n'
+    pos -= 1
+  return memoryview(buf)[:pos].tobytes()
+
+
 class _ControlFlow(RuntimeError):
   """Internal execption for control flow.
 
@@ -142,12 +246,15 @@ class Executor(object):
     self.traps = {}  # signal/hook name -> callable
     self.nodes_to_run = []  # list of nodes, appended to by signal handlers
     self.dir_stack = state.DirStack()
+    self.search_path = state.SearchPath(mem)  # for external commands and hash
 
     self.targets = []  # make syntax enters stuff here -- Target()
                        # metaprogramming or regular target syntax
                        # Whether argv[0] is make determines if it is executed
 
     self.waiter = process.Waiter()
+    self.profiler = devtools.profiler  # for --profile-commands
+    self.waiter.profiler = self.profiler
     # sleep 5 & puts a (PID, job#) entry here.  And then "jobs" displays it.
     self.job_state = process.JobState()
     self.tracer = Tracer(parse_ctx, exec_opts, mem, self.word_ev,
@@ -156,6 +263,47 @@ class Executor(object):
     self.loop_level = 0  # for detecting bad top-level break/continue
     self.check_command_sub_status = False  # a hack
 
+    # command_e tag -> method that returns (status, check_errexit).  This
+    # avoids a long if/elif chain in _Dispatch().
+    self.dispatch_table = {
+        command_e.SimpleCommand: self._DispatchSimpleCommand,
+        command_e.Sentence: self._DispatchSentence,
+        command_e.Pipeline: self._DispatchPipeline,
+        command_e.Subshell: self._DispatchSubshell,
+        command_e.DBracket: self._DispatchDBracket,
+        command_e.DParen: self._DispatchDParen,
+        command_e.Assignment: self._DispatchAssignment,
+        command_e.ControlFlow: self._DispatchControlFlow,
+        command_e.CommandList: self._DispatchCommandList,
+        command_e.BraceGroup: self._DispatchCommandList,
+        command_e.AndOr: self._DispatchAndOr,
+        command_e.WhileUntil: self._DispatchWhileUntil,
+        command_e.ForEach: self._DispatchForEach,
+        command_e.ForExpr: self._DispatchForExpr,
+        command_e.DoGroup: self._DispatchDoGroup,
+        command_e.FuncDef: self._DispatchFuncDef,
+        command_e.If: self._DispatchIf,
+        command_e.NoOp: self._DispatchNoOp,
+        command_e.Case: self._DispatchCase,
+        command_e.TimeBlock: self._DispatchTimeBlock,
+    }
+
+    # node -> SimpleCommand or None.  See _InlineCommand().
+    self.inline_cache = util.NodeCache()
+
+    # node -> SimpleCommand or None.  See _ExternalThunk().
+    self.spawn_cache = util.NodeCache()
+
+    # node -> constant patterns.  See _CompileCase().
+    self.case_cache = util.NodeCache()
+
+    # BracedWordTree -> list of words.  Brace expansion depends only on the
+    # syntax.
+    self.brace_cache = braces.BraceCache()
+
+    # For set -o compile-commands.
+    self.compiler = cmd_compile.CommandCompiler(self, _ControlFlow)
+
   def _EvalHelper(self, c_parser, source_name):
     self.arena.PushSource(source_name)
     try:
@@ -246,10 +394,20 @@ class Executor(object):
     # NOTE: Redirects were processed earlier.
     if argv:
       environ = self.mem.GetExported()
-      process.ExecExternalProgram(argv, environ)  # never returns
+      argv0_path = self._LookupExternal(argv[0])
+      process.ExecExternalProgram(argv, environ, argv0_path)  # never returns
     else:
       return 0
 
+  def _LookupExternal(self, arg0):
+    """Returns the full path of an external command, or None.
+
+    None means os.execvpe() should search $PATH, e.g. with 'set +h'.
+    """
+    if self.exec_opts.hashall:
+      return self.search_path.CachedLookup(arg0)
+    return None
+
   def _RunBuiltin(self, builtin_id, argv, span_id):
     # NOTE: Builtins don't need to know their own name.
     argv = argv[1:]
@@ -290,7 +448,7 @@ class Executor(object):
       status = builtin.Wait(argv, self.waiter, self.job_state, self.mem)
 
     elif builtin_id == builtin_e.JOBS:
-      status = builtin.Jobs(argv, self.job_state)
+      status = builtin.Jobs(argv, self.waiter, self.job_state)
 
     elif builtin_id == builtin_e.PUSHD:
       status = builtin.Pushd(argv, self.mem.GetVar('HOME'), self.dir_stack)
@@ -344,12 +502,13 @@ class Executor(object):
       status = builtin.GetOpts(argv, self.mem)
 
     elif builtin_id == builtin_e.COMMAND:
-      path = self.mem.GetVar('PATH')
-      status = builtin.Command(argv, self.funcs, path)
+      status = builtin.Command(argv, self.funcs, self.search_path)
 
     elif builtin_id == builtin_e.TYPE:
-      path = self.mem.GetVar('PATH')
-      status = builtin.Type(argv, self.funcs, path)
+      status = builtin.Type(argv, self.funcs, self.search_path)
+
+    elif builtin_id == builtin_e.HASH:
+      status = builtin.Hash(argv, self.search_path)
 
     elif builtin_id in (builtin_e.DECLARE, builtin_e.TYPESET):
       # These are synonyms
@@ -496,9 +655,14 @@ class Executor(object):
       redirects.append(r)
     return redirects
 
-  def _MakeProcess(self, node, job_state=None, disable_errexit=False):
+  def _MakeProcess(self, node, job_state=None, disable_errexit=False,
+                   kind='subshell'):
     """
     Assume we will run the node in another process.  Return a process.
+
+    Args:
+      kind: for --profile-commands, unless it's an external command.  e.g.
+        'command-sub'
     """
     if node.tag == command_e.ControlFlow:
       # Pipeline or subshells with control flow are invalid, e.g.:
@@ -517,11 +681,64 @@ class Executor(object):
     # interleaved.
     # - We could turn the `exit` builtin into a FatalRuntimeError exception and
     # get this check for "free".
-    thunk = process.SubProgramThunk(self, node,
-                                    disable_errexit=disable_errexit)
+    thunk = self._ExternalThunk(node)
+    if thunk is None:
+      thunk = process.SubProgramThunk(self, node,
+                                      disable_errexit=disable_errexit)
+      name = ''
+    else:
+      kind, name = 'external', thunk.argv[0]
     p = process.Process(thunk, job_state=job_state)
+    self._SetProfile(p, kind, name, self._ProfileSpanId(node))
     return p
 
+  def _SetProfile(self, p, kind, name, span_id):
+    """Make the process record a row for --profile-commands when it starts."""
+    if self.profiler:
+      p.profiler = self.profiler
+      p.profile_desc = (kind, name, span_id)
+
+  def _ExternalThunk(self, node):
+    """Return an ExternalThunk if the node just runs an external command.
+
+    Then process.Process can start it with posix_spawn(), rather than forking
+    a child shell that evaluates the node and calls exec().
+
+    Returns:
+      ExternalThunk or None
+    """
+    if self.exec_opts.xtrace:  # the child shell traces the command
+      return None
+
+    simple = self.spawn_cache.Get(node, False)
+    if simple is False:
+      simple = _PureSimpleCommand(node)
+      self.spawn_cache.Put(node, simple)
+    if simple is None:
+      return None
+
+    # The words are pure, so it doesn't matter whether we evaluate them here
+    # or in the child.  Errors are reported by the child.
+    saved_spid = self.mem.current_spid
+    self.mem.SetCurrentSpanId(word.LeftMostSpanForWord(simple.words[0]))
+    try:
+      argv = self.word_ev.EvalWordSequence(
+          self.brace_cache.ExpandWords(simple.words))
+    except util.FatalRuntimeError:
+      return None
+    finally:
+      self.mem.current_spid = saved_spid
+
+    if not argv:
+      return None
+    arg0 = argv[0]
+    if (builtin.ResolveSpecial(arg0) != builtin_e.NONE or
+        arg0 in self.funcs or builtin.Resolve(arg0) != builtin_e.NONE):
+      return None
+
+    argv0_path = self._LookupExternal(arg0)
+    return process.ExternalThunk(argv, self.mem.GetExported(), argv0_path)
+
   def _RunSimpleCommand(self, argv, fork_external, span_id, funcs=True):
     """
     Args:
@@ -547,7 +764,13 @@ class Executor(object):
       func_node = self.funcs.get(arg0)
       if func_node is not None:
         # NOTE: Functions could call 'exit 42' directly, etc.
-        status = self._RunFunc(func_node, argv[1:])
+        if self.profiler:
+          self.profiler.Start('function', arg0, span_id)
+        try:
+          status = self._RunFunc(func_node, argv[1:])
+        finally:
+          if self.profiler:
+            self.profiler.Stop()
         return status
 
     builtin_id = builtin.Resolve(arg0)
@@ -571,24 +794,100 @@ class Executor(object):
       return status
 
     environ = self.mem.GetExported()  # Include temporary variables
+    argv0_path = self._LookupExternal(arg0)
 
     if fork_external:
-      thunk = process.ExternalThunk(argv, environ)
+      thunk = process.ExternalThunk(argv, environ, argv0_path)
       p = process.Process(thunk)
+      self._SetProfile(p, 'external', arg0, span_id)
       status = p.Run(self.waiter)
+      if status == 127:  # exec failed, e.g. because the file was removed
+        self.search_path.MaybeRemoveEntry(arg0)
       return status
 
     # NOTE: Never returns!
-    process.ExecExternalProgram(argv, environ)
+    process.ExecExternalProgram(argv, environ, argv0_path)
+
+  def _RunSimpleCommandNode(self, node, words, span_id, fork_external):
+    """Evaluate the words and environment of a SimpleCommand, and run it.
+
+    Args:
+      node: command.SimpleCommand
+      words: node.words after brace expansion
+      span_id: for $LINENO
+      fork_external: passed to _RunSimpleCommand
+    """
+    self.mem.SetCurrentSpanId(span_id)
+
+    # PROBLEM: We want to log argv in 'xtrace' mode, but we may have already
+    # redirected here, which screws up logging.  For example, 'echo hi
+    # >/dev/null 2>&1'.  We want to evaluate argv and log it BEFORE applying
+    # redirects.
+
+    # Another problem:
+    # - tracing can be called concurrently from multiple processes, leading
+    # to overlap.  Maybe have a mode that creates a file per process.
+    # xtrace-proc
+    # - line numbers for every command would be very nice.  But then you have
+    # to print the filename too.
+
+    argv = self.word_ev.EvalWordSequence(words)
+
+    # This comes before evaluating env, in case there are problems evaluating
+    # it.  We could trace the env separately?  Also trace unevaluated code
+    # with set-o verbose?
+    self.tracer.OnSimpleCommand(argv)
+
+    if node.more_env:
+      self.mem.PushTemp()
+    try:
+      for env_pair in node.more_env:
+        val = self.word_ev.EvalWordToString(env_pair.val)
+        # Set each var so the next one can reference it.  Example:
+        # FOO=1 BAR=$FOO ls /
+        self.mem.SetVar(ast.LhsName(env_pair.name), val,
+                        (var_flags_e.Exported,), scope_e.TempEnv)
+
+      # NOTE: This might never return!  In the case of fork_external=False.
+      status = self._RunSimpleCommand(argv, fork_external, span_id)
+    finally:
+      if node.more_env:
+        self.mem.PopTemp()
+    return status
+
+  def _ProfileSpanId(self, node):
+    """Return the location of a command, for --profile-commands."""
+    while (node.tag in (command_e.CommandList, command_e.Pipeline) and
+           node.children):
+      node = node.children[0]
+    if node.tag == command_e.SimpleCommand and node.words:
+      return word.LeftMostSpanForWord(node.words[0])
+    return const.NO_INTEGER
 
   def _RunPipeline(self, node):
+    if self.profiler:
+      self.profiler.Start('pipeline', '', self._ProfileSpanId(node))
+    try:
+      return self._RunPipelineInternal(node)
+    finally:
+      if self.profiler:
+        self.profiler.Stop()
+
+  def _RunPipelineInternal(self, node):
     pi = process.Pipeline()
 
     # First n-1 processes (which is empty when n == 1)
     n = len(node.children)
     for i in xrange(n - 1):
-      p = self._MakeProcess(node.children[i])
-      pi.Add(p)
+      child = node.children[i]
+      inline_node = self._InlineCommand(child)
+      if inline_node:
+        # e.g. 'echo hi | read x'.  Pipeline.Start() hands the output to the
+        # next stage.
+        status, stdout = self._RunInlineCaptured(inline_node)
+        pi.Add(process.CapturedOutput(status, stdout))
+      else:
+        pi.Add(self._MakeProcess(child))
 
     # Last piece of code is in THIS PROCESS.  'echo foo | read line; echo $line'
     pi.AddLast((self, node.children[n-1]))
@@ -653,444 +952,489 @@ class Executor(object):
     # command.
     self.check_command_sub_status = False
 
-    #argv0 = None  # for error message
-    check_errexit = False  # for errexit
-
-    if node.tag == command_e.SimpleCommand:
-      check_errexit = True
-
-      # Find span_id for a basic implementation of $LINENO, e.g.
-      # PS4='+$SOURCE_NAME:$LINENO:'
-      # NOTE: osh2oil uses node.more_env, but we don't need that.
-      span_id = const.NO_INTEGER
-      if node.words:
-        first_word = node.words[0]
-        span_id = word.LeftMostSpanForWord(first_word)
-
-      self.mem.SetCurrentSpanId(span_id)
-
-      # PROBLEM: We want to log argv in 'xtrace' mode, but we may have already
-      # redirected here, which screws up logging.  For example, 'echo hi
-      # >/dev/null 2>&1'.  We want to evaluate argv and log it BEFORE applying
-      # redirects.
-
-      # Another problem:
-      # - tracing can be called concurrently from multiple processes, leading
-      # to overlap.  Maybe have a mode that creates a file per process.
-      # xtrace-proc
-      # - line numbers for every command would be very nice.  But then you have
-      # to print the filename too.
-
-      words = braces.BraceExpandWords(node.words)
-      argv = self.word_ev.EvalWordSequence(words)
+    method = self.dispatch_table.get(node.tag)
+    if method is None:
+      raise NotImplementedError(node.__class__.__name__)
+    return method(node, fork_external)
+
+  def _DispatchSimpleCommand(self, node, fork_external):
+    # Find span_id for a basic implementation of $LINENO, e.g.
+    # PS4='+$SOURCE_NAME:$LINENO:'
+    # NOTE: osh2oil uses node.more_env, but we don't need that.
+    span_id = const.NO_INTEGER
+    if node.words:
+      first_word = node.words[0]
+      span_id = word.LeftMostSpanForWord(first_word)
+
+    words = self.brace_cache.ExpandWords(node.words)
+    status = self._RunSimpleCommandNode(node, words, span_id, fork_external)
+    return status, True
+
+  def _DispatchSentence(self, node, fork_external):
+    # Don't check_errexit since this isn't a real node!
+    if node.terminator.id == Id.Op_Semi:
+      status = self._Execute(node.child)
+    else:
+      status = self._RunJobInBackground(node.child)
+    return status, False
 
-      # This comes before evaluating env, in case there are problems evaluating
-      # it.  We could trace the env separately?  Also trace unevaluated code
-      # with set-o verbose?
-      self.tracer.OnSimpleCommand(argv)
+  def _DispatchPipeline(self, node, fork_external):
+    check_errexit = True
+    if node.stderr_indices:
+      raise NotImplementedError('|&')
 
-      if node.more_env:
-        self.mem.PushTemp()
+    if node.negated:
+      self._PushErrExit()
       try:
-        for env_pair in node.more_env:
-          val = self.word_ev.EvalWordToString(env_pair.val)
-          # Set each var so the next one can reference it.  Example:
-          # FOO=1 BAR=$FOO ls /
-          self.mem.SetVar(ast.LhsName(env_pair.name), val,
-                          (var_flags_e.Exported,), scope_e.TempEnv)
-
-        # NOTE: This might never return!  In the case of fork_external=False.
-        status = self._RunSimpleCommand(argv, fork_external, span_id)
+        status2 = self._RunPipeline(node)
       finally:
-        if node.more_env:
-          self.mem.PopTemp()
+        self._PopErrExit()
 
-    elif node.tag == command_e.Sentence:
-      # Don't check_errexit since this isn't a real node!
-      if node.terminator.id == Id.Op_Semi:
-        status = self._Execute(node.child)
+      # errexit is disabled for !.
+      check_errexit = False
+      status = 1 if status2 == 0 else 0
+    else:
+      status = self._RunPipeline(node)
+    return status, check_errexit
+
+  def _DispatchSubshell(self, node, fork_external):
+    inline_node = self._InlineCommand(node.child)
+    if inline_node:
+      status = self._RunInline(inline_node)
+      return status, True
+
+    # This makes sure we don't waste a process if we'd launch one anyway.
+    p = self._MakeProcess(node.child)
+    status = p.Run(self.waiter)
+    return status, True
+
+  def _DispatchDBracket(self, node, fork_external):
+    result = self.bool_ev.Eval(node.expr)
+    status = 0 if result else 1
+    return status, True
+
+  def _DispatchDParen(self, node, fork_external):
+    i = self.arith_ev.Eval(node.child)
+    status = 0 if i != 0 else 1
+    return status, True
+
+  def _DispatchAssignment(self, node, fork_external):
+    flags = word_compile.ParseAssignFlags(node.flags)
+
+    if node.keyword == Id.Assign_Local:
+      lookup_mode = scope_e.LocalOnly
+    # typeset and declare are synonyms?  I see typeset -a a=() the most.
+    elif node.keyword in (Id.Assign_Declare, Id.Assign_Typeset):
+      # declare is like local, except it can also be used outside functions?
+      if var_flags_e.Global in flags:
+        lookup_mode = scope_e.GlobalOnly
       else:
-        status = self._RunJobInBackground(node.child)
+        lookup_mode = scope_e.LocalOnly
+    elif node.keyword == Id.Assign_Readonly:
+      lookup_mode = scope_e.Dynamic
+      flags.append(var_flags_e.ReadOnly)
+    elif node.keyword == Id.Assign_None:  # mutate existing local or global
+      lookup_mode = scope_e.Dynamic
+    else:
+      raise AssertionError(node.keyword)
+
+    for pair in node.pairs:
+      if pair.op == assign_op_e.PlusEqual:
+        assert pair.rhs, pair.rhs  # I don't think a+= is valid?
+        val = self.word_ev.EvalRhsWord(pair.rhs)
+        old_val, lval = expr_eval.EvalLhsAndLookup(pair.lhs, self.arith_ev,
+                                                   self.mem, self.exec_opts)
+        sig = (old_val.tag, val.tag)
+        if sig == (value_e.Undef, value_e.Str):
+          pass  # val is RHS
+        elif sig == (value_e.Undef, value_e.StrArray):
+          pass  # val is RHS
+        elif sig == (value_e.Str, value_e.Str):
+          val = runtime.Str(old_val.s + val.s)
+        elif sig == (value_e.Str, value_e.StrArray):
+          e_die("Can't append array to string")
+        elif sig == (value_e.StrArray, value_e.Str):
+          e_die("Can't append string to array")
+        elif sig == (value_e.StrArray, value_e.StrArray):
+          val = runtime.StrArray(old_val.strs + val.strs)
+
+      else:  # plain assignment
+        spid = pair.spids[0]  # Source location for tracing
+        lval = self._EvalLhs(pair.lhs, spid, lookup_mode)
+
+        # RHS can be a string or array.
+        if pair.rhs:
+          val = self.word_ev.EvalRhsWord(pair.rhs)
+          assert isinstance(val, runtime.value), val
 
-    elif node.tag == command_e.Pipeline:
-      check_errexit = True
-      if node.stderr_indices:
-        raise NotImplementedError('|&')
+        else:  # e.g. 'readonly x' or 'local x'
+          val = None
 
-      if node.negated:
-        self._PushErrExit()
-        try:
-          status2 = self._RunPipeline(node)
-        finally:
-          self._PopErrExit()
+      # NOTE: In bash and mksh, declare -a myarray makes an empty cell with
+      # Undef value, but the 'array' attribute.
+
+      #log('setting %s to %s with flags %s', lval, val, flags)
+      self.mem.SetVar(lval, val, flags, lookup_mode,
+                      strict_array=self.exec_opts.strict_array)
 
-        # errexit is disabled for !.
-        check_errexit = False
-        status = 1 if status2 == 0 else 0
+      # Assignment always appears to have a spid.
+      if node.spids:
+        current_spid = node.spids[0]
       else:
-        status = self._RunPipeline(node)
+        current_spid = const.NO_INTEGER
+      self.mem.SetCurrentSpanId(current_spid)
+      self.tracer.OnAssignment(lval, pair.op, val, flags, lookup_mode)
 
-    elif node.tag == command_e.Subshell:
-      check_errexit = True
-      # This makes sure we don't waste a process if we'd launch one anyway.
-      p = self._MakeProcess(node.child)
-      status = p.Run(self.waiter)
+    # PATCH to be compatible with existing shells: If the assignment had a
+    # command sub like:
+    #
+    # s=$(echo one; false)
+    #
+    # then its status will be in mem.last_status, and we can check it here.
+    # If there was NOT a command sub in the assignment, then we don't want to
+    # check it.
+    if node.keyword == Id.Assign_None:  # mutate existing local or global
+      # Only do this if there was a command sub?  How?  Look at node?
+      # Set a flag in mem?   self.mem.last_status or
+      if self.check_command_sub_status:
+        self._CheckStatus(self.mem.last_status, node)
+        # A global assignment shouldn't clear $?.
+        status = self.mem.last_status
+      else:
+        status = 0
+    else:
+      # To be compatible with existing shells, local assignments DO clear
+      # $?.  Even in strict mode, we don't need to bother setting
+      # check_errexit = True, because we would have already checked the
+      # command sub in RunCommandSub.
+      status = 0
+      # TODO: maybe we should have a "sane-status" that respects this:
+      # false; echo $?; local f=x; echo $?
+    return status, False
+
+  def _DispatchControlFlow(self, node, fork_external):
+    if node.arg_word:  # Evaluate the argument
+      val = self.word_ev.EvalWordToString(node.arg_word)
+      assert val.tag == value_e.Str
+      arg = int(val.s)  # They all take integers
+    else:
+      arg = 0  # return 0, exit 0, break 0 levels, etc.
+
+    # NOTE: We don't do anything about a top-level 'return' here.  Unlike in
+    # bash, that is OK.  If you can return from a sourced script, it makes
+    # sense to return from a main script.
+    ok = True
+    tok = node.token
+    if (tok.id in (Id.ControlFlow_Break, Id.ControlFlow_Continue) and
+        self.loop_level == 0):
+      ok = False
+      msg = 'Invalid control flow at top level'
+
+    if ok:
+      raise _ControlFlow(tok, arg)
+
+    if self.exec_opts.strict_control_flow:
+      e_die(msg, token=tok)
+    else:
+      # Only print warnings, never fatal.
+      # Bash oddly only exits 1 for 'return', but no other shell does.
+      ui.PrintFilenameAndLine(tok.span_id, self.arena)
+      util.warn(msg)
+      status = 0
+    return status, False
 
-    elif node.tag == command_e.DBracket:
-      check_errexit = True
-      result = self.bool_ev.Eval(node.expr)
-      status = 0 if result else 1
+  # Used for both CommandList and BraceGroup.  The only difference between
+  # these two is that CommandList has no redirects.  We already took care of
+  # that in _Execute().
+  def _DispatchCommandList(self, node, fork_external):
+    status = self._ExecuteList(node.children)
+    return status, False
 
-    elif node.tag == command_e.DParen:
-      check_errexit = True
-      i = self.arith_ev.Eval(node.child)
-      status = 0 if i != 0 else 1
+  def _DispatchAndOr(self, node, fork_external):
+    check_errexit = False
+    # NOTE: && and || have EQUAL precedence in command mode.  See case #13
+    # in dbracket.test.sh.
 
-    elif node.tag == command_e.Assignment:
-      flags = word_compile.ParseAssignFlags(node.flags)
+    left = node.children[0]
 
-      if node.keyword == Id.Assign_Local:
-        lookup_mode = scope_e.LocalOnly
-      # typeset and declare are synonyms?  I see typeset -a a=() the most.
-      elif node.keyword in (Id.Assign_Declare, Id.Assign_Typeset):
-        # declare is like local, except it can also be used outside functions?
-        if var_flags_e.Global in flags:
-          lookup_mode = scope_e.GlobalOnly
-        else:
-          lookup_mode = scope_e.LocalOnly
-      elif node.keyword == Id.Assign_Readonly:
-        lookup_mode = scope_e.Dynamic
-        flags.append(var_flags_e.ReadOnly)
-      elif node.keyword == Id.Assign_None:  # mutate existing local or global
-        lookup_mode = scope_e.Dynamic
-      else:
-        raise AssertionError(node.keyword)
+    # Suppress failure for every child except the last one.
+    self._PushErrExit()
+    try:
+      status = self._Execute(left)
+    finally:
+      self._PopErrExit()
 
-      for pair in node.pairs:
-        if pair.op == assign_op_e.PlusEqual:
-          assert pair.rhs, pair.rhs  # I don't think a+= is valid?
-          val = self.word_ev.EvalRhsWord(pair.rhs)
-          old_val, lval = expr_eval.EvalLhsAndLookup(pair.lhs, self.arith_ev,
-                                                     self.mem, self.exec_opts)
-          sig = (old_val.tag, val.tag)
-          if sig == (value_e.Undef, value_e.Str):
-            pass  # val is RHS
-          elif sig == (value_e.Undef, value_e.StrArray):
-            pass  # val is RHS
-          elif sig == (value_e.Str, value_e.Str):
-            val = runtime.Str(old_val.s + val.s)
-          elif sig == (value_e.Str, value_e.StrArray):
-            e_die("Can't append array to string")
-          elif sig == (value_e.StrArray, value_e.Str):
-            e_die("Can't append string to array")
-          elif sig == (value_e.StrArray, value_e.StrArray):
-            val = runtime.StrArray(old_val.strs + val.strs)
-
-        else:  # plain assignment
-          spid = pair.spids[0]  # Source location for tracing
-          lval = self._EvalLhs(pair.lhs, spid, lookup_mode)
-
-          # RHS can be a string or array.
-          if pair.rhs:
-            val = self.word_ev.EvalRhsWord(pair.rhs)
-            assert isinstance(val, runtime.value), val
-
-          else:  # e.g. 'readonly x' or 'local x'
-            val = None
-
-        # NOTE: In bash and mksh, declare -a myarray makes an empty cell with
-        # Undef value, but the 'array' attribute.
-
-        #log('setting %s to %s with flags %s', lval, val, flags)
-        self.mem.SetVar(lval, val, flags, lookup_mode,
-                        strict_array=self.exec_opts.strict_array)
-
-        # Assignment always appears to have a spid.
-        if node.spids:
-          current_spid = node.spids[0]
-        else:
-          current_spid = const.NO_INTEGER
-        self.mem.SetCurrentSpanId(current_spid)
-        self.tracer.OnAssignment(lval, pair.op, val, flags, lookup_mode)
+    i = 1
+    n = len(node.children)
+    while i < n:
+      #log('i %d status %d', i, status)
+      child = node.children[i]
+      op_id = node.ops[i-1]
 
-      # PATCH to be compatible with existing shells: If the assignment had a
-      # command sub like:
-      #
-      # s=$(echo one; false)
-      #
-      # then its status will be in mem.last_status, and we can check it here.
-      # If there was NOT a command sub in the assignment, then we don't want to
-      # check it.
-      if node.keyword == Id.Assign_None:  # mutate existing local or global
-        # Only do this if there was a command sub?  How?  Look at node?
-        # Set a flag in mem?   self.mem.last_status or
-        if self.check_command_sub_status:
-          self._CheckStatus(self.mem.last_status, node)
-          # A global assignment shouldn't clear $?.
-          status = self.mem.last_status
-        else:
-          status = 0
-      else:
-        # To be compatible with existing shells, local assignments DO clear
-        # $?.  Even in strict mode, we don't need to bother setting
-        # check_errexit = True, because we would have already checked the
-        # command sub in RunCommandSub.
-        status = 0
-        # TODO: maybe we should have a "sane-status" that respects this:
-        # false; echo $?; local f=x; echo $?
-
-    elif node.tag == command_e.ControlFlow:
-      if node.arg_word:  # Evaluate the argument
-        val = self.word_ev.EvalWordToString(node.arg_word)
-        assert val.tag == value_e.Str
-        arg = int(val.s)  # They all take integers
-      else:
-        arg = 0  # return 0, exit 0, break 0 levels, etc.
-
-      # NOTE: We don't do anything about a top-level 'return' here.  Unlike in
-      # bash, that is OK.  If you can return from a sourced script, it makes
-      # sense to return from a main script.
-      ok = True
-      tok = node.token
-      if (tok.id in (Id.ControlFlow_Break, Id.ControlFlow_Continue) and
-          self.loop_level == 0):
-        ok = False
-        msg = 'Invalid control flow at top level'
-
-      if ok:
-        raise _ControlFlow(tok, arg)
-
-      if self.exec_opts.strict_control_flow:
-        e_die(msg, token=tok)
-      else:
-        # Only print warnings, never fatal.
-        # Bash oddly only exits 1 for 'return', but no other shell does.
-        ui.PrintFilenameAndLine(tok.span_id, self.arena)
-        util.warn(msg)
-        status = 0
+      #log('child %s op_id %s', child, op_id)
 
-    # The only difference between these two is that CommandList has no
-    # redirects.  We already took care of that above.
-    elif node.tag in (command_e.CommandList, command_e.BraceGroup):
-      status = self._ExecuteList(node.children)
-      check_errexit = False
+      if op_id == Id.Op_DPipe and status == 0:
+        i += 1
+        continue  # short circuit
 
-    elif node.tag == command_e.AndOr:
-      # NOTE: && and || have EQUAL precedence in command mode.  See case #13
-      # in dbracket.test.sh.
+      elif op_id == Id.Op_DAmp and status != 0:
+        i += 1
+        continue  # short circuit
 
-      left = node.children[0]
+      if i == n - 1:  # errexit handled differently for last child
+        status = self._Execute(child)
+        check_errexit = True
+      else:
+        self._PushErrExit()
+        try:
+          status = self._Execute(child)
+        finally:
+          self._PopErrExit()
 
-      # Suppress failure for every child except the last one.
-      self._PushErrExit()
-      try:
-        status = self._Execute(left)
-      finally:
-        self._PopErrExit()
+      i += 1
+    return status, check_errexit
 
-      i = 1
-      n = len(node.children)
-      while i < n:
-        #log('i %d status %d', i, status)
-        child = node.children[i]
-        op_id = node.ops[i-1]
+  def _DispatchWhileUntil(self, node, fork_external):
+    if node.keyword.id == Id.KW_While:
+      _DonePredicate = lambda status: status != 0
+    else:
+      _DonePredicate = lambda status: status == 0
 
-        #log('child %s op_id %s', child, op_id)
+    status = 0
 
-        if op_id == Id.Op_DPipe and status == 0:
-          i += 1
-          continue  # short circuit
+    self.loop_level += 1
+    try:
+      while True:
+        self._PushErrExit()
+        try:
+          cond_status = self._ExecuteList(node.cond)
+        finally:
+          self._PopErrExit()
 
-        elif op_id == Id.Op_DAmp and status != 0:
-          i += 1
-          continue  # short circuit
+        done = cond_status != 0
+        if _DonePredicate(cond_status):
+          break
+        try:
+          status = self._Execute(node.body)  # last one wins
+        except _ControlFlow as e:
+          if e.IsBreak():
+            status = 0
+            break
+          elif e.IsContinue():
+            status = 0
+            continue
+          else:  # return needs to pop up more
+            raise
+    finally:
+      self.loop_level -= 1
+    return status, False
 
-        if i == n - 1:  # errexit handled differently for last child
-          status = self._Execute(child)
-          check_errexit = True
-        else:
-          self._PushErrExit()
-          try:
-            status = self._Execute(child)
-          finally:
-            self._PopErrExit()
+  def _EvalForEachWords(self, words):
+    """Return the values a 'for' loop iterates over.
 
-        i += 1
+    With set -o stream-for, the output of 'for x in $(cmd)' is split as it's
+    read, so the body runs while cmd is still running.
 
-    elif node.tag == command_e.WhileUntil:
-      if node.keyword.id == Id.KW_While:
-        _DonePredicate = lambda status: status != 0
-      else:
-        _DonePredicate = lambda status: status == 0
+    Big brace expansions of constants are iterated over lazily, so that
+    'for i in {a,b}{0,1,2,3,4,5,6,7,8,9}{0,1,2,3,4,5,6,7,8,9}...' doesn't
+    create every word up front.  Everything else is evaluated eagerly, since
+    the loop body could change the values of variables.
+    """
+    if self.exec_opts.stream_for:
+      node = _StreamableCommandSub(words)
+      # An inlined builtin is fast anyway.
+      if node is not None and self._InlineCommand(node) is None:
+        return self.word_ev.IterSplitGlob(self._StreamCommandSub(node))
+
+    if braces.BraceExpansionSize(words) > braces.MAX_CACHED_WORDS:
+      it = self.word_ev.IterStaticWords(words)
+      if it is not None:
+        return it
+    # NOTE: This does word splitting and globbing too.
+    return self.word_ev.EvalWordSequence(self.brace_cache.ExpandWords(words))
+
+  def _DispatchForEach(self, node, fork_external):
+    iter_name = node.iter_name
+    if node.do_arg_iter:
+      iter_list = self.mem.GetArgv()
+    else:
+      iter_list = self._EvalForEachWords(node.iter_words)
 
-      status = 0
+    status = 0  # in case we don't loop
+    self.loop_level += 1
+    try:
+      for x in iter_list:
+        #log('> ForEach setting %r', x)
+        state.SetLocalString(self.mem, iter_name, x)
+        #log('<')
 
-      self.loop_level += 1
-      try:
-        while True:
-          self._PushErrExit()
-          try:
-            cond_status = self._ExecuteList(node.cond)
-          finally:
-            self._PopErrExit()
-
-          done = cond_status != 0
-          if _DonePredicate(cond_status):
+        try:
+          status = self._Execute(node.body)  # last one wins
+        except _ControlFlow as e:
+          if e.IsBreak():
+            status = 0
+            break
+          elif e.IsContinue():
+            status = 0
+          else:  # return needs to pop up more
+            raise
+    finally:
+      self.loop_level -= 1
+      # Stop a lazy iteration, e.g. of a command sub, if we broke out.
+      close = getattr(iter_list, 'close', None)
+      if close:
+        close()
+    return status, False
+
+  def _DispatchForExpr(self, node, fork_external):
+    status = 0
+    init, cond, body, update = node.init, node.cond, node.body, node.update
+    if init:
+      self.arith_ev.Eval(init)
+
+    self.loop_level += 1
+    try:
+      while True:
+        if cond:
+          b = self.arith_ev.Eval(cond)
+          if not b:
             break
-          try:
-            status = self._Execute(node.body)  # last one wins
-          except _ControlFlow as e:
-            if e.IsBreak():
-              status = 0
-              break
-            elif e.IsContinue():
-              status = 0
-              continue
-            else:  # return needs to pop up more
-              raise
-      finally:
-        self.loop_level -= 1
 
-    elif node.tag == command_e.ForEach:
-      iter_name = node.iter_name
-      if node.do_arg_iter:
-        iter_list = self.mem.GetArgv()
-      else:
-        words = braces.BraceExpandWords(node.iter_words)
-        iter_list = self.word_ev.EvalWordSequence(words)
-        # We need word splitting and so forth
-        # NOTE: This expands globs too.  TODO: We should pass in a Globber()
-        # object.
-
-      status = 0  # in case we don't loop
-      self.loop_level += 1
-      try:
-        for x in iter_list:
-          #log('> ForEach setting %r', x)
-          state.SetLocalString(self.mem, iter_name, x)
-          #log('<')
-
-          try:
-            status = self._Execute(node.body)  # last one wins
-          except _ControlFlow as e:
-            if e.IsBreak():
-              status = 0
-              break
-            elif e.IsContinue():
-              status = 0
-            else:  # return needs to pop up more
-              raise
-      finally:
-        self.loop_level -= 1
+        try:
+          status = self._Execute(body)
+        except _ControlFlow as e:
+          if e.IsBreak():
+            status = 0
+            break
+          elif e.IsContinue():
+            status = 0
+          else:  # return needs to pop up more
+            raise
 
-    elif node.tag == command_e.ForExpr:
-      status = 0
-      init, cond, body, update = node.init, node.cond, node.body, node.update
-      if init:
-        self.arith_ev.Eval(init)
+        if update:
+          self.arith_ev.Eval(update)
 
-      self.loop_level += 1
+    finally:
+      self.loop_level -= 1
+    return status, False
+
+  def _DispatchDoGroup(self, node, fork_external):
+    status = self._ExecuteList(node.children)
+    return status, False  # not real statements
+
+  def _DispatchFuncDef(self, node, fork_external):
+    # NOTE: Would it make sense to evaluate the redirects BEFORE entering?
+    # It will save time on function calls.
+    self.funcs[node.name] = node
+    return 0, False
+
+  def _DispatchIf(self, node, fork_external):
+    done = False
+    for arm in node.arms:
+      self._PushErrExit()
       try:
-        while True:
-          if cond:
-            b = self.arith_ev.Eval(cond)
-            if not b:
-              break
-
-          try:
-            status = self._Execute(body)
-          except _ControlFlow as e:
-            if e.IsBreak():
-              status = 0
-              break
-            elif e.IsContinue():
-              status = 0
-            else:  # return needs to pop up more
-              raise
-
-          if update:
-            self.arith_ev.Eval(update)
-
+        status = self._ExecuteList(arm.cond)
       finally:
-        self.loop_level -= 1
+        self._PopErrExit()
 
-    elif node.tag == command_e.DoGroup:
-      status = self._ExecuteList(node.children)
-      check_errexit = False  # not real statements
+      if status == 0:
+        status = self._ExecuteList(arm.action)
+        done = True
+        break
+    # TODO: The compiler should flatten this
+    if not done and node.else_action is not None:
+      status = self._ExecuteList(node.else_action)
+    return status, False
 
-    elif node.tag == command_e.FuncDef:
-      # NOTE: Would it make sense to evaluate the redirects BEFORE entering?
-      # It will save time on function calls.
-      self.funcs[node.name] = node
-      status = 0
+  def _DispatchNoOp(self, node, fork_external):
+    return 0, False  # make it true
 
-    elif node.tag == command_e.If:
-      done = False
-      for arm in node.arms:
-        self._PushErrExit()
-        try:
-          status = self._ExecuteList(arm.cond)
-        finally:
-          self._PopErrExit()
+  def _CompileCase(self, node):
+    """Precompute the constant patterns of a case statement.
 
-        if status == 0:
-          status = self._ExecuteList(arm.action)
-          done = True
-          break
-      # TODO: The compiler should flatten this
-      if not done and node.else_action is not None:
-        status = self._ExecuteList(node.else_action)
-
-    elif node.tag == command_e.NoOp:
-      status = 0  # make it true
-
-    elif node.tag == command_e.Case:
-      val = self.word_ev.EvalWordToString(node.to_match)
-      to_match = val.s
-
-      status = 0  # If there are no arms, it should be zero?
-      done = False
-
-      for arm in node.arms:
-        for pat_word in arm.pat_list:
-          # NOTE: Is it OK that we're evaluating these as we go?
-
-          # TODO: case "$@") shouldn't succeed?  That's a type error?
-          # That requires strict-array?
-
-          pat_val = self.word_ev.EvalWordToString(pat_word, do_fnmatch=True)
-          #log('Matching word %r against pattern %r', to_match, pat_val.s)
-          if libc.fnmatch(pat_val.s, to_match):
-            status = self._ExecuteList(arm.action)
-            done = True  # TODO: Parse ;;& and for fallthrough and such?
-            break  # Only execute action ONCE
-        if done:
-          break
+    Returns:
+      literals: dict of string -> (position, arm index), for patterns without
+        glob syntax.  The first position wins.
+      patterns: list of (position, word, matcher, arm index) for the rest.
+        matcher is None if the word has to be evaluated each time.
+    """
+    literals = {}
+    patterns = []
+    pos = 0
+    for i, arm in enumerate(node.arms):
+      for pat_word in arm.pat_list:
+        ok, _, _ = word.StaticEval(pat_word)
+        if ok:
+          pat = self.word_ev.EvalWordToString(pat_word, do_fnmatch=True).s
+          lit = glob_.GlobToLiteral(pat)
+          if lit is not None:
+            if lit not in literals:
+              literals[lit] = (pos, i)
+          else:
+            patterns.append((pos, pat_word, glob_.CompileMatcher(pat), i))
+        else:
+          patterns.append((pos, pat_word, None, i))
+        pos += 1
+    return literals, patterns
+
+  def _DispatchCase(self, node, fork_external):
+    val = self.word_ev.EvalWordToString(node.to_match)
+    to_match = val.s
+
+    compiled = self.case_cache.Get(node)
+    if compiled is None:
+      compiled = self._CompileCase(node)
+      self.case_cache.Put(node, compiled)
+    literals, patterns = compiled
+
+    # Patterns are tried in order, and dynamic ones are evaluated as we go.
+    # A literal match only wins if no earlier pattern matches.
+    hit = literals.get(to_match)
+    limit = hit[0] if hit else sys.maxint
+
+    arm_index = hit[1] if hit else -1
+    for pos, pat_word, matcher, i in patterns:
+      if pos >= limit:
+        break
+      if matcher is None:
+        # TODO: case "$@") shouldn't succeed?  That's a type error?
+        # That requires strict-array?
+        pat_val = self.word_ev.EvalWordToString(pat_word, do_fnmatch=True)
+        matched = libc.fnmatch(pat_val.s, to_match)
+      else:
+        matched = matcher(to_match)
+      if matched:
+        arm_index = i
+        break
 
-    elif node.tag == command_e.TimeBlock:
-      # TODO:
-      # - When do we need RUSAGE_CHILDREN?
-      # - Respect TIMEFORMAT environment variable.
-      # "If this variable is not set, Bash acts as if it had the value"
-      # $'\nreal\t%3lR\nuser\t%3lU\nsys\t%3lS'
-      # "A trailing newline is added when the format string is displayed."
+    if arm_index == -1:
+      return 0, False  # If there are no arms, it should be zero?
 
-      start_t = time.time()  # calls gettimeofday() under the hood
-      start_u = resource.getrusage(resource.RUSAGE_SELF)
-      status = self._Execute(node.pipeline)
+    # Only execute action ONCE.
+    # TODO: Parse ;;& and for fallthrough and such?
+    status = self._ExecuteList(node.arms[arm_index].action)
+    return status, False
 
-      end_t = time.time()
-      end_u = resource.getrusage(resource.RUSAGE_SELF)
+  def _DispatchTimeBlock(self, node, fork_external):
+    # TODO:
+    # - When do we need RUSAGE_CHILDREN?
+    # - Respect TIMEFORMAT environment variable.
+    # "If this variable is not set, Bash acts as if it had the value"
+    # $'\nreal\t%3lR\nuser\t%3lU\nsys\t%3lS'
+    # "A trailing newline is added when the format string is displayed."
 
-      real = end_t - start_t
-      user = end_u.ru_utime - start_u.ru_utime
-      sys_ = end_u.ru_stime - start_u.ru_stime
-      libc.print_time(real, user, sys_)
+    start_t = time.time()  # calls gettimeofday() under the hood
+    start_u = resource.getrusage(resource.RUSAGE_SELF)
+    status = self._Execute(node.pipeline)
 
-    else:
-      raise NotImplementedError(node.__class__.__name__)
+    end_t = time.time()
+    end_u = resource.getrusage(resource.RUSAGE_SELF)
 
-    return status, check_errexit
+    real = end_t - start_t
+    user = end_u.ru_utime - start_u.ru_utime
+    sys_ = end_u.ru_stime - start_u.ru_stime
+    libc.print_time(real, user, sys_)
+    return status, False
 
   def _Execute(self, node, fork_external=True):
     """Apply redirects, call _Dispatch(), and performs the errexit check.
@@ -1104,12 +1448,11 @@ class Executor(object):
     # See core/builtin.py for the Python signal handler that appends to this
     # list.
 
+    if self.exec_opts.compile_commands:
+      return self.compiler.Compile(node)(fork_external)
+
     if self.nodes_to_run:
-      # Make a copy and clear it so we don't cause an infinite loop.
-      to_run = list(self.nodes_to_run)
-      del self.nodes_to_run[:]
-      for node in to_run:
-        self._Execute(node)
+      self._RunPendingNodes()
 
     # These nodes have no redirects.  NOTE: Function definitions have
     # redirects, but we do NOT want to evaluate them yet!  They're evaluated
@@ -1158,6 +1501,13 @@ class Executor(object):
       self._CheckStatus(status, node)
     return status
 
+  def _RunPendingNodes(self):
+    # Make a copy and clear it so we don't cause an infinite loop.
+    to_run = list(self.nodes_to_run)
+    del self.nodes_to_run[:]
+    for node in to_run:
+      self._Execute(node)
+
   def _ExecuteList(self, children):
     status = 0  # for empty list
     for child in children:
@@ -1242,9 +1592,84 @@ class Executor(object):
     else:
       return False  # nothing run, don't use its status
 
-  def RunCommandSub(self, node):
+  def _InlineCommand(self, node):
+    """For set -o inline-builtins.
+
+    Returns:
+      The SimpleCommand to run in this process instead of forking to run node,
+      or None.
+    """
+    if not self.exec_opts.inline_builtins:
+      return None
+
+    inline_node = self.inline_cache.Get(node, False)
+    if inline_node is False:
+      inline_node = _InlineBuiltinCommand(node)
+      self.inline_cache.Put(node, inline_node)
+
+    if inline_node is None:
+      return None
+    # It's a static word, so this doesn't evaluate anything.
+    _, arg0, _ = word.StaticEval(inline_node.words[0])
+    if arg0 in self.funcs:  # echo() { ... } shadows the builtin
+      return None
+    return inline_node
+
+  def _RunInline(self, node, disable_errexit=False):
+    """Run a node chosen by _InlineCommand() like a subprogram, but in this
+    process.
+
+    Like SubProgramThunk, errors and control flow don't escape.  $? is not
+    changed.
+    """
+    last_status = self.mem.last_status
+    if disable_errexit:
+      self._PushErrExit()
+    try:
+      self.ExecuteAndCatch(node)
+    finally:
+      if disable_errexit:
+        self._PopErrExit()
+    status = self.mem.last_status
+    self.mem.last_status = last_status
+    return status
+
+  def _RunInlineCaptured(self, node, disable_errexit=False):
+    """Run a node in this process, capturing stdout in a temp file.
+
+    Used for command subs and pipelines.  We don't use a pipe, because
+    nothing would read it while we write.
+
+    Returns:
+      (status, stdout string)
+    """
+    tmp = os.tmpfile()
+    try:
+      sys.stdout.flush()  # Don't capture output that's already buffered.
+      r = runtime.DescRedirect(Id.Redir_GreatAnd, 1, tmp.fileno())
+      if not self.fd_state.Push([r], self.waiter):
+        raise AssertionError("Couldn't redirect to temp file")
+      try:
+        status = self._RunInline(node, disable_errexit=disable_errexit)
+        sys.stdout.flush()  # e.g. pwd doesn't flush
+      finally:
+        self.fd_state.Pop()
+
+      tmp.seek(0)
+      stdout = tmp.read()
+    finally:
+      tmp.close()
+    return status, stdout
+
+  def _RunCommandSubProcess(self, node):
+    """Fork a process for a command sub, and read its stdout from a pipe.
+
+    Returns:
+      (status, stdout string)
+    """
     p = self._MakeProcess(node,
-                          disable_errexit=not self.exec_opts.strict_errexit)
+                          disable_errexit=not self.exec_opts.strict_errexit,
+                          kind='command-sub')
 
     r, w = os.pipe()
     p.AddStateChange(process.StdoutToPipe(r, w))
@@ -1252,16 +1677,55 @@ class Executor(object):
     #log('Command sub started %d', pid)
     self.waiter.Register(pid, p.WhenDone)
 
-    chunks = []
     os.close(w)  # not going to write
-    while True:
-      byte_str = os.read(r, 4096)
-      if not byte_str:
-        break
-      chunks.append(byte_str)
+    stdout = _ReadAllStripped(r)
     os.close(r)
 
     status = p.WaitUntilDone(self.waiter)
+    return status, stdout
+
+  def _StreamCommandSub(self, node):
+    """Fork a process for a command sub, and yield its stdout as it's read.
+
+    If the caller stops early, the pipe is closed, so the process gets SIGPIPE
+    if it writes more.  In either case we wait for it.
+    """
+    p = self._MakeProcess(node,
+                          disable_errexit=not self.exec_opts.strict_errexit,
+                          kind='command-sub')
+
+    r, w = process.PipeToShell()
+    p.AddStateChange(process.StdoutToPipe(r, w))
+    pid = p.Start()
+    self.waiter.Register(pid, p.WhenDone)
+
+    os.close(w)  # not going to write
+    f = io.FileIO(r, 'r', closefd=False)
+    try:
+      while True:
+        chunk = f.read(_FIRST_READ_SIZE)
+        if not chunk:
+          break
+        yield chunk
+    finally:
+      os.close(r)
+      status = p.WaitUntilDone(self.waiter)
+
+    # Unlike RunCommandSub(), the loop body has already set $?, so only
+    # strict-errexit looks at the status.
+    if (self.exec_opts.strict_errexit and self.exec_opts.ErrExit() and
+        status != 0):
+      raise util.ErrExitFailure(
+          'Command sub exited with status %d (%r)', status,
+          node.__class__.__name__)
+
+  def RunCommandSub(self, node):
+    inline_node = self._InlineCommand(node)
+    if inline_node:
+      status, stdout = self._RunInlineCaptured(
+          inline_node, disable_errexit=not self.exec_opts.strict_errexit)
+    else:
+      status, stdout = self._RunCommandSubProcess(node)
 
     # OSH has the concept of aborting in the middle of a WORD.  We're not
     # waiting until the command is over!
@@ -1283,7 +1747,7 @@ class Executor(object):
     # Runtime errors test case: # $("echo foo > $@")
     # Why rstrip()?
     # https://unix.stackexchange.com/questions/17747/why-does-shell-command-substitution-gobble-up-a-trailing-newline-char
-    return ''.join(chunks).rstrip('\n')
+    return stdout.rstrip('\n')
 
   def RunProcessSub(self, node, op_id):
     """Process sub creates a forks a process connected to a pipe.
@@ -1303,7 +1767,7 @@ class Executor(object):
 
     Should you put return codes in @PROCESS_SUB_STATUS?  You need two of them.
     """
-    p = self._MakeProcess(node)
+    p = self._MakeProcess(node, kind='process-sub')
 
     r, w = os.pipe()
 
@@ -9,6 +9,9 @@
 cmd_exec_test.py: Tests for cmd_exec.py
 """
 
+import cStringIO
+import csv
+import os
 import unittest
 import sys
 
@@ -31,7 +34,7 @@ def InitCommandParser(code_str, arena=None):
   return c_parser
 
 
-def InitExecutor(arena=None):
+def InitExecutor(arena=None, profiler=None):
   arena = arena or test_lib.MakeArena('<InitExecutor>')
 
   mem = state.Mem('', [], {}, arena)
@@ -43,7 +46,8 @@ def InitExecutor(arena=None):
   parse_ctx = parse_lib.ParseContext(arena, {})
 
   debug_f = util.DebugFile(sys.stderr)
-  devtools = dev.DevTools(dev.CrashDumper(''), debug_f, debug_f)
+  devtools = dev.DevTools(dev.CrashDumper(''), debug_f, debug_f,
+                          profiler=profiler)
 
   return cmd_exec.Executor(mem, fd_state, funcs, comp_funcs, exec_opts,
                            parse_ctx, devtools)
@@ -71,6 +75,19 @@ class ExpansionTest(unittest.TestCase):
     #print(ex._ExpandWords(node.words))
 
 
+class _UnknownNode(object):
+  tag = -1
+
+
+class DispatchTest(unittest.TestCase):
+
+  def testUnknownTag(self):
+    ex = InitExecutor()
+    node = _UnknownNode()
+    self.assertRaises(NotImplementedError, ex._Dispatch, node, True)
+    self.assertRaises(NotImplementedError, ex.arith_ev.Eval, node)
+
+
 class VarOpTest(unittest.TestCase):
 
   def testVarOps(self):
@@ -101,5 +118,189 @@ class VarOpTest(unittest.TestCase):
     print(part_vals)
 
 
+class InlineBuiltinTest(unittest.TestCase):
+
+  def testInlineBuiltinCommand(self):
+    CASES = [
+        ('echo hi', True),
+        ('echo "$x" ${y:-z};', True),
+        ('pwd', True),
+        ('echo hi > out.txt', False),
+        ('FOO=bar echo hi', False),
+        ('echo ${x=y}', False),
+        ('cd /', False),
+        ('ls', False),
+        ('echo a; echo b', False),
+    ]
+    for code_str, expected in CASES:
+      c_parser = InitCommandParser(code_str)
+      node = c_parser.ParseLogicalLine()
+      inline_node = cmd_exec._InlineBuiltinCommand(node)
+      self.assertEqual(expected, inline_node is not None, code_str)
+
+  def testRunInline(self):
+    arena = test_lib.MakeArena('<cmd_exec_test.py>')
+    ex = InitExecutor(arena)
+    ex.exec_opts.inline_builtins = True
+    c_parser = InitCommandParser('echo hi', arena=arena)
+    node = c_parser.ParseLogicalLine()
+
+    self.assertEqual('hi', ex.RunCommandSub(node))
+    self.assertEqual(0, ex.mem.last_status)
+
+    # A function shadows the builtin, so we have to fork.
+    ex.funcs['echo'] = node
+    self.assertEqual(None, ex._InlineCommand(node))
+
+  def testInlinePipeline(self):
+    arena = test_lib.MakeArena('<cmd_exec_test.py>')
+    ex = InitExecutor(arena)
+    ex.exec_opts.inline_builtins = True
+
+    c_parser = InitCommandParser('false | echo hi | read x', arena=arena)
+    node = c_parser.ParseLogicalLine()
+    ex.ExecuteAndCatch(node)
+    self.assertEqual('hi', ex.mem.GetVar('x').s)
+    self.assertEqual(['1', '0', '0'], ex.mem.GetVar('PIPESTATUS').strs)
+
+    # Too big for the pipe buffer
+    state.SetGlobalString(ex.mem, 'big', 'x' * 10000)
+    c_parser = InitCommandParser('echo $big | read y', arena=arena)
+    node = c_parser.ParseLogicalLine()
+    ex.ExecuteAndCatch(node)
+    self.assertEqual(10000, len(ex.mem.GetVar('y').s))
+
+
+class ExternalThunkTest(unittest.TestCase):
+
+  def testExternalThunk(self):
+    arena = test_lib.MakeArena('<cmd_exec_test.py>')
+    ex = InitExecutor(arena)
+    state.SetGlobalString(ex.mem, 'PATH', '/bin')
+
+    CASES = [
+        ('sh -c "exit 3"', True),
+        ('/bin/sh -c $x', True),
+        ('echo hi', False),  # builtin
+        ('sh > out.txt', False),
+        ('sh $((i++))', False),
+        ('sh; sh', False),
+    ]
+    for code_str, expected in CASES:
+      c_parser = InitCommandParser(code_str, arena=arena)
+      node = c_parser.ParseLogicalLine()
+      thunk = ex._ExternalThunk(node)
+      self.assertEqual(expected, thunk is not None, code_str)
+
+    c_parser = InitCommandParser('sh -c "exit 3"', arena=arena)
+    node = c_parser.ParseLogicalLine()
+    thunk = ex._ExternalThunk(node)
+    self.assertEqual(['sh', '-c', 'exit 3'], thunk.argv)
+    self.assertEqual('/bin/sh', thunk.argv0_path)
+
+    p = ex._MakeProcess(node)
+    self.assertEqual(3, p.Run(ex.waiter))
+
+    # Functions shadow external commands.
+    ex.funcs['sh'] = node
+    self.assertEqual(None, ex._ExternalThunk(node))
+
+
+class ProfileTest(unittest.TestCase):
+
+  def testPipelineAndCommandSub(self):
+    arena = test_lib.MakeArena('<cmd_exec_test.py>')
+    f = cStringIO.StringIO()
+    ex = InitExecutor(arena, profiler=dev.CommandProfiler(f, arena))
+    state.SetGlobalString(ex.mem, 'PATH', '/bin')
+
+    c_parser = InitCommandParser('ls / | /bin/true; x=$(/bin/echo hi)',
+                                 arena=arena)
+    node = c_parser.ParseLogicalLine()
+    ex.ExecuteAndCatch(node)
+    self.assertEqual('hi', ex.mem.GetVar('x').s)
+
+    rows = list(csv.reader(cStringIO.StringIO(f.getvalue())))
+    self.assertEqual(dev.PROFILE_COLUMNS, rows[0])
+    rows = [dict(zip(rows[0], row)) for row in rows[1:]]
+    self.assertEqual(4, len(rows), rows)
+
+    # Both stages are recorded, and finish before the pipeline.
+    stages = sorted((row['kind'], row['name']) for row in rows[:2])
+    self.assertEqual([('external', '/bin/true'), ('external', 'ls')], stages)
+    self.assertEqual(('pipeline', ''), (rows[2]['kind'], rows[2]['name']))
+    self.assertEqual(rows[2]['span_id'],
+                     [row for row in rows[:2] if row['name'] == 'ls'][0]
+                     ['span_id'])
+
+    # The command sub runs in a child process too.
+    self.assertEqual(('external', '/bin/echo'),
+                     (rows[3]['kind'], rows[3]['name']))
+    self.assertEqual('1', rows[3]['line_num'])
+
+    # A command sub that isn't a single command forks a shell.
+    c_parser = InitCommandParser('ls | wc -l', arena=arena)
+    node = c_parser.ParseLogicalLine()
+    p = ex._MakeProcess(node, kind='command-sub')
+    self.assertEqual(('command-sub', ''), p.profile_desc[:2])
+
+
+class CommandSubTest(unittest.TestCase):
+
+  def testReadAllStripped(self):
+    big = 'x' * (cmd_exec._FIRST_READ_SIZE * 3 + 1)
+    for contents, expected in [
+        ('', ''), ('\n\n', ''), ('a\nb\n\n', 'a\nb'), (big + '\n', big)]:
+      f = os.tmpfile()
+      f.write(contents)
+      f.flush()
+      f.seek(0)
+      self.assertEqual(expected, cmd_exec._ReadAllStripped(f.fileno()))
+      f.close()
+
+
+class CaseTest(unittest.TestCase):
+
+  def _Run(self, code_str):
+    arena = test_lib.MakeArena('<cmd_exec_test.py>')
+    ex = InitExecutor(arena)
+    c_parser = InitCommandParser(code_str, arena=arena)
+    node = c_parser.ParseLogicalLine()
+    ex.Execute(node)
+    return ex, node
+
+  def testCompileCase(self):
+    ex, node = self._Run(
+        'case $x in --foo|"-f") ;; --bar*) ;; $y) ;; *) ;; esac')
+    literals, patterns = ex._CompileCase(node)
+    self.assertEqual({'--foo': (0, 0), '-f': (1, 0)}, literals)
+    self.assertEqual([2, 3, 4], [pos for pos, _, _, _ in patterns])
+    self.assertEqual([1, 2, 3], [i for _, _, _, i in patterns])
+    # $y is evaluated every time.
+    self.assertEqual(None, patterns[1][2])
+
+  def testArmOrder(self):
+    # An earlier glob arm wins over a later literal arm.
+    ex, _ = self._Run(
+        'x=--foo; case $x in --f*) r=glob ;; --foo) r=lit ;; esac')
+    self.assertEqual('glob', ex.mem.GetVar('r').s)
+
+    ex, _ = self._Run(
+        'x=-f; y=-f; case $x in $y) r=dynamic ;; -f) r=lit ;; esac')
+    self.assertEqual('dynamic', ex.mem.GetVar('r').s)
+
+    ex, _ = self._Run(
+        'x=-f; case $x in -f) r=lit ;; *) r=star ;; esac')
+    self.assertEqual('lit', ex.mem.GetVar('r').s)
+
+    ex, _ = self._Run(
+        'x="*"; case $x in "*") r=quoted ;; *) r=star ;; esac')
+    self.assertEqual('quoted', ex.mem.GetVar('r').s)
+
+    ex, _ = self._Run('x=z; r=; case $x in a) r=a ;; esac')
+    self.assertEqual('', ex.mem.GetVar('r').s)
+    self.assertEqual(1, len(ex.case_cache))
+
+
 if __name__ == '__main__':
   unittest.main()
@@ -4,7 +4,9 @@ dev.py - Devtools / introspection.
 """
 from __future__ import print_function
 
+import csv
 import os
+import time
 
 from asdl import const
 from core import util
@@ -14,10 +16,127 @@ from core import word
 
 
 class DevTools(object):
-  def __init__(self, dumper, debug_f, trace_f):
+  def __init__(self, dumper, debug_f, trace_f, profiler=None):
     self.dumper = dumper
     self.debug_f = debug_f
     self.trace_f = trace_f
+    self.profiler = profiler  # CommandProfiler or None
+
+
+class _ProfileRecord(object):
+  """The resources used by one command, while it's running."""
+
+  def __init__(self, kind, name, span_id):
+    self.kind = kind
+    self.name = name
+    self.span_id = span_id
+    self.start_time = time.time()
+    self.user_secs = 0.0
+    self.sys_secs = 0.0
+    self.max_rss_kb = 0
+
+  def AddRusage(self, rusage):
+    self.user_secs += rusage.ru_utime
+    self.sys_secs += rusage.ru_stime
+    self.max_rss_kb = max(self.max_rss_kb, rusage.ru_maxrss)
+
+
+class CommandProfiler(object):
+  """Records the time and memory used by commands, for --profile-commands.
+
+  Every child process, pipeline, and function call is a row in a CSV file.
+  Child processes are external commands, pipeline stages, subshells, and
+  command and process subs.  Their user/sys time and max RSS come from the
+  rusage that wait4() returns for that PID.  A function call or pipeline
+  includes all the processes that were reaped while it was running.  Rows are
+  written when each command finishes, so inner commands come before outer
+  ones.
+
+  Only commands run by the main shell process are recorded.  Forked children
+  inherit the profiler, but they unwind through Stop() when they exit.
+
+  benchmarks/report.R command-profile aggregates the rows by location.
+  """
+
+  def __init__(self, f, arena):
+    """
+    Args:
+      f: file to write CSV rows to
+      arena: for turning span IDs into file names and line numbers
+    """
+    self.f = f
+    self.writer = csv.writer(f)
+    self.arena = arena
+    self.stack = []  # functions and pipelines that are running
+    self.procs = {}  # pid -> record for a child process that is running
+    self.pid = os.getpid()
+
+    self.writer.writerow(PROFILE_COLUMNS)
+    self.f.flush()  # see _WriteRow()
+
+  def Start(self, kind, name, span_id):
+    """
+    Args:
+      kind: 'pipeline' or 'function'
+      name: e.g. the function name
+      span_id: location of the command
+    """
+    if os.getpid() != self.pid:
+      return
+    self.stack.append(_ProfileRecord(kind, name, span_id))
+
+  def StartProcess(self, pid, kind, name, span_id):
+    """Called by process.Process when it starts a child.
+
+    Args:
+      pid: the child's PID
+      kind: 'external', 'subshell', 'command-sub', or 'process-sub'
+      name: the command name for an external command, or ''
+      span_id: location of the command
+    """
+    if os.getpid() != self.pid:
+      return
+    self.procs[pid] = _ProfileRecord(kind, name, span_id)
+
+  def OnReap(self, pid, rusage):
+    """Called by process.Waiter for every child it reaps."""
+    if os.getpid() != self.pid:
+      return
+    for rec in self.stack:
+      rec.AddRusage(rusage)
+    rec = self.procs.pop(pid, None)
+    if rec:
+      rec.AddRusage(rusage)
+      self._WriteRow(rec)
+
+  def Stop(self):
+    if os.getpid() != self.pid:
+      return
+    self._WriteRow(self.stack.pop())
+
+  def _WriteRow(self, rec):
+    wall_secs = time.time() - rec.start_time
+
+    if rec.span_id == const.NO_INTEGER:
+      path, line_num = '', -1
+    else:
+      span = self.arena.GetLineSpan(rec.span_id)
+      path, line_num = self.arena.GetDebugInfo(span.line_id)
+
+    self.writer.writerow([
+        rec.kind, rec.name, rec.span_id, path, line_num,
+        '%.6f' % wall_secs, '%.6f' % rec.user_secs, '%.6f' % rec.sys_secs,
+        rec.max_rss_kb])
+    # Flush so that forked children don't inherit unwritten rows.
+    self.f.flush()
+
+  def Close(self):
+    self.f.close()
+
+
+PROFILE_COLUMNS = [
+    'kind', 'name', 'span_id', 'path', 'line_num', 'wall_secs', 'user_secs',
+    'sys_secs', 'max_rss_kb']
 
 
 def SpanIdFromError(error):
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""
+dev_test.py: Tests for dev.py
+"""
+
+import cStringIO
+import csv
+import os
+import unittest
+
+from asdl import const
+from core import alloc
+from osh.meta import ast
+
+from core import dev  # module under test
+
+
+class _FakeRusage(object):
+  def __init__(self, utime, stime, maxrss):
+    self.ru_utime = utime
+    self.ru_stime = stime
+    self.ru_maxrss = maxrss
+
+
+class CommandProfilerTest(unittest.TestCase):
+
+  def testProfiler(self):
+    arena = alloc.Pool().NewArena()
+    arena.PushSource('foo.sh')
+    line_id = arena.AddLine('f | ls', 3)
+    span_id = arena.AddLineSpan(ast.line_span(line_id, 0, 1))
+    arena.PopSource()
+
+    f = cStringIO.StringIO()
+    profiler = dev.CommandProfiler(f, arena)
+
+    profiler.Start('function', 'f', span_id)
+    profiler.StartProcess(100, 'external', 'ls', span_id)
+    profiler.StartProcess(101, 'external', 'wc', span_id)
+    profiler.OnReap(100, _FakeRusage(0.5, 0.25, 1000))
+    profiler.OnReap(101, _FakeRusage(1.0, 0.0, 500))
+    profiler.OnReap(102, _FakeRusage(2.0, 0.0, 100))  # not started here
+    profiler.Stop()
+
+    profiler.Start('pipeline', '', const.NO_INTEGER)
+    profiler.Stop()
+
+    rows = list(csv.reader(cStringIO.StringIO(f.getvalue())))
+    self.assertEqual(dev.PROFILE_COLUMNS, rows[0])
+    self.assertEqual(5, len(rows))
+
+    ls_row = dict(zip(rows[0], rows[1]))
+    self.assertEqual('ls', ls_row['name'])
+    self.assertEqual('foo.sh', ls_row['path'])
+    self.assertEqual('3', ls_row['line_num'])
+    self.assertEqual(0.5, float(ls_row['user_secs']))
+    self.assertEqual('1000', ls_row['max_rss_kb'])
+
+    # Each process only gets its own rusage.
+    wc_row = dict(zip(rows[0], rows[2]))
+    self.assertEqual('wc', wc_row['name'])
+    self.assertEqual(1.0, float(wc_row['user_secs']))
+    self.assertEqual(0.0, float(wc_row['sys_secs']))
+    self.assertEqual('500', wc_row['max_rss_kb'])
+
+    # The function includes every child reaped while it was running.
+    f_row = dict(zip(rows[0], rows[3]))
+    self.assertEqual('f', f_row['name'])
+    self.assertEqual(3.5, float(f_row['user_secs']))
+    self.assertEqual(0.25, float(f_row['sys_secs']))
+    self.assertEqual('1000', f_row['max_rss_kb'])
+
+    pipeline_row = dict(zip(rows[0], rows[4]))
+    self.assertEqual('', pipeline_row['path'])
+    self.assertEqual('-1', pipeline_row['line_num'])
+
+  def testForkedChild(self):
+    arena = alloc.Pool().NewArena()
+    f = os.tmpfile()
+    dev.CommandProfiler(f, arena)
+
+    # A forked child flushes what it inherited when it exits.
+    pid = os.fork()
+    if pid == 0:
+      f.flush()
+      os._exit(0)
+    os.waitpid(pid, 0)
+
+    f.seek(0)
+    rows = list(csv.reader(f))
+    self.assertEqual([dev.PROFILE_COLUMNS], rows)
+
+
+if __name__ == '__main__':
+  unittest.main()
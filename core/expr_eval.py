@@ -9,6 +9,7 @@
 expr_eval.py -- Currently used for boolean and arithmetic expressions.
 """
 
+import operator
 import os
 import stat
 
@@ -19,6 +20,7 @@ except ImportError:
 
 from asdl import const
 from core import dev
+from core import libstr
 from core import util
 from core import state
 from core import ui
@@ -224,8 +226,64 @@ def EvalLhsAndLookup(node, arith_ev, mem, exec_opts):
   return val, lval
 
 
+# Binary operators that don't short-circuit or need error handling.
+# NOTE: Division by zero is handled in the evaluator.
+_BINARY_OPS = {
+    Id.Arith_Comma: lambda lhs, rhs: rhs,
+
+    Id.Arith_Plus: operator.add,
+    Id.Arith_Minus: operator.sub,
+    Id.Arith_Star: operator.mul,
+    Id.Arith_Percent: operator.mod,
+
+    Id.Arith_DEqual: lambda lhs, rhs: int(lhs == rhs),
+    Id.Arith_NEqual: lambda lhs, rhs: int(lhs != rhs),
+    Id.Arith_Great: lambda lhs, rhs: int(lhs > rhs),
+    Id.Arith_GreatEqual: lambda lhs, rhs: int(lhs >= rhs),
+    Id.Arith_Less: lambda lhs, rhs: int(lhs < rhs),
+    Id.Arith_LessEqual: lambda lhs, rhs: int(lhs <= rhs),
+
+    Id.Arith_Pipe: operator.or_,
+    Id.Arith_Amp: operator.and_,
+    Id.Arith_Caret: operator.xor,
+
+    # Note: how to define shift of negative numbers?
+    Id.Arith_DLess: operator.lshift,
+    Id.Arith_DGreat: operator.rshift,
+}
+
+# Compound assignment operators, except for /=.
+_ASSIGN_OPS = {
+    Id.Arith_PlusEqual: operator.add,
+    Id.Arith_MinusEqual: operator.sub,
+    Id.Arith_StarEqual: operator.mul,
+    Id.Arith_PercentEqual: operator.mod,
+
+    Id.Arith_DGreatEqual: operator.rshift,
+    Id.Arith_DLessEqual: operator.lshift,
+    Id.Arith_AmpEqual: operator.and_,
+    Id.Arith_PipeEqual: operator.or_,
+    Id.Arith_CaretEqual: operator.xor,
+}
+
+
 class ArithEvaluator(_ExprEvaluator):
 
+  def __init__(self, mem, exec_opts, word_ev, arena):
+    _ExprEvaluator.__init__(self, mem, exec_opts, word_ev, arena)
+
+    # arith_expr_e tag -> method.  This avoids a long if/elif chain in Eval().
+    self.dispatch_table = {
+        arith_expr_e.ArithVarRef: self._EvalArithVarRef,
+        arith_expr_e.ArithWord: self._EvalArithWord,
+        arith_expr_e.UnaryAssign: self._EvalUnaryAssign,
+        arith_expr_e.BinaryAssign: self._EvalBinaryAssign,
+        arith_expr_e.ArithUnary: self._EvalArithUnary,
+        arith_expr_e.ArithBinary: self._EvalArithBinary,
+        arith_expr_e.TernaryOp: self._EvalTernaryOp,
+        arith_expr_e.FuncCall: self._EvalFuncCall,
+    }
+
   def _ValToArith(self, val, span_id, int_coerce=True):
     """Convert runtime.value to a Python int or list of strings."""
     assert isinstance(val, runtime.value), '%r %r' % (val, type(val))
@@ -346,213 +404,172 @@ class ArithEvaluator(_ExprEvaluator):
     # OSH semantics: Variable NAMES cannot be formed dynamically; but INTEGERS
     # can.  ${foo:-3}4 is OK.  $? will be a compound word too, so we don't have
     # to handle that as a special case.
+    method = self.dispatch_table.get(node.tag)
+    if method is None:
+      raise NotImplementedError(node.__class__.__name__)
+    return method(node, int_coerce)
+
+  def _EvalArithVarRef(self, node, int_coerce):  # $(( x ))  (can be array)
+    tok = node.token
+    val = self._LookupVar(tok.val)
+    return self._ValToArithOrError(val, int_coerce=int_coerce,
+                                   span_id=tok.span_id)
+
+  def _EvalArithWord(self, node, int_coerce):
+    # $(( $x )) $(( ${x}${y} )), etc.
+    val = self.word_ev.EvalWordToString(node.w)
+    return self._ValToArithOrError(val, int_coerce=int_coerce, blame_word=node.w)
+
+  def _EvalUnaryAssign(self, node, int_coerce):  # a++
+    op_id = node.op_id
+    old_int, lval = self._EvalLhsAndLookupArith(node.child)
+
+    if op_id == Id.Node_PostDPlus:  # post-increment
+      new_int = old_int + 1
+      ret = old_int
+
+    elif op_id == Id.Node_PostDMinus:  # post-decrement
+      new_int = old_int - 1
+      ret = old_int
+
+    elif op_id == Id.Arith_DPlus:  # pre-increment
+      new_int = old_int + 1
+      ret = new_int
+
+    elif op_id == Id.Arith_DMinus:  # pre-decrement
+      new_int = old_int - 1
+      ret = new_int
 
-    if node.tag == arith_expr_e.ArithVarRef:  # $(( x ))  (can be array)
-      tok = node.token
-      val = self._LookupVar(tok.val)
-      return self._ValToArithOrError(val, int_coerce=int_coerce,
-                                     span_id=tok.span_id)
-
-    if node.tag == arith_expr_e.ArithWord:  # $(( $x )) $(( ${x}${y} )), etc.
-      val = self.word_ev.EvalWordToString(node.w)
-      return self._ValToArithOrError(val, int_coerce=int_coerce, blame_word=node.w)
-
-    if node.tag == arith_expr_e.UnaryAssign:  # a++
-      op_id = node.op_id
-      old_int, lval = self._EvalLhsAndLookupArith(node.child)
-
-      if op_id == Id.Node_PostDPlus:  # post-increment
-        new_int = old_int + 1
-        ret = old_int
+    else:
+      raise NotImplementedError(op_id)
 
-      elif op_id == Id.Node_PostDMinus:  # post-decrement
-        new_int = old_int - 1
-        ret = old_int
+    #log('old %d new %d ret %d', old_int, new_int, ret)
+    self._Store(lval, new_int)
+    return ret
 
-      elif op_id == Id.Arith_DPlus:  # pre-increment
-        new_int = old_int + 1
-        ret = new_int
+  def _EvalBinaryAssign(self, node, int_coerce):  # a=1, a+=5, a[1]+=5
+    op_id = node.op_id
 
-      elif op_id == Id.Arith_DMinus:  # pre-decrement
-        new_int = old_int - 1
-        ret = new_int
+    if op_id == Id.Arith_Equal:
+      rhs = self.Eval(node.right)
+      lval = self._EvalLhsArith(node.left)
+      self._Store(lval, rhs)
+      return rhs
 
-      else:
-        raise NotImplementedError(op_id)
+    old_int, lval = self._EvalLhsAndLookupArith(node.left)
+    rhs = self.Eval(node.right)
 
-      #log('old %d new %d ret %d', old_int, new_int, ret)
-      self._Store(lval, new_int)
-      return ret
+    if op_id == Id.Arith_SlashEqual:
+      try:
+        new_int = old_int / rhs
+      except ZeroDivisionError:
+        # TODO: location
+        e_die('Divide by zero')
+    else:
+      try:
+        func = _ASSIGN_OPS[op_id]
+      except KeyError:
+        raise AssertionError(op_id)  # shouldn't get here
+      new_int = func(old_int, rhs)
 
-    if node.tag == arith_expr_e.BinaryAssign:  # a=1, a+=5, a[1]+=5
-      op_id = node.op_id
+    self._Store(lval, new_int)
+    return new_int
 
-      if op_id == Id.Arith_Equal:
-        rhs = self.Eval(node.right)
-        lval = self._EvalLhsArith(node.left)
-        self._Store(lval, rhs)
-        return rhs
+  def _EvalArithUnary(self, node, int_coerce):
+    op_id = node.op_id
 
-      old_int, lval = self._EvalLhsAndLookupArith(node.left)
-      rhs = self.Eval(node.right)
+    if op_id == Id.Node_UnaryPlus:
+      return self.Eval(node.child)
+    if op_id == Id.Node_UnaryMinus:
+      return -self.Eval(node.child)
 
-      if op_id == Id.Arith_PlusEqual:
-        new_int = old_int + rhs
-      elif op_id == Id.Arith_MinusEqual:
-        new_int = old_int - rhs
-      elif op_id == Id.Arith_StarEqual:
-        new_int = old_int * rhs
-      elif op_id == Id.Arith_SlashEqual:
-        try:
-          new_int = old_int / rhs
-        except ZeroDivisionError:
-          # TODO: location
-          e_die('Divide by zero')
-      elif op_id == Id.Arith_PercentEqual:
-        new_int = old_int % rhs
-
-      elif op_id == Id.Arith_DGreatEqual:
-        new_int = old_int >> rhs
-      elif op_id == Id.Arith_DLessEqual:
-        new_int = old_int << rhs
-      elif op_id == Id.Arith_AmpEqual:
-        new_int = old_int & rhs
-      elif op_id == Id.Arith_PipeEqual:
-        new_int = old_int | rhs
-      elif op_id == Id.Arith_CaretEqual:
-        new_int = old_int ^ rhs
-      else:
-        raise AssertionError(op_id)  # shouldn't get here
+    if op_id == Id.Arith_Bang:  # logical negation
+      return int(not self.Eval(node.child))
+    if op_id == Id.Arith_Tilde:  # bitwise complement
+      return ~self.Eval(node.child)
 
-      self._Store(lval, new_int)
-      return new_int
+    raise NotImplementedError(op_id)
 
-    if node.tag == arith_expr_e.ArithUnary:
-      op_id = node.op_id
+  def _EvalArithBinary(self, node, int_coerce):
+    op_id = node.op_id
 
-      if op_id == Id.Node_UnaryPlus:
-        return self.Eval(node.child)
-      if op_id == Id.Node_UnaryMinus:
-        return -self.Eval(node.child)
+    lhs = self.Eval(node.left)
 
-      if op_id == Id.Arith_Bang:  # logical negation
-        return int(not self.Eval(node.child))
-      if op_id == Id.Arith_Tilde:  # bitwise complement
-        return ~self.Eval(node.child)
+    # Short-circuit evaluation for || and &&.
+    if op_id == Id.Arith_DPipe:
+      if lhs == 0:
+        rhs = self.Eval(node.right)
+        return int(rhs != 0)
+      else:
+        return 1  # true
+    if op_id == Id.Arith_DAmp:
+      if lhs == 0:
+        return 0  # false
+      else:
+        rhs = self.Eval(node.right)
+        return int(rhs != 0)
 
-      raise NotImplementedError(op_id)
+    rhs = self.Eval(node.right)  # eager evaluation for the rest
 
-    if node.tag == arith_expr_e.ArithBinary:
-      op_id = node.op_id
+    # Most operators are a single Python operation.
+    func = _BINARY_OPS.get(op_id)
+    if func is not None:
+      return func(lhs, rhs)
 
-      lhs = self.Eval(node.left)
+    if op_id == Id.Arith_LBracket:
+      if not isinstance(lhs, list):
+        # TODO: Add error context
+        e_die('Expected array in index expression, got %s', lhs)
 
-      # Short-circuit evaluation for || and &&.
-      if op_id == Id.Arith_DPipe:
-        if lhs == 0:
-          rhs = self.Eval(node.right)
-          return int(rhs != 0)
-        else:
-          return 1  # true
-      if op_id == Id.Arith_DAmp:
-        if lhs == 0:
-          return 0  # false
+      try:
+        item = lhs[rhs]
+      except IndexError:
+        if self.exec_opts.nounset:
+          e_die('Index out of bounds')
         else:
-          rhs = self.Eval(node.right)
-          return int(rhs != 0)
-
-      rhs = self.Eval(node.right)  # eager evaluation for the rest
+          return 0  # If not fatal, return 0
 
-      if op_id == Id.Arith_LBracket:
-        if not isinstance(lhs, list):
-          # TODO: Add error context
-          e_die('Expected array in index expression, got %s', lhs)
+      assert isinstance(item, str), item
+      return self._StringToIntegerOrError(item)
 
-        try:
-          item = lhs[rhs]
-        except IndexError:
-          if self.exec_opts.nounset:
-            e_die('Index out of bounds')
-          else:
-            return 0  # If not fatal, return 0
-
-        assert isinstance(item, str), item
-        return self._StringToIntegerOrError(item)
-
-      if op_id == Id.Arith_Comma:
-        return rhs
-
-      if op_id == Id.Arith_Plus:
-        return lhs + rhs
-      if op_id == Id.Arith_Minus:
-        return lhs - rhs
-      if op_id == Id.Arith_Star:
-        return lhs * rhs
-      if op_id == Id.Arith_Slash:
-        try:
-          return lhs / rhs
-        except ZeroDivisionError:
-          # TODO: _ErrorWithLocation should also accept arith_expr ?  I
-          # think I needed that for other stuff.
-          # Or I could blame the '/' token, instead of op_id.
-          error_expr = node.right  # node is ArithBinary
-          if error_expr.tag == arith_expr_e.ArithVarRef:
-            # TODO: ArithVarRef should store a token instead of a string!
-            e_die('Divide by zero (name)')
-          elif error_expr.tag == arith_expr_e.ArithWord:
-            e_die('Divide by zero', word=node.right.w)
-          else:
-            e_die('Divide by zero')
-      if op_id == Id.Arith_Percent:
-
-        return lhs % rhs
-      if op_id == Id.Arith_DStar:
-        # OVM is stripped of certain functions that are somehow necessary for
-        # exponentiation.
-        # Python/ovm_stub_pystrtod.c:21: PyOS_double_to_string: Assertion `0'
-        # failed.
-        if rhs < 0:
-          e_die("Exponent can't be less than zero")  # TODO: error location
-        result = 1
-        for i in xrange(rhs):
-          result *= lhs
-        return result
-
-      if op_id == Id.Arith_DEqual:
-        return int(lhs == rhs)
-      if op_id == Id.Arith_NEqual:
-        return int(lhs != rhs)
-      if op_id == Id.Arith_Great:
-        return int(lhs > rhs)
-      if op_id == Id.Arith_GreatEqual:
-        return int(lhs >= rhs)
-      if op_id == Id.Arith_Less:
-        return int(lhs < rhs)
-      if op_id == Id.Arith_LessEqual:
-        return int(lhs <= rhs)
-
-      if op_id == Id.Arith_Pipe:
-        return lhs | rhs
-      if op_id == Id.Arith_Amp:
-        return lhs & rhs
-      if op_id == Id.Arith_Caret:
-        return lhs ^ rhs
-
-      # Note: how to define shift of negative numbers?
-      if op_id == Id.Arith_DLess:
-        return lhs << rhs
-      if op_id == Id.Arith_DGreat:
-        return lhs >> rhs
-
-      raise NotImplementedError(op_id)
+    if op_id == Id.Arith_Slash:
+      try:
+        return lhs / rhs
+      except ZeroDivisionError:
+        # TODO: _ErrorWithLocation should also accept arith_expr ?  I
+        # think I needed that for other stuff.
+        # Or I could blame the '/' token, instead of op_id.
+        error_expr = node.right  # node is ArithBinary
+        if error_expr.tag == arith_expr_e.ArithVarRef:
+          # TODO: ArithVarRef should store a token instead of a string!
+          e_die('Divide by zero (name)')
+        elif error_expr.tag == arith_expr_e.ArithWord:
+          e_die('Divide by zero', word=node.right.w)
+        else:
+          e_die('Divide by zero')
 
-    if node.tag == arith_expr_e.TernaryOp:
-      cond = self.Eval(node.cond)
-      if cond:  # nonzero
-        return self.Eval(node.true_expr)
-      else:
-        return self.Eval(node.false_expr)
+    if op_id == Id.Arith_DStar:
+      # OVM is stripped of certain functions that are somehow necessary for
+      # exponentiation.
+      # Python/ovm_stub_pystrtod.c:21: PyOS_double_to_string: Assertion `0'
+      # failed.
+      if rhs < 0:
+        e_die("Exponent can't be less than zero")  # TODO: error location
+      result = 1
+      for i in xrange(rhs):
+        result *= lhs
+      return result
+
+    raise NotImplementedError(op_id)
+
+  def _EvalTernaryOp(self, node, int_coerce):
+    cond = self.Eval(node.cond)
+    if cond:  # nonzero
+      return self.Eval(node.true_expr)
+    else:
+      return self.Eval(node.false_expr)
 
+  def _EvalFuncCall(self, node, int_coerce):
     raise NotImplementedError("Unhandled node %r" % node.__class__.__name__)
 
 
@@ -728,7 +745,7 @@ class BoolEvaluator(_ExprEvaluator):
         if op_id == Id.BoolBinary_EqualTilde:
           #log('Matching %r against regex %r', s1, s2)
           try:
-            matches = libc.regex_match(s2, s1)
+            matches = libstr.CompileRegex(s2, libstr.REGEX_ERE).match(s1)
           except RuntimeError:
             # 2 means a parse error.  Note this is a fatal error in OSH but not
             # in bash.
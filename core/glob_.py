@@ -3,11 +3,15 @@
 glob_.py
 """
 
+import os
+
 try:
   import libc
 except ImportError:
   from benchmarks import fake_libc as libc
 
+_HAVE_NATIVE_GLOB = hasattr(libc, 'glob_filter') and hasattr(libc, 'scandir')
+
 from osh.meta import ast, Id
 from osh import match
 from core import util
@@ -118,6 +122,84 @@ def _GlobUnescape(s):  # used by cmd_exec
   return unescaped
 
 
+def _SplitOnStars(pat):
+  """Split a glob pattern on unescaped *, unescaping the literal pieces.
+
+  Returns:
+    A list of strings, or None if the pattern has other glob syntax: ? [ or
+    anything fnmatch() might treat as an extended glob.
+
+  Examples:
+    'foo'    -> ['foo']
+    'foo*'   -> ['foo', '']
+    '*\*.py' -> ['', '*.py']
+  """
+  pieces = []
+  current = []
+  i = 0
+  n = len(pat)
+  while i < n:
+    c = pat[i]
+    if c == '\\':
+      if i == n - 1:  # Trailing backslash; let fnmatch() decide
+        return None
+      i += 1
+      current.append(pat[i])
+    elif c == '*':
+      pieces.append(''.join(current))
+      current = []
+    elif c in '?[(':
+      return None
+    else:
+      current.append(c)
+    i += 1
+  pieces.append(''.join(current))
+  return pieces
+
+
+def GlobToLiteral(pat):
+  """Return the string a pattern matches if it has no glob syntax, else None.
+
+  Used to turn constant case patterns into a dict lookup.
+  """
+  pieces = _SplitOnStars(pat)
+  if pieces is not None and len(pieces) == 1:
+    return pieces[0]
+  return None
+
+
+def CompileMatcher(pat):
+  """Return a function s -> bool that does the same thing as fnmatch(pat, s).
+
+  Common patterns like foo* *.py and *foo* are turned into string methods.
+  Everything else is passed to libc.fnmatch().  NOTE: Our fnmatch() doesn't
+  use FNM_PATHNAME or FNM_PERIOD, so * matches / and a leading dot.
+  """
+  pieces = _SplitOnStars(pat)
+  if pieces is None:
+    return lambda s: libc.fnmatch(pat, s)
+
+  if len(pieces) == 1:
+    lit = pieces[0]
+    return lambda s: s == lit
+
+  if len(pieces) == 2:
+    prefix, suffix = pieces
+    if not prefix:
+      return lambda s: s.endswith(suffix)
+    if not suffix:
+      return lambda s: s.startswith(prefix)
+    min_len = len(prefix) + len(suffix)  # they can't overlap
+    return lambda s: (len(s) >= min_len and s.startswith(prefix) and
+                      s.endswith(suffix))
+
+  if len(pieces) == 3 and not pieces[0] and not pieces[2]:
+    middle = pieces[1]
+    return lambda s: middle in s
+
+  return lambda s: libc.fnmatch(pat, s)
+
+
 # For ${x//foo*/y}, we need to glob patterns, but fnmatch doesn't give you the
 # positions of matches.  So we convert globs to regexps.
 
@@ -171,6 +253,10 @@ class _GlobParser(object):
 
       if balance == 0:
         break
+      # A backslash quotes the next char in a glob char class, but in a regex
+      # char class it's literal.  e.g. [\]] vs. []].
+      if self.token_type in (Id.Glob_EscapedChar, Id.Glob_BadBackslash):
+        self.warnings.append('Got backslash in character class')
       tokens.append((self.token_type, self.token_val))  # Don't append the last ]
 
     negated = False
@@ -240,7 +326,7 @@ def _GenerateERE(parts):
       elif part.id == Id.Glob_CleanLiterals:
         out.append(part.s)  # e.g. 'py' doesn't need to be escaped
 
-      elif part.id == Id.Glob_OtherLiteral:
+      else:  # Glob_{OtherLiteral,Bang,Caret,RBracket,BadBackslash}
         assert len(part.s) == 1, part.s
         c = part.s
         if c in _REGEX_CHARS_TO_ESCAPE:
@@ -294,6 +380,27 @@ def GlobToERE(pat):
   return regex, warnings
 
 
+def _DirPrefix(dir_path):
+  """Return what to prepend to names in a directory, the way glob(3) does.
+
+  There's no ./ prefix for the current directory.
+  """
+  if not dir_path or dir_path.endswith('/'):
+    return dir_path
+  return dir_path + '/'
+
+
+def _AppendLiteral(dirs, name, check_exists):
+  """Yield paths for a component without glob syntax.
+
+  There's no listing to match against, so only the last component is checked.
+  """
+  for d in dirs:
+    path = _DirPrefix(d) + name
+    if not check_exists or os.path.lexists(path):
+      yield path
+
+
 class Globber(object):
   def __init__(self, exec_opts):
     self.exec_opts = exec_opts
@@ -302,9 +409,7 @@ class Globber(object):
     # do.  Could a default GLOBIGNORE to ignore flags on the file system be
     # part of the security solution?  It doesn't seem totally sound.
 
-    # shopt: why the difference?  No command line switch I guess.
-    self.dotglob = False  # dotfiles are matched
-    self.globstar = False  # ** for directories
+    # shopt -s dotglob and globstar are in exec_opts.
     # globasciiranges - ascii or unicode char classes (unicode by default)
     # nocaseglob
     # extglob: the !() syntax
@@ -312,6 +417,155 @@ class Globber(object):
     # TODO: Figure out which ones are in other shells, and only support those?
     # - Include globstar since I use it, and zsh has it.
 
+    # Directory path -> (names, subdirs) from libc.scandir().  It lives for
+    # one command evaluation, so 'cp src/*.c src/*.h dest/' reads src/ once.
+    # See ClearCache().
+    self.listings = {}
+
+  def ClearCache(self):
+    """Forget directory listings.
+
+    Called at the start of each command's word evaluation, and after anything
+    that can modify the file system in the middle of it, like $(touch foo).
+    """
+    self.listings.clear()
+
+  def _Scan(self, dir_path):
+    """Return the sorted (names, subdirs) of a directory."""
+    entry = self.listings.get(dir_path)
+    if entry is None:
+      try:
+        names, subdirs = libc.scandir(dir_path or '.')
+      except OSError:  # not a directory, permission denied, etc.
+        entry = [], []
+      else:
+        # glob(3) matches these too, e.g. .* expands to . and ..
+        names.append('.')
+        names.append('..')
+        names.sort()  # so results from a single directory are sorted
+        subdirs.sort()
+        entry = names, subdirs
+      self.listings[dir_path] = entry
+    return entry
+
+  def _MatchNames(self, dirs, comp, dotglob):
+    """Yield the paths in each directory whose names match a component."""
+    for d in dirs:
+      prefix = _DirPrefix(d)
+      names, _ = self._Scan(d)
+      for name in libc.glob_filter(comp, names, dotglob):
+        yield prefix + name
+
+  def _WalkDirs(self, dirs, dotglob):
+    """Yield each directory followed by the ones under it, recursively.
+
+    This is what ** matches when globstar is on.  Like bash, we don't follow
+    symlinks, and we skip hidden directories unless dotglob is on.
+    """
+    for top in dirs:
+      stack = [top]
+      while stack:
+        d = stack.pop()
+        yield d
+        _, subdirs = self._Scan(d)
+        prefix = _DirPrefix(d)
+        for name in reversed(subdirs):  # so we pop them in order
+          if dotglob or not name.startswith('.'):
+            stack.append(prefix + name)
+
+  def _WalkAll(self, dirs, dotglob):
+    """Yield everything under each directory, for a trailing **.
+
+    Like bash, a/** includes a/ itself, but ** doesn't include the current
+    directory.
+    """
+    for top in dirs:
+      names, _ = self._Scan(top)
+      if not names:  # not a directory
+        continue
+      if top:
+        yield _DirPrefix(top)
+      for path in self._MatchNames(self._WalkDirs([top], dotglob), '*',
+                                   dotglob):
+        yield path
+
+  def _Glob(self, pat):
+    """Do what libc.glob() does, but with cached directory listings.
+
+    Each path component with glob syntax is matched against the listing of its
+    parent with libc.glob_filter().  Literal components are just appended, and
+    checked for existence if they're last.  With globstar, a ** component
+    walks the tree under the directories matched so far.
+
+    Each step is a generator over the paths from the previous one, so we never
+    build a list of every directory in a tree.
+
+    Returns:
+      A sorted list of paths, or None if the pattern has syntax we don't
+      handle, in which case the caller should use libc.glob().
+    """
+    if not _HAVE_NATIVE_GLOB:
+      return None
+    if '//' in pat:
+      return None
+
+    # A trailing / only matches directories.
+    only_dirs = pat.endswith('/')
+    if only_dirs:
+      pat = pat.rstrip('/')
+      if not pat:
+        return None
+
+    components = pat.split('/')
+    if components[0]:
+      paths = ['']
+    else:  # absolute path
+      paths = ['/']
+      components = components[1:]
+
+    for comp in components:
+      if '[' in comp and not LooksLikeGlob(comp):
+        return None  # e.g. [/], which glob(3) treats differently
+
+    dotglob = self.exec_opts.dotglob
+    globstar = self.exec_opts.globstar
+
+    last = len(components) - 1
+    needs_sort = False
+    seen_glob = False
+    for i, comp in enumerate(components):
+      if seen_glob:
+        needs_sort = True  # e.g. */x gives a-b/x before a/x
+
+      if globstar and comp == '**':
+        if i != last and components[i+1] == '**':
+          continue  # **/** is the same as **
+        if i == last:
+          paths = self._WalkAll(paths, dotglob)
+        else:
+          paths = self._WalkDirs(paths, dotglob)
+        seen_glob = True
+        needs_sort = True
+
+      elif LooksLikeGlob(comp):
+        paths = self._MatchNames(paths, comp, dotglob)
+        seen_glob = True
+
+      else:
+        paths = _AppendLiteral(paths, _GlobUnescape(comp), i == last)
+
+    if only_dirs:
+      paths = [_DirPrefix(p) for p in paths if os.path.isdir(p)]
+      needs_sort = True  # a-b/ comes before a/
+    else:
+      paths = list(paths)
+
+    # glob(3) compares with strcmp(), since we don't call setlocale().  Listings
+    # are sorted, so we usually don't need to sort again.
+    if needs_sort:
+      paths.sort()
+    return paths
+
   def Expand(self, arg):
     """Given a string that could be a glob, return a list of strings."""
     # e.g. don't glob 'echo' because it doesn't look like a glob
@@ -321,16 +575,18 @@ class Globber(object):
     if self.exec_opts.noglob:
       return [arg]
 
-    try:
-      #g = glob.glob(arg)  # Bad Python glob
-      # PROBLEM: / is significant and can't be escaped!  Have to avoid
-      # globbing it.
-      g = libc.glob(arg)
-    except Exception as e:
-      # - [C\-D] is invalid in Python?  Regex compilation error.
-      # - [:punct:] not supported
-      print("Error expanding glob %r: %s" % (arg, e))
-      raise
+    g = self._Glob(arg)
+    if g is None:
+      try:
+        #g = glob.glob(arg)  # Bad Python glob
+        # PROBLEM: / is significant and can't be escaped!  Have to avoid
+        # globbing it.
+        g = libc.glob(arg)
+      except Exception as e:
+        # - [C\-D] is invalid in Python?  Regex compilation error.
+        # - [:punct:] not supported
+        print("Error expanding glob %r: %s" % (arg, e))
+        raise
     #log('glob %r -> %r', arg, g)
 
     if g:
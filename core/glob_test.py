@@ -4,9 +4,14 @@ glob_test.py: Tests for glob.py
 """
 from __future__ import print_function
 
+import os
 import re
+import shutil
+import tempfile
 import unittest
 
+import libc
+
 from core import glob_
 from osh import match
 
@@ -55,6 +60,32 @@ class GlobEscapeTest(unittest.TestCase):
       self.assertEqual(expected, glob_.LooksLikeGlob(pat),
                        '%s: expected %r' % (pat, expected))
 
+  def testGlobToLiteral(self):
+    self.assertEqual('foo', glob_.GlobToLiteral('foo'))
+    self.assertEqual('--foo', glob_.GlobToLiteral(r'\-\-foo'))
+    self.assertEqual('*.py', glob_.GlobToLiteral(r'\*.py'))
+    self.assertEqual(None, glob_.GlobToLiteral('*.py'))
+    self.assertEqual(None, glob_.GlobToLiteral('[ab]'))
+    self.assertEqual(None, glob_.GlobToLiteral('+(a|b)'))
+
+  def testCompileMatcher(self):
+    CASES = [
+        ('*', ['', 'x', '.x', 'a/b'], []),
+        ('foo*', ['foo', 'foobar'], ['fo', 'xfoo']),
+        ('*.py', ['.py', 'a.py'], ['a.pyc']),
+        ('*oo*', ['oo', 'foobar'], ['o']),
+        ('ab*ba', ['abba', 'ab-ba'], ['aba', 'abab']),
+        (r'\**', ['*', '*x'], ['x']),
+        ('a*b*c', ['abc', 'aXbYc'], ['acb']),
+        ('[ab]*', ['a', 'bz'], ['c']),
+    ]
+    for pat, matches, non_matches in CASES:
+      m = glob_.CompileMatcher(pat)
+      for s in matches:
+        self.assertEqual(True, bool(m(s)), '%r %r' % (pat, s))
+      for s in non_matches:
+        self.assertEqual(False, bool(m(s)), '%r %r' % (pat, s))
+
   def testGlobStripRegexes(self):
     s = 'aabbccdd'
 
@@ -158,5 +189,98 @@ class GlobParserTest(unittest.TestCase):
       print('warnings: %s' % warnings)
 
 
+class _ExecOpts(object):
+  noglob = False
+  failglob = False
+  nullglob = False
+  dotglob = False
+  globstar = False
+
+
+class GlobberTest(unittest.TestCase):
+
+  def setUp(self):
+    self.old_cwd = os.getcwd()
+    self.tmp_dir = tempfile.mkdtemp()
+    os.chdir(self.tmp_dir)
+    for d in ['src', 'src/sub', 'a', 'a-b', '.hidden', 'empty']:
+      os.mkdir(d)
+    for f in ['src/a.c', 'src/b.c', 'src/a.h', 'src/.d.c', 'src/sub/c.c',
+              'a/x', 'a-b/x', '.hidden/y', '.profile', 'Makefile', 'b*c', 'a[1]']:
+      open(f, 'w').close()
+    os.symlink('nonexistent', 'src/dangling')
+    os.symlink('src', 'link')
+
+  def tearDown(self):
+    os.chdir(self.old_cwd)
+    shutil.rmtree(self.tmp_dir)
+
+  def testSameAsLibcGlob(self):
+    g = glob_.Globber(_ExecOpts())
+    patterns = [
+        '*', '.*', '\\.*', '?akefile', '[.]*', '*/*', '*/*.c', 'src/*.[ch]',
+        'src/[!a]*', 'src/*/c.c', '*/sub/*', 'src/dang*', 'src/*ling',
+        '*/x', 'a\\-b/*', 'b\\*c', 'b*c', 'a\\[1\\]*', 'nonexistent/*',
+        './*', '.*/*', '*/.', '*/..', 'src/.?.c', self.tmp_dir + '/src/*.c',
+        '/*', '@(src|empty)', 'src/*.@(c|h)', '*/', 'src/*/', '**/*.c',
+    ]
+    for pat in patterns:
+      g.ClearCache()
+      self.assertEqual(libc.glob(pat), g._Glob(pat), pat)
+
+  def testCache(self):
+    g = glob_.Globber(_ExecOpts())
+    self.assertEqual(['src/a.c', 'src/b.c'], g.Expand('src/*.c'))
+    open('src/new.c', 'w').close()
+    # Still cached for the same command.
+    self.assertEqual(['src/a.c', 'src/b.c'], g.Expand('src/*.c'))
+    g.ClearCache()
+    self.assertEqual(['src/a.c', 'src/b.c', 'src/new.c'], g.Expand('src/*.c'))
+
+  def testFallback(self):
+    g = glob_.Globber(_ExecOpts())
+    self.assertEqual(None, g._Glob('src//*.c'))
+    self.assertEqual(None, g._Glob('a[/]'))
+    self.assertEqual(['src//a.c', 'src//b.c'], g.Expand('src//*.c'))
+
+  def testGlobStar(self):
+    exec_opts = _ExecOpts()
+    exec_opts.globstar = True
+    g = glob_.Globber(exec_opts)
+
+    self.assertEqual(
+        ['Makefile', 'a', 'a-b', 'a-b/x', 'a/x', 'a[1]', 'b*c', 'empty',
+         'link', 'src', 'src/a.c', 'src/a.h', 'src/b.c', 'src/dangling',
+         'src/sub', 'src/sub/c.c'],
+        g.Expand('**'))
+    # Symlinks to directories aren't followed.
+    self.assertEqual(['src/a.c', 'src/b.c', 'src/sub/c.c'],
+                     g.Expand('**/*.c'))
+    self.assertEqual(['src/a.c', 'src/b.c', 'src/sub/c.c'],
+                     g.Expand('src/**/**/*.c'))
+    self.assertEqual(['a-b/x', 'a/x'], g.Expand('**/x'))
+    self.assertEqual(['src/sub/c.c'], g.Expand('**/sub/*'))
+    self.assertEqual(['a-b/', 'a/', 'empty/', 'link/', 'src/', 'src/sub/'],
+                     g.Expand('**/'))
+    self.assertEqual(['link/sub/c.c'], g.Expand('link/**/c.c'))
+    self.assertEqual(['src/sub/', 'src/sub/c.c'], g.Expand('src/sub/**'))
+    self.assertEqual(['src/', 'src/sub/'], g.Expand('src/**/'))
+    self.assertEqual(['nonexistent/**'], g.Expand('nonexistent/**'))
+
+    exec_opts.dotglob = True
+    self.assertEqual(['src/.d.c', 'src/a.c', 'src/b.c', 'src/sub/c.c'],
+                     g.Expand('**/*.c'))
+    self.assertEqual(['.hidden/y'], g.Expand('**/y'))
+
+  def testDotGlob(self):
+    exec_opts = _ExecOpts()
+    exec_opts.dotglob = True
+    g = glob_.Globber(exec_opts)
+    self.assertEqual(['.profile', 'Makefile'], g.Expand('*fi*'))
+    self.assertEqual(['.hidden', '.profile', 'Makefile'], g.Expand('*')[:3])
+    self.assertEqual(['.', '..', '.hidden', '.profile'], g.Expand('.*'))
+    self.assertEqual(['src/.d.c', 'src/a.c', 'src/b.c'], g.Expand('src/*.c'))
+
+
 if __name__ == '__main__':
   unittest.main()
@@ -27,6 +27,11 @@ with SPLIT_REGEX = / digit+ / {
 }
 """
 
+try:
+  import libc
+except ImportError:
+  libc = None
+
 from osh.meta import runtime
 from core import util
 
@@ -40,6 +45,14 @@ ST = runtime.state_e
 
 log = util.log
 
+# libc.ifs_split() and libc.ifs_spans() implement IfsSplitter in C.  The
+# Python code below is the reference; see native/libc_test.py.
+# Not in fake_libc, or an old build of libc.so.
+_HAVE_NATIVE_SPLIT = hasattr(libc, 'ifs_split')
+
+# span kind from libc.ifs_spans() -> span_e
+_NATIVE_SPAN_KINDS = (span_e.Black, span_e.Delim, span_e.Backslash)
+
 
 DEFAULT_IFS = ' \t\n'
 
@@ -90,8 +103,24 @@ class SplitContext(object):
     # Split into (ifs_whitespace, ifs_other)
     self.splitters = {}  # IFS value -> splitter instance
 
+    # The splitter and join char for the current value of IFS, or None if it
+    # has to be looked up again.  Looking up IFS walks the whole stack, so Mem
+    # tells us when it may have changed.
+    self.cur_splitter = None
+    self.cur_join_char = None
+    mem.Watch('IFS', self._OnIfsChanged)
+
+  def _OnIfsChanged(self):
+    self.cur_splitter = None
+    self.cur_join_char = None
+
   def _GetSplitter(self):
     """Based on the current stack frame, get the splitter."""
+    if self.cur_splitter is None:
+      self.cur_splitter = self._LookupSplitter()
+    return self.cur_splitter
+
+  def _LookupSplitter(self):
     val = self.mem.GetVar('IFS')
     if val.tag == value_e.Undef:
       ifs = DEFAULT_IFS
@@ -136,6 +165,11 @@ class SplitContext(object):
     # by a <space> if IFS is unset. If IFS is set to a null string, this is
     # not equivalent to unsetting it; its first character does not exist, so
     # the parameter values are concatenated."
+    if self.cur_join_char is None:
+      self.cur_join_char = self._LookupJoinChar()
+    return self.cur_join_char
+
+  def _LookupJoinChar(self):
     val = self.mem.GetVar('IFS')
     if val.tag == value_e.Undef:
       return ''
@@ -150,6 +184,15 @@ class SplitContext(object):
     sp = self._GetSplitter()
     return sp.Escape(s)
 
+  def CanSplit(self, s):
+    """Whether SplitForWordEval() could change the unescaped string s."""
+    sp = self._GetSplitter()
+    # Search for each of the few IFS chars, rather than looping over s.
+    for c in sp.escape_chars:
+      if c in s:
+        return True
+    return False
+
   def SplitForWordEval(self, s):
     """Split the string into slices, some of which are marked ignored.
 
@@ -168,11 +211,12 @@ class SplitContext(object):
       Array of (ignored Bool, start_index Int) tuples.
     """
     sp = self._GetSplitter()
-    spans = sp.Split(s, True)
-    if 0:
-      for span in spans:
-        log('SPAN %s', span)
-    return _SpansToParts(s, spans)
+    return sp.SplitToParts(s, True)
+
+  def SplitPoint(self, s):
+    """Where the unescaped string s can be split in two; see IfsSplitter."""
+    sp = self._GetSplitter()
+    return sp.SplitPoint(s)
 
   def SplitForRead(self, line, allow_escape):
     sp = self._GetSplitter()
@@ -297,6 +341,41 @@ class IfsSplitter(_BaseSplitter):
     self.ifs_whitespace = ifs_whitespace
     self.ifs_other = ifs_other
 
+  def SplitToParts(self, s, allow_escape):
+    """Split a string into fields.
+
+    Returns:
+      List of strings, the same as _SpansToParts(s, self.Split(...))
+    """
+    if _HAVE_NATIVE_SPLIT:
+      return libc.ifs_split(s, self.ifs_whitespace, self.ifs_other,
+                            allow_escape)
+    return _SpansToParts(s, self.PySplit(s, allow_escape))
+
+  def SplitPoint(self, s):
+    """Find a place to cut s so its halves can be split separately.
+
+    This is for splitting the output of a command sub as it's read.  s is
+    split without backslash escapes, as in word evaluation.
+
+    Returns:
+      The last index i such that splitting s[:i] and s[i:] + t gives the same
+      fields as splitting s + t, for any string t that comes later.  Or 0 if
+      there isn't one.  It's after an IFS character that's followed by a
+      non-IFS character, or at the end if IFS is only whitespace.
+    """
+    ifs_chars = self.ifs_whitespace + self.ifs_other
+    if not ifs_chars or '\\' in ifs_chars:
+      return 0
+    if not self.ifs_other and s and s[-1] in ifs_chars:
+      return len(s)  # whitespace after it can't change the fields
+    i = len(s) - 1
+    while i > 0:
+      if s[i - 1] in ifs_chars and s[i] not in ifs_chars:
+        return i
+      i -= 1
+    return 0
+
   def Split(self, s, allow_escape):
     """
     Args:
@@ -309,6 +388,14 @@ class IfsSplitter(_BaseSplitter):
     TODO: This should be (frag, do_split) pairs, to avoid IFS='\'
     double-escaping issue.
     """
+    if _HAVE_NATIVE_SPLIT:
+      return [(_NATIVE_SPAN_KINDS[kind], end_index) for kind, end_index in
+              libc.ifs_spans(s, self.ifs_whitespace, self.ifs_other,
+                             allow_escape)]
+    return self.PySplit(s, allow_escape)
+
+  def PySplit(self, s, allow_escape):
+    """The reference implementation of Split(), in Python."""
     ws_chars = self.ifs_whitespace
     other_chars = self.ifs_other
 
@@ -3,6 +3,7 @@
 legacy_test.py: Tests for legacy.py
 """
 
+import random
 import unittest
 
 from core import legacy  # module under test
@@ -11,7 +12,12 @@ from core import legacy  # module under test
 def _RunSplitCases(test, sp, cases):
 
   for expected_parts, s, allow_escape in cases:
-    spans = sp.Split(s, allow_escape)
+    spans = sp.PySplit(s, allow_escape)
+
+    # The native splitter, if it's built, must agree with the reference.
+    test.assertEqual(spans, sp.Split(s, allow_escape), repr(s))
+    test.assertEqual(expected_parts, sp.SplitToParts(s, allow_escape),
+                     repr(s))
     if 0:
       print('%r: %s' % (s, spans))
     else:
@@ -165,5 +171,57 @@ class SplitTest(unittest.TestCase):
     _RunSplitCases(self, sp, CASES)
 
 
+class NativeSplitTest(unittest.TestCase):
+  """Compare libc.ifs_split() against the Python state machine."""
+
+  def testRandomStrings(self):
+    if not legacy._HAVE_NATIVE_SPLIT:
+      return
+
+    r = random.Random(42)
+    splitters = [
+        legacy.IfsSplitter(legacy.DEFAULT_IFS, ''),
+        legacy.IfsSplitter(' ', '_'),
+        legacy.IfsSplitter('', '_-'),
+        legacy.IfsSplitter('\t', ':'),
+        legacy.IfsSplitter('', '\\'),  # IFS='\'
+    ]
+    for _ in xrange(2000):
+      s = ''.join(r.choice('ab _-:\t\n\\') for _ in xrange(r.randint(0, 12)))
+      for sp in splitters:
+        for allow_escape in (True, False):
+          spans = sp.PySplit(s, allow_escape)
+          self.assertEqual(spans, sp.Split(s, allow_escape), repr(s))
+          self.assertEqual(legacy._SpansToParts(s, spans),
+                           sp.SplitToParts(s, allow_escape), repr(s))
+
+
+class SplitPointTest(unittest.TestCase):
+
+  def testRandomStrings(self):
+    r = random.Random(42)
+    splitters = [
+        legacy.IfsSplitter(legacy.DEFAULT_IFS, ''),
+        legacy.IfsSplitter(' ', '_'),
+        legacy.IfsSplitter('', '_-'),
+        legacy.IfsSplitter('\t', ':'),
+    ]
+    for _ in xrange(2000):
+      s = ''.join(r.choice('ab _-:\t\n') for _ in xrange(r.randint(0, 12)))
+      t = ''.join(r.choice('ab _-:\t\n') for _ in xrange(r.randint(0, 3)))
+      for sp in splitters:
+        i = sp.SplitPoint(s)
+        if i == 0:
+          continue
+        self.assertEqual(sp.SplitToParts(s + t, False),
+                         sp.SplitToParts(s[:i], False) +
+                         sp.SplitToParts(s[i:] + t, False), repr(s + t))
+
+    self.assertEqual(4, splitters[0].SplitPoint('foo bar'))
+    self.assertEqual(5, splitters[0].SplitPoint('foo  '))
+    self.assertEqual(0, splitters[1].SplitPoint('foo  '))
+    self.assertEqual(0, legacy.IfsSplitter('', '\\').SplitPoint('a\\b'))
+
+
 if __name__ == '__main__':
   unittest.main()
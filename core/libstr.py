@@ -9,6 +9,8 @@ Instead of:
     var y = x -> sub( Glob/a*/, 'b', :ALL)  # maybe a glob literal
 """
 
+import collections
+
 import libc
 
 from osh.meta import Id
@@ -94,6 +96,14 @@ def _NextUtf8Char(s, i):
   return i
 
 
+# Error codes from libc.utf8_count() and libc.utf8_slice().
+_UTF8_ERRORS = {
+    -1: INCOMPLETE_CHAR,
+    -2: INVALID_CONT,
+    -3: INVALID_START,
+}
+
+
 def CountUtf8Chars(s):
   """Returns the number of utf-8 characters in the byte string 's'.
 
@@ -105,6 +115,31 @@ def CountUtf8Chars(s):
   $ echo $?
   1
   """
+  try:
+    return libc.utf8_count(s)
+  except ValueError as e:
+    raise util.InvalidUtf8(_UTF8_ERRORS[e.args[0]])
+
+
+def Utf8Slice(s, begin, length):
+  """Return the byte offsets of a slice of UTF-8 chars, for ${s:begin:length}.
+
+  Args:
+    begin: a non-negative number of chars
+    length: a non-negative number of chars, or None for the rest of the string
+
+  Returns:
+    (byte_begin, byte_end).  Neither bash or zsh checks out of bounds for
+    slicing, so they're clamped to the end of the string.
+  """
+  try:
+    return libc.utf8_slice(s, begin, -1 if length is None else length)
+  except ValueError as e:
+    raise util.InvalidUtf8(_UTF8_ERRORS[e.args[0]])
+
+
+def _PyCountUtf8Chars(s):
+  """Reference implementation of CountUtf8Chars()."""
   num_chars = 0
   num_bytes = len(s)
   i = 0
@@ -114,12 +149,12 @@ def CountUtf8Chars(s):
   return num_chars
 
 
-def AdvanceUtf8Chars(s, num_chars, byte_offset):
+def _PyAdvanceUtf8Chars(s, num_chars, byte_offset):
   """
   Advance a certain number of UTF-8 chars, beginning with the given byte
   offset.  Returns a byte offset.
 
-  If we got past the end of the string
+  Reference implementation for Utf8Slice().
   """
   num_bytes = len(s)
   i = byte_offset  # current byte position
@@ -144,9 +179,11 @@ def AdvanceUtf8Chars(s, num_chars, byte_offset):
 # (2) Strip -- % %% # ## -
 #
 # a. Fast path for constant strings.
-# b. Convert to POSIX extended regex, to see if it matches at ALL.  If it
-# doesn't match, short circuit out?  We can't do this with fnmatch.
-# c. If it does match, call fnmatch() iteratively over prefixes / suffixes.
+# b. For ## and %%, convert to POSIX extended regex, and let libc.regex_strip()
+# find the longest prefix or suffix.  See _RegexStrip().
+# c. For # and %, patterns like *: and :* are a str.find().  See
+# _LiteralStrip().
+# d. Otherwise, call fnmatch() iteratively over prefixes / suffixes.
 #
 # - # shortest prefix - [:1], [:2], [:3] until it matches
 # - ## longest prefix - [:-1] [:-2], [:3].  Works because fnmatch does not
@@ -164,6 +201,77 @@ def AdvanceUtf8Chars(s, num_chars, byte_offset):
 # - Add location info to errors.  Maybe pass spid pair all the way down.
 #   - Compile time errors for [[:space:]] ?
 
+# op_id -> (is_suffix, is_longest)
+_STRIP_OPS = {
+    Id.VOp1_Pound: (False, False),
+    Id.VOp1_DPound: (False, True),
+    Id.VOp1_Percent: (True, False),
+    Id.VOp1_DPercent: (True, True),
+}
+
+
+def _RegexStrip(s, is_suffix, pat):
+  """Strip the longest prefix or suffix matching a glob, using a regex.
+
+  Returns:
+    The stripped string, or None if the glob can't be converted to a regex
+    that fnmatch() would agree with.
+  """
+  # - Extended globs like @(a|b) aren't converted.
+  # - []] and [!]] are parsed differently.
+  if '(' in pat or '[]' in pat or '[!]' in pat or '[^]' in pat:
+    return None
+  regex, warnings = _GlobToERE(pat)
+  if regex is None or warnings:
+    return None
+
+  try:
+    search = CompileRegex(regex, _REGEX_SUFFIX if is_suffix else _REGEX_PREFIX)
+  except RuntimeError:
+    return None
+
+  i = libc.regex_strip(search, s, is_suffix)
+  if i == -1:
+    return s
+  return s[:i] if is_suffix else s[i:]
+
+
+def _LiteralStrip(s, is_suffix, pat):
+  """Strip the shortest prefix like *: or suffix like :* with str.find().
+
+  Returns:
+    The stripped string, or None if the glob isn't a star and a literal.
+  """
+  if is_suffix:
+    lit, star = pat[:-1], pat[-1:]
+  else:
+    star, lit = pat[:1], pat[1:]
+  if (star != '*' or not lit or glob_.LooksLikeGlob(lit) or '\\' in lit or
+      '(' in lit):
+    return None
+
+  if is_suffix:
+    i = s.rfind(lit)
+    return s if i == -1 else s[:i]
+  else:
+    i = s.find(lit)
+    return s if i == -1 else s[i+len(lit):]
+
+
+def _StripGlob(s, op_id, pat):
+  """Strip a prefix or suffix matching a glob, for ${x#pat} and family."""
+  is_suffix, is_longest = _STRIP_OPS[op_id]
+  # POSIX regexes can only find the longest match in one pass.  Trying each
+  # shorter length with regexec() would be O(n^2), and slower than fnmatch().
+  if is_longest:
+    result = _RegexStrip(s, is_suffix, pat)
+  else:
+    result = _LiteralStrip(s, is_suffix, pat)
+  if result is None:
+    result = _FnmatchStrip(s, op_id, pat)
+  return result
+
+
 def DoUnarySuffixOp(s, op, arg):
   """Helper for ${x#prefix} and family."""
 
@@ -204,25 +312,27 @@ def DoUnarySuffixOp(s, op, arg):
     else:  # e.g. ^ ^^ , ,,
       raise AssertionError(op.op_id)
 
-  # For patterns, do fnmatch() in a loop.
-  #
+  if op.op_id not in _STRIP_OPS:
+    raise NotImplementedError("Can't use %s with pattern" % op.op_id)
+
+  return _StripGlob(s, op.op_id, arg)
+
+
+def _FnmatchStrip(s, op_id, arg):
+  """Strip a prefix or suffix by calling fnmatch() in a loop.
+
+  This is O(n^2), so it's only used for patterns that _RegexStrip() and
+  _LiteralStrip() can't handle.
+  """
   # TODO: The loop needs to iterate over code points, not bytes!
   # - The forward case can probably be handled in a similar manner.
   # - The backward case might be handled by pre-calculating an array of start
   #   positions with _NextUtf8Char.
   #
-  # TODO: Another potential fast path:
-  #
-  # v=aabbccdd
-  # echo ${v#*b}  # strip shortest prefix
-  #
-  # If the whole thing doesn't match '*b*', then no test can succeed.  So we
-  # can fail early.  Conversely echo ${v%%c*} and '*c*'.
-  #
   # (Although honestly this whole construct is nuts and should be deprecated.)
 
   n = len(s)
-  if op.op_id == Id.VOp1_Pound:  # shortest prefix
+  if op_id == Id.VOp1_Pound:  # shortest prefix
     # 'abcd': match 'a', 'ab', 'abc', ...
     for i in xrange(1, n+1):
       #log('Matching pattern %r with %r', arg, s[:i])
@@ -231,7 +341,7 @@ def DoUnarySuffixOp(s, op, arg):
     else:
       return s
 
-  elif op.op_id == Id.VOp1_DPound:  # longest prefix
+  elif op_id == Id.VOp1_DPound:  # longest prefix
     # 'abcd': match 'abc', 'ab', 'a'
     for i in xrange(n, 0, -1):
       #log('Matching pattern %r with %r', arg, s[:i])
@@ -240,7 +350,7 @@ def DoUnarySuffixOp(s, op, arg):
     else:
       return s
 
-  elif op.op_id == Id.VOp1_Percent:  # shortest suffix
+  elif op_id == Id.VOp1_Percent:  # shortest suffix
     # 'abcd': match 'abc', 'ab', 'a'
     for i in xrange(n-1, -1, -1):
       #log('Matching pattern %r with %r', arg, s[:i])
@@ -249,7 +359,7 @@ def DoUnarySuffixOp(s, op, arg):
     else:
       return s
 
-  elif op.op_id == Id.VOp1_DPercent:  # longest suffix
+  elif op_id == Id.VOp1_DPercent:  # longest suffix
     # 'abcd': match 'abc', 'bc', 'c', ...
     for i in xrange(0, n):
       #log('Matching pattern %r with %r', arg, s[:i])
@@ -259,10 +369,71 @@ def DoUnarySuffixOp(s, op, arg):
       return s
 
   else:
-    raise NotImplementedError("Can't use %s with pattern" % op.op_id)
+    raise AssertionError(op_id)
+
+
+class _LruCache(object):
+  """A dict that holds the most recently used entries, up to a maximum."""
+
+  def __init__(self, max_size):
+    self.max_size = max_size
+    self.entries = collections.OrderedDict()
+
+  def Get(self, key):
+    """Return the value for a key, or None."""
+    value = self.entries.pop(key, None)
+    if value is not None:
+      self.entries[key] = value  # now the most recently used
+    return value
+
+  def Put(self, key, value):
+    if len(self.entries) >= self.max_size:
+      self.entries.popitem(last=False)  # least recently used
+    self.entries[key] = value
+
+
+# Modes for CompileRegex().  PatSub matches a single group so it can get its
+# position.
+REGEX_ERE = '%s'  # [[ $x =~ $pat ]]
+_REGEX_GROUP = '(%s)'  # ${x/pat/rep} and ${x//pat/rep}
+_REGEX_PREFIX = '^(%s)'  # ${x/#pat/rep}
+_REGEX_SUFFIX = '(%s)$'  # ${x/%pat/rep}
 
+_REGEX_CACHE_SIZE = 100
 
-def _AllMatchPositions(s, regex):
+# (regex, mode) -> libc.Regex
+_REGEX_CACHE = _LruCache(_REGEX_CACHE_SIZE)
+# glob pattern -> (regex, warnings), from glob_.GlobToERE()
+_GLOB_TO_ERE_CACHE = _LruCache(_REGEX_CACHE_SIZE)
+
+
+def CompileRegex(regex, mode):
+  """Return a compiled libc.Regex, which is cached.
+
+  Loops like 'for x in ...; do echo ${x//a*/b}; done' would otherwise call
+  regcomp() for every string.
+
+  Raises:
+    RuntimeError if the regex is invalid.
+  """
+  key = (regex, mode)
+  compiled = _REGEX_CACHE.Get(key)
+  if compiled is None:
+    compiled = libc.regex_compile(mode % regex)
+    _REGEX_CACHE.Put(key, compiled)
+  return compiled
+
+
+def _GlobToERE(pat):
+  """Cached version of glob_.GlobToERE()."""
+  result = _GLOB_TO_ERE_CACHE.Get(pat)
+  if result is None:
+    result = glob_.GlobToERE(pat)
+    _GLOB_TO_ERE_CACHE.Put(pat, result)
+  return result
+
+
+def _AllMatchPositions(s, compiled):
   """Returns a list of all (start, end) match positions of the regex against s.
 
   (If there are no matches, it returns the empty list.)
@@ -270,7 +441,7 @@ def _AllMatchPositions(s, regex):
   matches = []
   pos = 0
   while True:
-    m = libc.regex_first_group_match(regex, s, pos)
+    m = compiled.first_group_match(s, pos)
     if m is None:
       break
     matches.append(m)
@@ -280,10 +451,10 @@ def _AllMatchPositions(s, regex):
   return matches
 
 
-def _PatSubAll(s, regex, replace_str):
+def _PatSubAll(s, compiled, replace_str):
   parts = []
   prev_end = 0
-  for start, end in _AllMatchPositions(s, regex):
+  for start, end in _AllMatchPositions(s, compiled):
     parts.append(s[prev_end:start])
     parts.append(replace_str)
     prev_end = end
@@ -323,28 +494,32 @@ class _ConstStringReplacer(_Replacer):
 
 class _GlobReplacer(_Replacer):
   def __init__(self, regex, replace_str, slash_spid):
-    # TODO: It would be nice to cache the compilation of the regex here,
-    # instead of just the string.  That would require more sophisticated use of
-    # the Python/C API in libc.c, which we might want to avoid.
+    # The compiled regex is looked up in Replace(), since it depends on the
+    # mode.  See CompileRegex().
     self.regex = regex
     self.replace_str = replace_str
     self.slash_spid = slash_spid
 
   def Replace(self, s, op):
-    regex = '(%s)' % self.regex  # make it a group
-
     if op.replace_mode == Id.Lit_Slash:
-      try:
-        return _PatSubAll(s, regex, self.replace_str)  # loop over matches
-      except RuntimeError as e:
-        e_die('Error matching regex %r: %s', regex, e, span_id=self.slash_spid)
-
-    if op.replace_mode == Id.Lit_Pound:
-      regex = '^' + regex
+      mode = _REGEX_GROUP
+    elif op.replace_mode == Id.Lit_Pound:
+      mode = _REGEX_PREFIX
     elif op.replace_mode == Id.Lit_Percent:
-      regex = regex + '$'
+      mode = _REGEX_SUFFIX
+    else:
+      mode = _REGEX_GROUP
+
+    try:
+      compiled = CompileRegex(self.regex, mode)
+    except RuntimeError as e:
+      e_die('Error matching regex %r: %s', mode % self.regex, e,
+            span_id=self.slash_spid)
+
+    if op.replace_mode == Id.Lit_Slash:
+      return _PatSubAll(s, compiled, self.replace_str)  # loop over matches
 
-    m = libc.regex_first_group_match(regex, s, 0)
+    m = compiled.first_group_match(s, 0)
     #log('regex = %r, s = %r, match = %r', regex, s, m)
     if m is None:
       return s
@@ -360,7 +535,7 @@ def MakeReplacer(pat, replace_str, slash_spid):
   Using these objects is more efficient when performing the same operation on
   multiple strings.
   """
-  regex, warnings = glob_.GlobToERE(pat)
+  regex, warnings = _GlobToERE(pat)
   if warnings:
     # TODO: Add strict mode and expose warnings.
     pass
@@ -4,8 +4,12 @@ libstr_test.py: Tests for libstr.py
 """
 from __future__ import print_function
 
+import random
 import unittest
 
+from core import util
+from osh.meta import Id
+
 from core import libstr  # module under test
 
 
@@ -33,7 +37,7 @@ class LibStrTest(unittest.TestCase):
     n = len(s)
 
     # All of these loops test exactly 4.
-    # NOTE: These are manually copied into DoUnarySuffixOp
+    # NOTE: These are manually copied into _FnmatchStrip
 
     print('## shortest prefix')
     for i in xrange(1, n+1):
@@ -57,27 +61,126 @@ class LibStrTest(unittest.TestCase):
 
   def testPatSubAllMatches(self):
     s = 'oXooXoooX'
+    x_dot = libstr.CompileRegex('X.', libstr._REGEX_GROUP)
+    z = libstr.CompileRegex('z', libstr._REGEX_GROUP)
 
     # Match positions
     self.assertEqual(
         [(1, 3), (4, 6)],
-        libstr._AllMatchPositions(s, '(X.)'))
+        libstr._AllMatchPositions(s, x_dot))
 
     # No match
     self.assertEqual(
         [],
-        libstr._AllMatchPositions(s, '(z)'))
+        libstr._AllMatchPositions(s, z))
 
     # Replacement
     self.assertEqual(
         'o_o_ooX',
-        libstr._PatSubAll(s, '(X.)', '_'))
+        libstr._PatSubAll(s, x_dot, '_'))
 
     # Replacement with no match
     self.assertEqual(
         s,
-        libstr._PatSubAll(s, '(z)', '_'))
-
+        libstr._PatSubAll(s, z, '_'))
+
+  def testCompileRegex(self):
+    r = libstr.CompileRegex('X.', libstr._REGEX_PREFIX)
+    self.assertEqual(None, r.first_group_match('oXo', 0))
+    self.assertEqual((0, 2), r.first_group_match('Xoo', 0))
+
+    # Cached by regex and mode
+    self.assertTrue(r is libstr.CompileRegex('X.', libstr._REGEX_PREFIX))
+    self.assertFalse(r is libstr.CompileRegex('X.', libstr._REGEX_SUFFIX))
+
+    r = libstr.CompileRegex('([a-z]+)-([0-9]+)', libstr.REGEX_ERE)
+    self.assertEqual(['ab-12', 'ab', '12'], r.match('ab-12'))
+
+    self.assertRaises(RuntimeError, libstr.CompileRegex, '*',
+                      libstr.REGEX_ERE)
+
+  def testStripGlob(self):
+    # The regex, str.find(), and the fnmatch() loop should always agree.
+    patterns = [
+        '*', '?', '*:', ':*', '*a*', 'a*b', '[ab]*', '*[!a]', '?:*', '*.',
+        '\\**', '[[:alpha:]]*', '*b?', '*^', '^*', '*^?', '*[^a]', '*$',
+        '$*', '*+', '+*', '*{', '{*', '*|', '|*', '*\\\\', '\\\\*',
+        '[\\]]*', '*[\\]]', '*]', ']*', '*\\]', '*a]b', '*[a^]',
+    ]
+    r = random.Random(42)
+    for _ in xrange(200):
+      s = ''.join(r.choice('ab:.*^$+{|\\]') for _ in xrange(r.randint(0, 8)))
+      for pat in patterns:
+        for op_id in libstr._STRIP_OPS:
+          expected = libstr._FnmatchStrip(s, op_id, pat)
+          actual = libstr._StripGlob(s, op_id, pat)
+          self.assertEqual(expected, actual, '%r %s %r: expected %r, got %r' %
+                           (s, op_id, pat, expected, actual))
+
+    self.assertEqual('b^c', libstr._StripGlob('a^b^c', Id.VOp1_Pound, '*^'))
+    self.assertEqual('a^b', libstr._StripGlob('a^b^c', Id.VOp1_Percent, '^*'))
+    self.assertEqual('c', libstr._RegexStrip('a^b^c', False, '*^'))
+
+    # Not converted
+    self.assertEqual(None, libstr._RegexStrip('ab', False, '@(a|b)'))
+    self.assertEqual(None, libstr._RegexStrip('ab', False, '[]a]'))
+    self.assertEqual(None, libstr._RegexStrip('ab', False, '[\\]]*'))
+    self.assertEqual(None, libstr._LiteralStrip('ab', False, '*[a]'))
+    self.assertEqual(None, libstr._LiteralStrip('ab', True, 'a\\**'))
+
+  def testUtf8(self):
+    self.assertEqual(0, libstr.CountUtf8Chars(''))
+    self.assertEqual(3, libstr.CountUtf8Chars('abc'))
+    self.assertEqual(3, libstr.CountUtf8Chars('a\xce\xbcc'))
+    self.assertEqual((1, 3), libstr.Utf8Slice('abcd', 1, 2))
+    self.assertEqual((4, 4), libstr.Utf8Slice('abcd', 9, 2))
+    self.assertEqual((1, 5), libstr.Utf8Slice('a\xce\xbc\xce\xbc', 1, None))
+    self.assertEqual((3, 5), libstr.Utf8Slice('a\xce\xbc\xce\xbc', 2, 100))
+    # Invalid bytes after the slice aren't checked.
+    self.assertEqual((0, 2), libstr.Utf8Slice('ab\xff', 0, 2))
+
+    self.assertRaises(util.InvalidUtf8, libstr.CountUtf8Chars, 'ab\xff')
+    self.assertRaises(util.InvalidUtf8, libstr.Utf8Slice, 'ab\xff', 0, 3)
+
+  def testUtf8SameAsPython(self):
+    def Result(f, *args):
+      try:
+        return f(*args)
+      except util.InvalidUtf8 as e:
+        return e.UserErrorString()
+
+    # Pieces of valid and invalid UTF-8, so we cover the ASCII fast path
+    # and the errors.
+    pieces = ['a', 'bcdefghij', '\xce\xbc', '\xe2\x82\xac', '\xf0\x9f\x98\x80',
+              '\xff', '\xce', '\x80', '\xe2\x82']
+    r = random.Random(42)
+    for _ in xrange(500):
+      s = ''.join(r.choice(pieces) for _ in xrange(r.randint(0, 6)))
+      self.assertEqual(Result(libstr._PyCountUtf8Chars, s),
+                       Result(libstr.CountUtf8Chars, s), repr(s))
+
+      begin = r.randint(0, 10)
+      length = r.choice([None, 0, 1, 3, 20])
+
+      def PySlice():
+        b = libstr._PyAdvanceUtf8Chars(s, begin, 0)
+        if length is None:
+          return b, len(s)
+        return b, libstr._PyAdvanceUtf8Chars(s, length, b)
+
+      self.assertEqual(Result(PySlice), Result(libstr.Utf8Slice, s, begin,
+                                               length),
+                       '%r %d %s' % (s, begin, length))
+
+  def testLruCache(self):
+    c = libstr._LruCache(2)
+    c.Put('a', 1)
+    c.Put('b', 2)
+    self.assertEqual(1, c.Get('a'))  # now b is least recently used
+    c.Put('c', 3)
+    self.assertEqual(None, c.Get('b'))
+    self.assertEqual(1, c.Get('a'))
+    self.assertEqual(3, c.Get('c'))
 
 if __name__ == '__main__':
   unittest.main()
@@ -13,18 +13,90 @@ from __future__ import print_function
 import errno
 import fcntl
 import os
+import select
+import signal
 import sys
 
+try:
+  import libc
+except ImportError:
+  from benchmarks import fake_libc as libc
+
 from osh.meta import runtime
 from core import util
 from osh.meta import Id
 
+# The number of bytes we can write to an empty pipe without blocking.  At
+# least PIPE_BUF, which is 4096 on Linux and 512 in POSIX.
+_PIPE_BUF = getattr(select, 'PIPE_BUF', 512)
+
 redirect_e = runtime.redirect_e
 process_state_e = runtime.process_state_e
 e_die = util.e_die
 log = util.log
 
 
+# Python 2 doesn't define it.  The value is from Linux <fcntl.h>.
+if hasattr(fcntl, 'F_DUPFD_CLOEXEC'):
+  _F_DUPFD_CLOEXEC = fcntl.F_DUPFD_CLOEXEC
+elif sys.platform.startswith('linux'):
+  _F_DUPFD_CLOEXEC = 1030
+else:
+  _F_DUPFD_CLOEXEC = None
+
+# Descriptors 0-9 are for the user, e.g. 'exec 3>out.txt'.
+_MIN_SHELL_FD = 10
+
+
+def _DupCloExec(fd):
+  """Return the lowest free descriptor >= 10 that is a copy of fd.
+
+  It has FD_CLOEXEC set, so child processes don't inherit it.
+
+  Raises:
+    IOError, e.g. EBADF if fd isn't open.
+  """
+  if _F_DUPFD_CLOEXEC is not None:
+    return fcntl.fcntl(fd, _F_DUPFD_CLOEXEC, _MIN_SHELL_FD)  # atomic
+
+  new_fd = fcntl.fcntl(fd, fcntl.F_DUPFD, _MIN_SHELL_FD)
+  fcntl.fcntl(new_fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+  return new_fd
+
+
+def _PipeCloExec():
+  """Return (r, w) for a new pipe with FD_CLOEXEC set on both ends.
+
+  Children only get the ends that are dup'd onto 0 or 1 for them.
+  """
+  if _HAVE_PIPE_CLOEXEC:
+    return libc.pipe_cloexec()  # atomic
+
+  r, w = os.pipe()
+  fcntl.fcntl(r, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+  fcntl.fcntl(w, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+  return r, w
+
+
+def PipeToShell():
+  """Return (r, w) for a pipe that the shell reads while it runs commands.
+
+  Both ends have FD_CLOEXEC set, and r is 10 or above, so a redirect like
+  'exec 3<x' in the meantime doesn't clobber it.
+  """
+  r, w = _PipeCloExec()
+  return _MoveOutOfUserRange(r), w
+
+
+def _MoveOutOfUserRange(fd):
+  """Return a copy of fd that is 10 or above, closing the original."""
+  if fd >= _MIN_SHELL_FD:
+    return fd
+  new_fd = _DupCloExec(fd)
+  os.close(fd)
+  return new_fd
+
+
 class _FdFrame(object):
   def __init__(self):
     self.saved = []
@@ -46,29 +118,14 @@ class FdState(object):
 
   For example, you can do 'myfunc > out.txt' without forking.
   """
-  def __init__(self, next_fd=10):
-    self.next_fd = next_fd  # where to start saving descriptors
+  def __init__(self):
     self.cur_frame = _FdFrame()  # for the top level
     self.stack = [self.cur_frame]
-
-  def _NextFreeFileDescriptor(self):
-    """Return a free file descriptor above 10 that isn't used.
-
-    NOTE: This doesn't seem to solve all file descriptor problems, and I
-    don't understand why!  This fixed 'test/gold.sh configure-bug', I still
-    had ANOTHER bug with 'test/gold.sh nix' that wasn't fixed.  That required
-    removing the 'import cgi'.
-    """
-    done = False
-    while not done:
-      try:
-        fcntl.fcntl(self.next_fd, fcntl.F_GETFD)
-      except IOError as e:
-        if e.errno == errno.EBADF:
-          done = True
-      self.next_fd += 1
-
-    return self.next_fd
+    # Descriptors we saved user descriptors to, which Pop() restores.  The
+    # kernel gives us the lowest free one with F_DUPFD_CLOEXEC, so we don't
+    # have to probe for it.  Like bash, redirects can't copy them, e.g.
+    # 'echo hi 1>&10' is a bad descriptor error.
+    self.allocated = set()
 
   def Open(self, path, mode='r'):
     """Opens a path for read, but moves it out of the reserved 3-9 fd range.
@@ -82,13 +139,12 @@ class FdState(object):
     if mode == 'r':
       fd_mode = os.O_RDONLY
     elif mode == 'w':
-      fd_mode = os.O_CREAT | os.O_RDWR
+      fd_mode = os.O_CREAT | os.O_RDWR | os.O_TRUNC
     else:
       raise AssertionError(mode)
 
     fd = os.open(path, fd_mode, 0666)
-    new_fd = self._NextFreeFileDescriptor()
-    os.dup2(fd, new_fd)
+    new_fd = _DupCloExec(fd)
     os.close(fd)
     return os.fdopen(new_fd, mode)
 
@@ -100,12 +156,13 @@ class FdState(object):
     Returns:
       success Bool
     """
-    new_fd = self._NextFreeFileDescriptor()
     #log('---- _PushDup %s %s', fd1, fd2)
+    if fd1 in self.allocated:  # e.g. 1>&10, which isn't open for the user
+      util.error('%d: %s', fd1, os.strerror(errno.EBADF))
+      return False
     need_restore = True
     try:
-      #log('DUPFD %s %s', fd2, self.next_fd)
-      fcntl.fcntl(fd2, fcntl.F_DUPFD, new_fd)
+      new_fd = _DupCloExec(fd2)
     except IOError as e:
       # Example program that causes this error: exec 4>&1.  Descriptor 4 isn't
       # open.
@@ -117,7 +174,7 @@ class FdState(object):
         raise
     else:
       os.close(fd2)
-      fcntl.fcntl(new_fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+      self.allocated.add(new_fd)
 
     #log('==== dup %s %s\n' % (fd1, fd2))
     try:
@@ -126,8 +183,10 @@ class FdState(object):
       # bash/dash give this error too, e.g. for 'echo hi 1>&3'
       util.error('%d: %s', fd1, os.strerror(e.errno))
       # Restore and return error
-      os.dup2(new_fd, fd2)
-      os.close(new_fd)
+      if need_restore:
+        os.dup2(new_fd, fd2)
+        os.close(new_fd)
+        self.allocated.discard(new_fd)
       # Undo it
       return False
 
@@ -141,6 +200,70 @@ class FdState(object):
   def _PushWait(self, proc, waiter):
     self.cur_frame.need_wait.append((proc, waiter))
 
+  def _PushHereDoc(self, r, waiter):
+    """Make descriptor r.fd read the here doc body.
+
+    Like dash, we write small bodies into a pipe without forking a writer
+    process, since they fit in the pipe buffer and write() won't block.  Big
+    bodies go in an unlinked temp file, which also doesn't need a process.
+
+    Returns:
+      success Bool
+    """
+    body = r.body
+    if len(body) <= _PIPE_BUF:
+      read_fd, write_fd = os.pipe()
+      os.write(write_fd, body)
+      os.close(write_fd)
+
+      # Move it out of the range 0-9, so it's not the descriptor we're about
+      # to redirect, e.g. 3 in 'cat 3<<EOF'.
+      read_fd = _MoveOutOfUserRange(read_fd)
+      ok = self._PushDup(read_fd, r.fd)  # stdin is now the pipe
+      os.close(read_fd)  # We already made a copy of it.
+      return ok
+
+    try:
+      f = os.tmpfile()
+      f.write(body)
+      f.flush()
+    except (IOError, OSError):
+      f = None  # e.g. EMFILE, or ENOSPC when the disk is full
+
+    if f is not None:
+      fd = _MoveOutOfUserRange(os.dup(f.fileno()))
+      f.close()
+      os.lseek(fd, 0, 0)
+      ok = self._PushDup(fd, r.fd)
+      os.close(fd)  # We already made a copy of it.
+      return ok
+
+    # Last resort: a process that writes to a pipe.
+    # NOTE: Do these descriptors have to be moved out of the range 0-9?
+    read_fd, write_fd = os.pipe()
+
+    ok = self._PushDup(read_fd, r.fd)  # stdin is now the pipe
+
+    # We can't close like we do in the filename case above?  The writer can
+    # get a "broken pipe".
+    self._PushClose(read_fd)
+
+    thunk = _HereDocWriterThunk(write_fd, body)
+    here_proc = Process(thunk)
+
+    # NOTE: we could close the read pipe here, but it doesn't really
+    # matter because we control the code.
+    # here_proc.StateChange()
+    pid = here_proc.Start()
+    # no-op callback
+    waiter.Register(pid, here_proc.WhenDone)
+    #log('Started %s as %d', here_proc, pid)
+    self._PushWait(here_proc, waiter)
+
+    # Now that we've started the child, close it in the parent.
+    os.close(write_fd)
+    return ok
+
   def _ApplyRedirect(self, r, waiter):
     ok = True
 
@@ -207,42 +330,9 @@ class FdState(object):
         raise NotImplementedError
 
     elif r.tag == redirect_e.HereRedirect:
-      # NOTE: Do these descriptors have to be moved out of the range 0-9?
-      read_fd, write_fd = os.pipe()
-
-      if not self._PushDup(read_fd, r.fd):  # stdin is now the pipe
+      if not self._PushHereDoc(r, waiter):
         ok = False
 
-      # We can't close like we do in the filename case above?  The writer can
-      # get a "broken pipe".
-      self._PushClose(read_fd)
-
-      thunk = _HereDocWriterThunk(write_fd, r.body)
-
-      # TODO: Use PIPE_SIZE to save a process in the case of small here docs,
-      # which are the common case.  (dash does this.)
-      start_process = True
-      #start_process = False
-
-      if start_process:
-        here_proc = Process(thunk)
-
-        # NOTE: we could close the read pipe here, but it doesn't really
-        # matter because we control the code.
-        # here_proc.StateChange()
-        pid = here_proc.Start()
-        # no-op callback
-        waiter.Register(pid, here_proc.WhenDone)
-        #log('Started %s as %d', here_proc, pid)
-        self._PushWait(here_proc, waiter)
-
-        # Now that we've started the child, close it in the parent.
-        os.close(write_fd)
-
-      else:
-        os.write(write_fd, r.body)
-        os.close(write_fd)
-
     return ok
 
   def Push(self, redirects, waiter):
@@ -254,6 +344,7 @@ class FdState(object):
     for r in redirects:
       #log('apply %s', r)
       if not self._ApplyRedirect(r, waiter):
+        self.Pop()  # undo the ones that were applied
         return False  # for bad descriptor
     #log('done applying %d redirects', len(redirects))
     return True
@@ -272,6 +363,10 @@ class FdState(object):
     return self._PushDup(r, 0)
 
   def MakePermanent(self):
+    # The saved descriptors won't be restored.
+    for saved, _ in self.cur_frame.saved:
+      os.close(saved)
+      self.allocated.discard(saved)
     self.cur_frame.Forget()
 
   def Pop(self):
@@ -286,13 +381,9 @@ class FdState(object):
         #os.system('ls -l /proc/%s/fd' % os.getpid())
         raise
       os.close(saved)
+      self.allocated.discard(saved)
       #log('dup2 %s %s', saved, orig)
 
-      # NOTE: This balances the increments from _PushDup().  But it doesn't
-      # balance the ones from Open().
-      self.next_fd -= 1  # Count down
-      assert self.next_fd >= 10, self.next_fd
-
     for fd in frame.need_close:
       #log('Close %d', fd)
       try:
@@ -311,9 +402,20 @@ class ChildStateChange(object):
   def Apply(self):
     raise NotImplementedError
 
+  def SpawnActions(self):
+    """The same change as a list of (fd, new_fd) for libc.posix_spawn().
+
+    new_fd == -1 means close(fd).
+    """
+    raise NotImplementedError
+
 
 class StdinFromPipe(ChildStateChange):
   def __init__(self, pipe_read_fd, w):
+    """
+    Args:
+      w: the write end, or -1 if the parent already closed it
+    """
     self.r = pipe_read_fd
     self.w = w
 
@@ -324,9 +426,16 @@ class StdinFromPipe(ChildStateChange):
     os.dup2(self.r, 0)
     os.close(self.r)  # close after dup
 
-    os.close(self.w)  # we're reading from the pipe, not writing
+    if self.w != -1:
+      os.close(self.w)  # we're reading from the pipe, not writing
     #log('child CLOSE w %d pid=%d', self.w, os.getpid())
 
+  def SpawnActions(self):
+    actions = [(self.r, 0), (self.r, -1)]
+    if self.w != -1:
+      actions.append((self.w, -1))
+    return actions
+
 
 class StdoutToPipe(ChildStateChange):
   def __init__(self, r, pipe_write_fd):
@@ -343,6 +452,9 @@ class StdoutToPipe(ChildStateChange):
     os.close(self.r)  # we're writing to the pipe, not reading
     #log('child CLOSE r %d pid=%d', self.r, os.getpid())
 
+  def SpawnActions(self):
+    return [(self.w, 1), (self.w, -1), (self.r, -1)]
+
 
 class Thunk(object):
   """Abstract base class for things runnable in another process."""
@@ -352,18 +464,31 @@ class Thunk(object):
     raise NotImplementedError
 
 
-def ExecExternalProgram(argv, environ):
+def ExecExternalProgram(argv, environ, argv0_path=None):
   """Execute a program and exit this process.
 
   Called by:
   ls /
   exec ls /
   ( ls / )
+
+  Args:
+    argv0_path: The result of looking up argv[0] in $PATH, if any.  Then we
+      don't have to search $PATH again.
   """
   # TODO: If there is an error, like the file isn't executable, then we should
   # exit, and the parent will reap it.  Should it capture stderr?
   try:
-    os.execvpe(argv[0], argv, environ)
+    if argv0_path is None:
+      os.execvpe(argv[0], argv, environ)
+    else:
+      try:
+        os.execve(argv0_path, argv, environ)
+      except OSError as e:
+        # The file may have been removed since we looked it up.
+        if e.errno != errno.ENOENT:
+          raise
+        os.execvpe(argv[0], argv, environ)
   except OSError as e:
     util.error('%r: %s', argv[0], os.strerror(e.errno))
     # POSIX mentions 126 and 127 for two specific errors.  The rest are
@@ -384,18 +509,49 @@ def ExecExternalProgram(argv, environ):
   # no return
 
 
+# Not in fake_libc, or an old build of libc.so.
+_HAVE_SPAWN = hasattr(libc, 'posix_spawn')
+_HAVE_PIPE_CLOEXEC = hasattr(libc, 'pipe_cloexec')
+
+
 class ExternalThunk(object):
   """An external executable."""
 
-  def __init__(self, argv, environ):
+  def __init__(self, argv, environ, argv0_path=None):
     self.argv = argv
     self.environ = environ
+    self.argv0_path = argv0_path
 
   def Run(self):
     """
     An ExternalThunk is run in parent for the exec builtin.
     """
-    ExecExternalProgram(self.argv, self.environ)
+    ExecExternalProgram(self.argv, self.environ, self.argv0_path)
+
+  def Spawn(self, state_changes):
+    """Start the program with posix_spawn() rather than fork() and exec().
+
+    Returns:
+      The PID, or -1 if the caller should fork instead.  When the program
+      can't be started, the forked child reports the error.
+    """
+    if not _HAVE_SPAWN:
+      return -1
+
+    path = self.argv0_path
+    if path is None:
+      if '/' not in self.argv[0]:
+        return -1  # not found, or 'set +o hashall'
+      path = self.argv[0]
+
+    fd_actions = []
+    for st in state_changes:
+      fd_actions.extend(st.SpawnActions())
+    envp = ['%s=%s' % (name, val) for name, val in self.environ.iteritems()]
+    try:
+      return libc.posix_spawn(path, self.argv, envp, fd_actions)
+    except OSError:
+      return -1
 
 
 class SubProgramThunk(object):
@@ -473,27 +629,20 @@ class Process(Job):
 
     # For pipelines
     self.state_changes = []
-    self.close_r = -1
-    self.close_w = -1
 
     self.pid = -1
     self.status = -1
 
+    # For --profile-commands.  Set by the Executor.
+    self.profiler = None  # dev.CommandProfiler
+    self.profile_desc = None  # (kind, name, span_id)
+
   def __repr__(self):
     return '<Process %s>' % self.thunk
 
   def AddStateChange(self, s):
     self.state_changes.append(s)
 
-  def AddPipeToClose(self, r, w):
-    self.close_r = r
-    self.close_w = w
-
-  def ClosePipe(self):
-    if self.close_r != -1:
-      os.close(self.close_r)
-      os.close(self.close_w)
-
   def Start(self):
     """Start this process with fork(), haandling redirects."""
     # TODO: If OSH were a job control shell, we might need to call some of
@@ -510,31 +659,45 @@ class Process(Job):
     #
     # The whole job control mechanism is complicated and hacky.
 
-    pid = os.fork()
-    if pid < 0:
-      # When does this happen?
-      raise RuntimeError('Fatal error in os.fork()')
+    pid = -1
+    if isinstance(self.thunk, ExternalThunk):
+      pid = self.thunk.Spawn(self.state_changes)
+
+    if pid == -1:
+      pid = os.fork()
+      if pid < 0:
+        # When does this happen?
+        raise RuntimeError('Fatal error in os.fork()')
 
-    elif pid == 0:  # child
-      for st in self.state_changes:
-        st.Apply()
+      elif pid == 0:  # child
+        # Python ignores SIGPIPE, but a child writing to a closed pipe should
+        # die quietly, like 'yes | head -n 1'.
+        signal.signal(signal.SIGPIPE, signal.SIG_DFL)
 
-      self.thunk.Run()
-      # Never returns
+        for st in self.state_changes:
+          st.Apply()
+
+        self.thunk.Run()
+        # Never returns
 
     #log('STARTED process %s, pid = %d', self, pid)
 
     # Invariant, after the process is started, it stores its PID.
     self.pid = pid
+    if self.profiler:
+      kind, name, span_id = self.profile_desc
+      self.profiler.StartProcess(pid, kind, name, span_id)
     return pid
 
   def WaitUntilDone(self, waiter):
-    while True:
+    # Wait for this process only, with waitpid(), rather than for any child.
+    while self.state != process_state_e.Done:
       #log('WAITING')
-      if not waiter.Wait():
-        break
-      if self.state == process_state_e.Done:
+      if not waiter.Wait(self.pid):
         break
+    # Nobody waits for process subs by PID, and background jobs may be
+    # waited for much later.  Don't leave them as zombies.
+    waiter.ReapFinished()
     return self.status
 
   def WhenDone(self, pid, status):
@@ -562,6 +725,43 @@ class Process(Job):
     return self.WaitUntilDone(waiter)
 
 
+class CapturedOutput(object):
+  """A pipeline stage that was already run in the shell process.
+
+  For example, 'echo' in 'echo hi | read x' with 'set -o inline-builtins'.
+  Pipeline.Start() gives its output to the next stage, without forking.
+  """
+
+  def __init__(self, status, stdout):
+    self.status = status
+    self.stdout = stdout
+
+  def __repr__(self):
+    return '<CapturedOutput %d %r>' % (self.status, self.stdout[:20])
+
+  def OpenForReading(self):
+    """Return a descriptor that reads the output.
+
+    Like here docs: small outputs fit in the pipe buffer, so we write them
+    without blocking.  Big outputs go in an unlinked temp file.
+    """
+    if len(self.stdout) <= _PIPE_BUF:
+      r, w = _PipeCloExec()
+      os.write(w, self.stdout)
+      os.close(w)
+      return r
+
+    f = os.tmpfile()
+    try:
+      f.write(self.stdout)
+      f.flush()
+      fd = _DupCloExec(f.fileno())
+    finally:
+      f.close()
+    os.lseek(fd, 0, 0)
+    return fd
+
+
 class Pipeline(Job):
   """A pipeline of processes to run.
 
@@ -575,6 +775,8 @@ class Pipeline(Job):
     Job.__init__(self)
     self.procs = []
     self.pids = []  # pids in order
+    self.pid_index = {}  # pid -> index in self.pids, for WhenDone()
+    self.num_done = 0  # how many processes have exited
     self.pipe_status = []  # status in order
     self.status = -1  # for 'wait' jobs
 
@@ -583,26 +785,16 @@ class Pipeline(Job):
 
     # Optional for foregroud
     self.last_thunk = None
-    self.last_pipe = None
+    self.last_read_fd = -1  # stdin for last_thunk, set in Start()
 
   def __repr__(self):
     return '<Pipeline %s>' % ' '.join(repr(p) for p in self.procs)
 
   def Add(self, p):
-    """Append a process to the pipeline."""
-    if len(self.procs) == 0:
-      self.procs.append(p)
-      return
-
-    r, w = os.pipe()
-    #log('pipe for %s: %d %d', p, r, w)
-    prev = self.procs[-1]
-
-    prev.AddStateChange(StdoutToPipe(r, w))  # applied on Start()
-    p.AddStateChange(StdinFromPipe(r, w))  # applied on Start()
-
-    p.AddPipeToClose(r, w)  # ClosePipe() on Start()
+    """Append a process to the pipeline.
 
+    The pipes are created in Start().
+    """
     self.procs.append(p)
 
   def AddLast(self, thunk):
@@ -613,27 +805,44 @@ class Pipeline(Job):
     """
     self.last_thunk = thunk
 
-    if len(self.procs) == 0:   # No pipe: if ! foo
-      return
-
-    r, w = os.pipe()
-    #log('last pipe %d %d', r, w)
-
-    prev = self.procs[-1]
-    prev.AddStateChange(StdoutToPipe(r, w))
-
-    self.last_pipe = (r, w)  # So we can connect it to last_thunk
-
   def Start(self, waiter):
+    # Each pipe is created just before the process that writes to it is
+    # started, and the parent closes its copies right after the reader is
+    # started.  So when we fork, the only pipe descriptors we have open are
+    # the read end for this process's stdin, and both ends of the pipe for its
+    # stdout.  They all have FD_CLOEXEC set.
+    n = len(self.procs)
+    prev_r = -1
     for i, proc in enumerate(self.procs):
+      if isinstance(proc, CapturedOutput):
+        assert self.last_thunk, "Its output can only go to another stage"
+        if prev_r != -1:
+          os.close(prev_r)  # it doesn't read stdin
+        self.pipe_status.append(proc.status)
+        prev_r = proc.OpenForReading()
+        continue
+
+      if prev_r != -1:
+        proc.AddStateChange(StdinFromPipe(prev_r, -1))
+
+      w = -1
+      if i < n - 1 or self.last_thunk:  # No pipe for a background job's end
+        r, w = _PipeCloExec()
+        proc.AddStateChange(StdoutToPipe(r, w))
+
       pid = proc.Start()
+      self.pid_index[pid] = i
       self.pids.append(pid)
       self.pipe_status.append(-1)  # uninitialized
       waiter.Register(pid, self.WhenDone)
 
-      # NOTE: This has to be done after every fork() call.  Otherwise processes
-      # will have descriptors from non-adjacent pipes.
-      proc.ClosePipe()
+      if prev_r != -1:
+        os.close(prev_r)  # the child reads it
+      if w != -1:
+        os.close(w)  # the child writes it
+        prev_r = r
+
+    self.last_read_fd = prev_r
 
     if self.last_thunk:
       self.pipe_status.append(-1)  # for self.last_thunk
@@ -645,14 +854,16 @@ class Pipeline(Job):
     return self.pids[-1]  # the last PID is the job ID
 
   def WaitUntilDone(self, waiter):
-    while True:
-      #log('WAIT pipeline')
-      if not waiter.Wait():
-        break
-      if self.state == process_state_e.Done:
-        #log('Pipeline DONE')
-        break
-
+    # Wait for each process in turn.  The order doesn't matter, since we need
+    # all of them.
+    for pid in self.pids:
+      i = self.pid_index[pid]
+      while self.pipe_status[i] == -1:
+        #log('WAIT pipeline')
+        if not waiter.Wait(pid):
+          break
+
+    waiter.ReapFinished()  # see Process.WaitUntilDone()
     return self.pipe_status
 
   def Run(self, waiter, fd_state):
@@ -667,10 +878,9 @@ class Pipeline(Job):
     ex, node = self.last_thunk
 
     #log('thunk %s', self.last_thunk)
-    if self.last_pipe is not None:
-      r, w = self.last_pipe  # set in AddLast()
-      os.close(w)  # we will not write here
-      fd_state.PushStdinFromPipe(r)
+    if self.last_read_fd != -1:
+      fd_state.PushStdinFromPipe(self.last_read_fd)
+      os.close(self.last_read_fd)  # it was dup'd onto stdin
       try:
         ex.ExecuteAndCatch(node)
       finally:
@@ -685,14 +895,14 @@ class Pipeline(Job):
 
   def WhenDone(self, pid, status):
     #log('Pipeline WhenDone %d %d', pid, status)
-    i = self.pids.index(pid)
-    assert i != -1, 'Unexpected PID %d' % pid
+    i = self.pid_index[pid]
     self.pipe_status[i] = status
-    if all(status != -1 for status in self.pipe_status):
+    self.num_done += 1
+    if self.num_done == len(self.pids):
       self.status = self.pipe_status[-1]  # last one
       self.state = process_state_e.Done
       if self.job_state:
-        self.job_state.WhenDone(self.pipe_status[-1])
+        self.job_state.WhenDone(self.pids[-1])  # the job ID
 
 
 class JobState(object):
@@ -703,10 +913,13 @@ class JobState(object):
     # A pipeline that is backgrounded is always run in a SubProgramThunk?  So
     # you can wait for it once?
     self.jobs = {}
+    self.num_running = 0  # so AllDone() doesn't have to look at every job
 
   def Register(self, pid, job):
     """ Used by 'sleep 1 &' """
     self.jobs[pid] = job
+    if job.State() != process_state_e.Done:
+      self.num_running += 1
 
   def List(self):
     """Used by the 'jobs' builtin."""
@@ -729,15 +942,21 @@ class JobState(object):
 
   def AllDone(self):
     """Test if all jobs are done.  Used by 'wait' builtin."""
-    for job in self.jobs.itervalues():
-      if job.State() != process_state_e.Done:
-        return False
-    return True
+    return self.num_running == 0
+
+  def NumRunning(self):
+    """Used by 'wait -P'."""
+    return self.num_running
 
   def WhenDone(self, pid):
-    """Process and Pipeline can call this."""
+    """Process and Pipeline call this when a background job is done.
+
+    Args:
+      pid: the job ID
+    """
     log('JobState WhenDone %d', pid)
-    # TODO: Update the list
+    if pid in self.jobs:  # a job can't finish before it's registered
+      self.num_running -= 1
 
 
 class Waiter(object):
@@ -762,21 +981,34 @@ class Waiter(object):
   process OR a background process!  So you have to distinguish between them.
 
   NOTE: strace reveals that all shells call wait4(-1), which waits for ANY
-  process.  os.wait() ends up calling that too.  This is the only way to
-  support the processes we need.
+  process.  We do that for 'wait' and 'wait -n', but foreground processes and
+  'wait $pid' use waitpid() on a specific PID, and then reap any other
+  children that have exited with WNOHANG.
   """
   def __init__(self):
     self.callbacks = {}  # pid -> callback
     self.last_status = 127  # wait -n error code
+    self.profiler = None  # dev.CommandProfiler, for --profile-commands
 
   def Register(self, pid, callback):
     self.callbacks[pid] = callback
 
-  def Wait(self):
-    # This is a list of async jobs
+  def Wait(self, pid=-1, options=0):
+    """Wait for a child process to exit, and call its callback.
+
+    Args:
+      pid: The process to wait for, or -1 for any child.  Waiting for a
+        specific process means we don't reap unrelated background jobs, and
+        call their callbacks, while running something in the foreground.
+      options: os.WNOHANG to return immediately if no child has exited.
+
+    Returns:
+      True if the caller should keep waiting, or False if there's nothing to
+      wait for.
+    """
     while True:
       try:
-        pid, status = os.wait()
+        pid, status, rusage = os.wait4(pid, options)
       except OSError as e:
         #log('wait() error: %s', e)
         if e.errno == errno.ECHILD:
@@ -794,11 +1026,14 @@ class Waiter(object):
       else:
         break  # no exception thrown, so no need to retry
 
+    if pid == 0:  # WNOHANG and no child has exited
+      return False
+
     #log('WAIT got %s %s', pid, status)
 
     # TODO: change status in more cases.
     if os.WIFSIGNALED(status):
-      pass
+      status = 128 + os.WTERMSIG(status)  # e.g. 141 for SIGPIPE, like bash
     elif os.WIFEXITED(status):
       status = os.WEXITSTATUS(status)
       #log('exit status: %s', status)
@@ -816,4 +1051,17 @@ class Waiter(object):
     callback(pid, status)
     self.last_status = status  # for wait -n
 
+    if self.profiler:
+      self.profiler.OnReap(pid, rusage)
+
     return True  # caller should keep waiting
+
+  def ReapFinished(self):
+    """Reap every child that has already exited, without blocking.
+
+    Used after waiting for foreground processes, so that process subs and
+    finished background jobs don't stay zombies, and 'jobs' and 'wait' see
+    them.
+    """
+    while self.Wait(options=os.WNOHANG):
+      pass
@@ -3,8 +3,12 @@
 process_test.py: Tests for process.py
 """
 
+import fcntl
 import os
+import subprocess
+import sys
 import unittest
+from distutils import spawn
 
 from core import builtin
 from core import process  # module under test
@@ -38,6 +42,25 @@ def _ExtProc(argv):
   return Process(ExternalThunk(argv, {}))
 
 
+# Write the descriptors above 2 that this process has open to argv[1].
+_LIST_FDS = """
+import os, sys
+open_fds = []
+for fd in range(3, 256):
+  try:
+    os.fstat(fd)
+  except OSError:
+    continue
+  open_fds.append(fd)
+with open(sys.argv[1], 'w') as f:
+  f.write(repr(open_fds))
+"""
+
+
+def _ListFds(path):
+  return [sys.executable, '-c', _LIST_FDS, path]
+
+
 class ProcessTest(unittest.TestCase):
 
   def testStdinRedirect(self):
@@ -64,6 +87,50 @@ class ProcessTest(unittest.TestCase):
     self.assertEqual('one\n', line1)
     self.assertEqual('one\n', line2)
 
+  def testSavedDescriptors(self):
+    waiter = process.Waiter()
+    fd_state = process.FdState()
+
+    r = runtime.PathRedirect(Id.Redir_Great, 1, '/dev/null')
+    fd_state.Push([r], waiter)
+    self.assertEqual(1, len(fd_state.allocated))
+    saved_fd = list(fd_state.allocated)[0]
+    self.assertTrue(saved_fd >= 10, saved_fd)
+    # Child processes don't inherit it.
+    flags = fcntl.fcntl(saved_fd, fcntl.F_GETFD)
+    self.assertEqual(fcntl.FD_CLOEXEC, flags & fcntl.FD_CLOEXEC)
+
+    # The user can't copy it, e.g. 2>&10.
+    r = runtime.DescRedirect(Id.Redir_GreatAnd, 2, saved_fd)
+    self.assertEqual(False, fd_state.Push([r], waiter))  # and it's popped
+
+    fd_state.Pop()
+    self.assertEqual(set(), fd_state.allocated)
+
+    # exec 2>/dev/null closes the saved descriptor.
+    stderr_copy = os.dup(2)
+    r = runtime.PathRedirect(Id.Redir_Great, 2, '/dev/null')
+    fd_state.Push([r], waiter)
+    saved_fd = list(fd_state.allocated)[0]
+    fd_state.MakePermanent()
+    fd_state.Pop()
+    os.dup2(stderr_copy, 2)
+    os.close(stderr_copy)
+    self.assertEqual(set(), fd_state.allocated)
+    self.assertRaises(OSError, os.fstat, saved_fd)
+
+  def testHereDocRedirect(self):
+    waiter = process.Waiter()
+    fd_state = process.FdState()
+
+    # Small bodies are written to a pipe, and big ones to a temp file.
+    for body in ['one\ntwo\n', 'x' * (process._PIPE_BUF + 1) + '\n']:
+      r = runtime.HereRedirect(0, body)
+      fd_state.Push([r], waiter)
+      line = builtin.ReadLineFromStdin()
+      fd_state.Pop()
+      self.assertEqual(body.splitlines(True)[0], line)
+
   def testProcess(self):
 
     # 3 fds.  Does Python open it?  Shell seems to have it too.  Maybe it
@@ -83,6 +150,32 @@ class ProcessTest(unittest.TestCase):
     # 12 file descriptors open!
     print('FDS AFTER', os.listdir('/dev/fd'))
 
+  def testWaitForJobs(self):
+    waiter = process.Waiter()
+    job_state = process.JobState()
+
+    pi = process.Pipeline()
+    pi.Add(_ExtProc(['sh', '-c', 'exit 1']))
+    pi.Add(_ExtProc(['sh', '-c', 'exit 2']))
+    job_id = pi.StartInBackground(waiter, job_state)
+    job_state.Register(job_id, pi)
+
+    p = Process(ExternalThunk(['sh', '-c', 'sleep 0.2; exit 3'], {}),
+                job_state=job_state)
+    pid = p.Start()
+    waiter.Register(pid, p.WhenDone)
+    job_state.Register(pid, p)
+    self.assertEqual(False, job_state.AllDone())
+
+    # After waiting for a specific process, the others that have already
+    # exited are reaped too, so they don't stay zombies.
+    self.assertEqual(3, p.WaitUntilDone(waiter))
+    self.assertEqual(True, job_state.AllDone())
+    self.assertEqual([1, 2], pi.WaitUntilDone(waiter))
+
+    # Nothing left.
+    self.assertEqual(False, waiter.Wait(options=os.WNOHANG))
+
   def testPipeline(self):
     arena = test_lib.MakeArena('testPipeline')
     node = _CommandNode('uniq -c', arena)
@@ -101,6 +194,48 @@ class ProcessTest(unittest.TestCase):
 
     print('AFTER', os.listdir('/dev/fd'))
 
+  def testPipelineDescriptors(self):
+    # What a child inherits from the test runner itself.
+    p = _ExtProc(_ListFds('_tmp/fds-alone.txt'))
+    p.Run(_WAITER)
+    with open('_tmp/fds-alone.txt') as f:
+      expected = f.read()
+
+    # A process in the middle of a pipeline doesn't get any other pipes.
+    p = process.Pipeline()
+    p.Add(_ExtProc(['true']))
+    p.Add(_ExtProc(['true']))
+    p.Add(_ExtProc(_ListFds('_tmp/fds-pipeline.txt')))
+    p.Add(_ExtProc(['cat']))
+    p.Add(_ExtProc(['true']))
+    p.Start(_WAITER)
+    self.assertEqual([0, 0, 0, 0, 0], p.WaitUntilDone(_WAITER))
+
+    with open('_tmp/fds-pipeline.txt') as f:
+      self.assertEqual(expected, f.read())
+
+  @unittest.skipUnless(spawn.find_executable('strace'), 'strace not installed')
+  def testPipelineSyscalls(self):
+    # Count the pipes made for a pipeline of 4 processes.
+    argv = ['strace', '-f', '-e', 'trace=pipe,pipe2', '-o', '_tmp/strace.txt',
+            'bin/osh', '-c', 'true | true | true | true']
+    self.assertEqual(0, subprocess.call(argv))
+    with open('_tmp/strace.txt') as f:
+      lines = f.readlines()
+
+    pipe2_calls = [line for line in lines if 'pipe2(' in line]
+    self.assertEqual(3, len(pipe2_calls), lines)
+    for line in pipe2_calls:
+      self.assertIn('O_CLOEXEC', line)
+    self.assertEqual([], [line for line in lines if 'pipe(' in line])
+
+  def testCapturedOutput(self):
+    for stdout in ['hi\n', 'x' * 10000]:
+      fd = process.CapturedOutput(0, stdout).OpenForReading()
+      self.assertEqual(stdout, os.read(fd, 20000))
+      self.assertEqual('', os.read(fd, 1))  # EOF
+      os.close(fd)
+
   def testPipeline2(self):
     arena = test_lib.MakeArena('testPipeline')
     ex = cmd_exec_test.InitExecutor(arena=arena)
@@ -81,6 +81,9 @@ SET_OPTIONS = [
     (None, 'pipefail'),
 
     (None, 'debug-completion'),
+    (None, 'compile-commands'),
+    (None, 'inline-builtins'),
+    (None, 'stream-for'),
 
     (None, 'strict-control-flow'),
     (None, 'strict-errexit'),
@@ -101,8 +104,8 @@ SET_OPTIONS = [
 SET_OPTION_NAMES = set(name for _, name in SET_OPTIONS)
 
 SHOPT_OPTION_NAMES = (
-    'nullglob', 'failglob', 'expand_aliases', 'extglob', 'progcomp',
-    'hostcomplete', 'lastpipe')
+    'nullglob', 'failglob', 'dotglob', 'globstar', 'expand_aliases',
+    'extglob', 'progcomp', 'hostcomplete', 'lastpipe')
 
 
 class ExecOpts(object):
@@ -129,11 +132,20 @@ class ExecOpts(object):
     self.noglob = False  # -f
     self.noexec = False  # -n
     self.noclobber = False  # -C
-    # We don't do anything with this yet.  But Aboriginal calls 'set +h'.
+    # Remember the location of external commands.  Aboriginal calls 'set +h'.
     self.hashall = True  # -h is true by default.
 
     # OSH-specific options.
     self.debug_completion = False
+    # Run command nodes through closures from core/cmd_compile.py.
+    self.compile_commands = False
+    # Run command subs and subshells that only call a builtin like echo
+    # without forking.
+    self.inline_builtins = False
+    # Run the body of 'for x in $(cmd)' as cmd's output is read, rather than
+    # after it exits.  The output is split and globbed a chunk at a time, with
+    # the values of IFS and the glob options at that time.
+    self.stream_for = False
     self.strict_control_flow = False
 
     # strict_errexit makes 'local foo=$(false)' and echo $(false) fail.
@@ -161,6 +173,8 @@ class ExecOpts(object):
     # these.
     self.nullglob = False
     self.failglob = False
+    self.dotglob = False  # * matches names that start with .
+    self.globstar = False  # ** matches directories recursively
 
     # No-op for bash compatibility.  We always expand aliases.
     self.expand_aliases = False
@@ -398,6 +412,71 @@ class DirStack(object):
     return reversed(self.stack)
 
 
+class SearchPath(object):
+  """Resolves command names to paths, and caches the results.
+
+  For the 'hash' builtin, and so that we don't make os.execvpe() try every
+  directory in $PATH for every external command.  The cache is cleared when
+  the value of $PATH changes, including temporary bindings like PATH=/bin ls.
+  """
+
+  def __init__(self, mem):
+    self.mem = mem
+    self.path_str = None  # the value of $PATH the cache is valid for
+    self.cache = {}  # name -> full path
+
+  def _PathList(self):
+    val = self.mem.GetVar('PATH')
+    if val.tag == value_e.Str:
+      path_str = val.s
+    else:
+      path_str = None  # treat as empty path
+
+    if path_str != self.path_str:
+      self.cache.clear()
+      self.path_str = path_str
+    return path_str.split(':') if path_str is not None else []
+
+  def Lookup(self, name):
+    """Search $PATH for an executable file, without using the cache.
+
+    Returns:
+      The full path, or None if it wasn't found.
+    """
+    for path_dir in self._PathList():
+      full_path = os.path.join(path_dir, name)
+      if os.path.isfile(full_path) and os.access(full_path, os.X_OK):
+        return full_path
+    return None
+
+  def CachedLookup(self, name):
+    """Like Lookup(), but remember the result.
+
+    Names with a slash aren't looked up, and relative results like 'foo' from
+    an empty $PATH entry aren't cached, because they depend on the cwd.
+    """
+    if '/' in name:
+      return None  # execve() doesn't search $PATH either
+    self._PathList()  # possibly invalidate
+    full_path = self.cache.get(name)
+    if full_path is None:
+      full_path = self.Lookup(name)
+      if full_path is not None and full_path.startswith('/'):
+        self.cache[name] = full_path
+    return full_path
+
+  def MaybeRemoveEntry(self, name):
+    """When the file was deleted or moved, e.g. after exec fails."""
+    self.cache.pop(name, None)
+
+  def ClearCache(self):
+    self.cache.clear()
+
+  def CachedCommands(self):
+    self._PathList()  # possibly invalidate
+    return sorted(self.cache)
+
+
 def _FormatStack(var_stack):
   """Temporary debugging.
 
@@ -449,6 +528,10 @@ class Mem(object):
     self.last_status = 0  # Mutable public variable
     self.last_job_id = -1  # Uninitialized value mutable public variable
 
+    # var name -> list of functions to call when its value may have changed.
+    # See Watch().
+    self.watchers = {}
+
     # Done ONCE on initialization
     self.root_pid = os.getpid()
 
@@ -559,6 +642,28 @@ class Mem(object):
 
     self.current_spid = span_id
 
+  #
+  # Watchers
+  #
+
+  def Watch(self, name, callback):
+    """Call callback() whenever the value of a variable may have changed.
+
+    That is, when it's assigned or unset, or when a function call or temp
+    binding that shadowed it returns.  For caches like SplitContext that
+    depend on a variable.
+    """
+    self.watchers.setdefault(name, []).append(callback)
+
+  def _Notify(self, name):
+    for callback in self.watchers.get(name, ()):
+      callback()
+
+  def _NotifyPoppedFrame(self, frame):
+    for name in self.watchers:
+      if name in frame.vars:
+        self._Notify(name)
+
   #
   # Stack
   #
@@ -579,7 +684,7 @@ class Mem(object):
     self.bash_source.pop()
     self._PopDebugStack()
 
-    self.var_stack.pop()
+    self._NotifyPoppedFrame(self.var_stack.pop())
     self.argv_stack.pop()
 
   def PushSource(self, source_name, argv):
@@ -605,7 +710,7 @@ class Mem(object):
 
   def PopTemp(self):
     self._PopDebugStack()
-    self.var_stack.pop()
+    self._NotifyPoppedFrame(self.var_stack.pop())
 
   def _PushDebugStack(self, func_name, source_name):
     # self.current_spid is set before every SimpleCommand and Assignment.
@@ -769,6 +874,9 @@ class Mem(object):
 
     assert new_flags is not None
 
+    if lval.name in self.watchers:
+      self._Notify(lval.name)
+
     if lval.tag == lvalue_e.LhsName:
       #if lval.name == 'ldflags':
       # TODO: Turn this into a tracing feature.  Like osh --tracevar ldflags
@@ -912,6 +1020,8 @@ class Mem(object):
     """
     cell = self.var_stack[0].vars[name]
     cell.val = new_val
+    if name in self.watchers:
+      self._Notify(name)
 
   # NOTE: Have a default for convenience
   def GetVar(self, name, lookup_mode=scope_e.Dynamic):
@@ -996,6 +1106,8 @@ class Mem(object):
         if cell.readonly:
           return False, found
         del namespace[lval.name]  # it must be here
+        if lval.name in self.watchers:
+          self._Notify(lval.name)
         return True, found # found
       else:
         return True, False
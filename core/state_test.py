@@ -6,6 +6,7 @@ state_test.py: Tests for state.py
 import unittest
 
 from osh.meta import ast, runtime
+from core import legacy
 from core import state  # module under test
 from core import util
 from core import test_lib
@@ -288,5 +289,62 @@ class MemTest(unittest.TestCase):
     self.assertEqual(['i', 'j', 'k'], mem.GetArgv())
 
 
+class SplitContextTest(unittest.TestCase):
+
+  def testIfsChanges(self):
+    mem = _InitMem()
+    splitter = legacy.SplitContext(mem)
+    self.assertEqual(['a', 'b:c'], splitter.SplitForWordEval('a b:c'))
+
+    state.SetGlobalString(mem, 'IFS', ':')
+    self.assertEqual(['a b', 'c'], splitter.SplitForWordEval('a b:c'))
+    self.assertEqual(':', splitter.GetJoinChar())
+
+    # IFS=' ' myfunc
+    mem.PushTemp()
+    mem.SetVar(runtime.LhsName('IFS'), runtime.Str(' '), (), scope_e.TempEnv)
+    self.assertEqual(['a', 'b:c'], splitter.SplitForWordEval('a b:c'))
+    mem.PopTemp()
+    self.assertEqual(['a b', 'c'], splitter.SplitForWordEval('a b:c'))
+
+    # local IFS in a function
+    mem.PushCall('f', 0, [])
+    mem.SetVar(runtime.LhsName('IFS'), None, (), scope_e.LocalOnly)
+    self.assertEqual(['a', 'b:c'], splitter.SplitForWordEval('a b:c'))
+    mem.PopCall()
+    self.assertEqual(['a b', 'c'], splitter.SplitForWordEval('a b:c'))
+
+    mem.Unset(runtime.LhsName('IFS'), scope_e.Dynamic)
+    self.assertEqual(['a', 'b:c'], splitter.SplitForWordEval('a b:c'))
+
+    # Other variables don't invalidate the cache.
+    sp = splitter.cur_splitter
+    state.SetGlobalString(mem, 'x', 'y')
+    self.assertTrue(sp is splitter.cur_splitter)
+
+
+class SearchPathTest(unittest.TestCase):
+
+  def testCachedLookup(self):
+    mem = _InitMem()
+    search_path = state.SearchPath(mem)
+    self.assertEqual(None, search_path.CachedLookup('sh'))  # no $PATH
+
+    state.SetGlobalString(mem, 'PATH', '/nonexistent:/bin')
+    self.assertEqual('/bin/sh', search_path.CachedLookup('sh'))
+    self.assertEqual(['sh'], search_path.CachedCommands())
+    self.assertEqual(None, search_path.CachedLookup('/bin/sh'))
+
+    # Changing $PATH clears the cache.
+    state.SetGlobalString(mem, 'PATH', '/nonexistent')
+    self.assertEqual([], search_path.CachedCommands())
+    self.assertEqual(None, search_path.CachedLookup('sh'))
+
+    state.SetGlobalString(mem, 'PATH', '/bin')
+    search_path.CachedLookup('sh')
+    search_path.MaybeRemoveEntry('sh')
+    self.assertEqual([], search_path.CachedCommands())
+
+
 if __name__ == '__main__':
   unittest.main()
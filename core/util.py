@@ -10,6 +10,7 @@ util.py - Common infrastructure.
 """
 from __future__ import print_function
 
+import collections
 import cStringIO
 import os
 import pwd  # TODO: Move this dependency to Oil?
@@ -243,6 +244,33 @@ def ShowAppVersion(app_name):
   print('Bytecode: %s' % pyc_version)
 
 
+# The most entries a cache keyed by LST nodes holds.  Code from 'eval' and
+# 'source' creates new nodes, so an unbounded cache would keep them all alive.
+NODE_CACHE_SIZE = 10000
+
+
+class NodeCache(object):
+  """A dict that drops its oldest entry when it's full.
+
+  Get() is just a dict lookup, since it's called on every execution of a node.
+  An evicted node that's still in use is recomputed on its next lookup.
+  """
+
+  def __init__(self, max_size=NODE_CACHE_SIZE):
+    self.max_size = max_size
+    self.entries = collections.OrderedDict()
+    # OrderedDict doesn't override get(), so this is the fast C method.
+    self.Get = self.entries.get
+
+  def Put(self, key, value):
+    if key not in self.entries and len(self.entries) >= self.max_size:
+      self.entries.popitem(last=False)  # oldest
+    self.entries[key] = value
+
+  def __len__(self):
+    return len(self.entries)
+
+
 # This was useful for debugging.
 def ShowFdState():
   import subprocess
@@ -19,6 +19,21 @@ class UtilTest(unittest.TestCase):
   def testFoo(self):
     util.log('hello %d', 42)
 
+  def testNodeCache(self):
+    c = util.NodeCache(2)
+    c.Put('a', 1)
+    c.Put('b', None)
+    self.assertEqual(1, c.Get('a'))
+    self.assertEqual(None, c.Get('b', False))  # None is a valid value
+    self.assertEqual(False, c.Get('c', False))
+
+    c.Put('b', 2)  # replacing doesn't evict
+    self.assertEqual(1, c.Get('a'))
+    c.Put('c', 3)  # evicts the oldest
+    self.assertEqual(2, len(c))
+    self.assertEqual(None, c.Get('a'))
+    self.assertEqual(3, c.Get('c'))
+
 
 if __name__ == '__main__':
   unittest.main()
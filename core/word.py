@@ -11,6 +11,8 @@ p_die = util.p_die
 
 word_e = ast.word_e
 word_part_e = ast.word_part_e
+bracket_op_e = ast.bracket_op_e
+suffix_op_e = ast.suffix_op_e
 assign_op_e = ast.assign_op_e
 lhs_expr_e = ast.lhs_expr_e
 
@@ -104,6 +106,58 @@ def StaticEval(w):
   return True, ret, quoted
 
 
+def _IsPurePart(part):
+  """Helper for IsPureWord."""
+  if part.tag in (
+      word_part_e.LiteralPart, word_part_e.EscapedLiteralPart,
+      word_part_e.SingleQuotedPart, word_part_e.SimpleVarSub,
+      word_part_e.TildeSubPart):
+    return True
+
+  if part.tag == word_part_e.DoubleQuotedPart:
+    for p in part.parts:
+      if not _IsPurePart(p):
+        return False
+    return True
+
+  if part.tag == word_part_e.BracedVarSub:
+    # a[i++] is an arithmetic expression.
+    if part.bracket_op and part.bracket_op.tag == bracket_op_e.ArrayIndex:
+      return False
+
+    op = part.suffix_op
+    if op is None:
+      return True
+    if op.tag == suffix_op_e.StringNullary:
+      return True
+    if op.tag == suffix_op_e.StringUnary:
+      # ${x=default} assigns, and ${x?msg} is fatal.
+      if op.op_id in (Id.VTest_ColonEquals, Id.VTest_Equals,
+                      Id.VTest_ColonQMark, Id.VTest_QMark):
+        return False
+      return IsPureWord(op.arg_word)
+    if op.tag == suffix_op_e.PatSub:
+      return IsPureWord(op.pat) and (op.replace is None or
+                                     IsPureWord(op.replace))
+    return False  # Slice has arithmetic expressions
+
+  # Command subs, arithmetic, and extended globs.
+  return False
+
+
+def IsPureWord(w):
+  """Whether evaluating a word can't have side effects on the shell.
+
+  Examples of side effects: ${x=default}, $((i++)), and $(cd /).
+  """
+  if w.tag != word_e.CompoundWord:
+    return False
+  for part in w.parts:
+    if not _IsPurePart(part):
+      return False
+  return True
+
+
 def LeftMostSpanForPart(part):
   # TODO: Write unit tests in ui.py for error values
 
@@ -30,6 +30,14 @@ log = util.log
 e_die = util.e_die
 
 
+def _HasGlobChar(s):
+  """Whether glob_.LooksLikeGlob() could be true for a string containing s.
+
+  Cheaper than LooksLikeGlob(), and ] doesn't matter without [.
+  """
+  return '*' in s or '?' in s or '[' in s
+
+
 def _BackslashEscape(s):
   """Double up backslashes.
 
@@ -67,6 +75,65 @@ def _ValueToPartValue(val, quoted):
     raise AssertionError(val.__class__.__name__)
 
 
+def _StaticArgvValue(w, quoted=False):
+  """Evaluate a word whose value doesn't depend on the program state.
+
+  Such a word has no substitutions and no unquoted glob characters, e.g.
+  'echo', '-f', or "conftest.c".
+
+  Returns:
+    None if the word isn't constant.  Otherwise a 2-tuple of
+      s: the string value
+      unquoted: the unquoted text, which is still subject to IFS splitting
+  """
+  if not quoted and not w.parts:
+    return None  # elided, e.g. the empty alternative in {X,,Y}
+
+  strs = []
+  unquoted = []
+  for part in w.parts:
+    if part.tag == word_part_e.LiteralPart:
+      s = part.token.val
+      if not quoted:
+        # The lexer splits [b]in into several parts, so be conservative.
+        for c in s:
+          if c in '\\*?[':
+            return None
+        unquoted.append(s)
+
+    elif part.tag == word_part_e.EscapedLiteralPart:
+      s = part.token.val[1]
+
+    elif part.tag == word_part_e.SingleQuotedPart:
+      if part.left.id == Id.Left_SingleQuote:
+        s = ''.join(t.val for t in part.tokens)
+      elif part.left.id == Id.Left_DollarSingleQuote:
+        s = ''.join(word_compile.EvalCStringToken(t.id, t.val)
+                    for t in part.tokens)
+      else:
+        raise AssertionError(part.left.id)
+
+    elif part.tag == word_part_e.DoubleQuotedPart:
+      result = _StaticArgvValue(part, quoted=True)
+      if result is None:
+        return None
+      s = result[0]
+
+    else:  # substitutions, extended globs, etc.
+      return None
+
+    strs.append(s)
+
+  return ''.join(strs), ''.join(unquoted)
+
+
+def _IterStaticValues(words):
+  for w in words:
+    static = _StaticArgvValue(w)
+    if static is not None:  # None for elided words
+      yield static[0]
+
+
 def _MakeWordFrames(part_vals):
   """
   A word evaluates to a flat list of word parts (StringPartValue or
@@ -140,6 +207,15 @@ class _WordEvaluator(object):
     self.splitter = splitter
 
     self.globber = glob_.Globber(exec_opts)
+    # tuple of word parts -> (s, unquoted) or None.  See _StaticArgvValue.
+    # NOTE: Keyed by parts rather than words because big brace expansions
+    # aren't cached, and create new words on every evaluation.
+    self.static_argv = util.NodeCache()
+    self.brace_cache = braces.BraceCache()  # for array literals
+    # How many frames in _EvalWordFrame() were split and globbed, and how many
+    # took the fast path instead.  Logged to --debug-file at exit.
+    self.num_slow_frames = 0
+    self.num_fast_frames = 0
     # NOTE: Executor also instantiates one.
     self.arith_ev = expr_eval.ArithEvaluator(mem, exec_opts, self, arena)
 
@@ -667,19 +743,14 @@ class _WordEvaluator(object):
                   "The start index of a string slice can't be negative: %d",
                   begin, part=part)
 
-            byte_begin = libstr.AdvanceUtf8Chars(s, begin, 0)
-
-            if length is None:
-              byte_end = len(s)
-            else:
-              if length < 0:
-                # TODO: Instead of attributing it to the word part, it would be
-                # better if we attributed it to arith_expr begin.
-                raise util.InvalidSlice(
-                    "The length of a string slice can't be negative: %d",
-                    length, part=part)
+            if length is not None and length < 0:
+              # TODO: Instead of attributing it to the word part, it would be
+              # better if we attributed it to arith_expr begin.
+              raise util.InvalidSlice(
+                  "The length of a string slice can't be negative: %d",
+                  length, part=part)
 
-              byte_end = libstr.AdvanceUtf8Chars(s, length, byte_begin)
+            byte_begin, byte_end = libstr.Utf8Slice(s, begin, length)
 
           except (util.InvalidSlice, util.InvalidUtf8) as e:
             if self.exec_opts.strict_word_eval:
@@ -774,6 +845,8 @@ class _WordEvaluator(object):
       else:
         raise AssertionError(id_)
 
+      # The command may have changed the file system, e.g. $(touch foo).
+      self.globber.ClearCache()
       part_vals.append(v)
 
     elif part.tag == word_part_e.SimpleVarSub:
@@ -927,7 +1000,7 @@ class _WordEvaluator(object):
         word.parts[0].tag == word_part_e.ArrayLiteralPart):
 
       array_words = word.parts[0].words
-      words = braces.BraceExpandWords(array_words)
+      words = self.brace_cache.ExpandWords(array_words)
       strs = self._EvalWordSequence(words)
       #log('ARRAY LITERAL EVALUATED TO -> %s', strs)
       return runtime.StrArray(strs)
@@ -965,6 +1038,18 @@ class _WordEvaluator(object):
 
     will_glob = not self.exec_opts.noglob
 
+    # Fast path, e.g. for $x when x='foo.c'.  Quoted fragments never change.
+    # If the unquoted ones have no IFS or glob characters, then escaping,
+    # splitting, and globbing would give back the joined frame unchanged.
+    unquoted = ''.join(s for s, do_split_glob in frame if do_split_glob)
+    if (not self.splitter.CanSplit(unquoted) and
+        not (will_glob and _HasGlobChar(unquoted))):
+      self.num_fast_frames += 1
+      # This is '' for $empty"", which isn't elided.
+      argv.append(''.join(s for s, _ in frame))
+      return
+    self.num_slow_frames += 1
+
     # Array of strings, some of which are BOTH IFS-escaped and GLOB escaped!
     frags = []
     for frag, do_split_glob in frame:
@@ -1023,7 +1108,8 @@ class _WordEvaluator(object):
       argv: list of string arguments, or None if there was an eval error
     """
     # Parse time:
-    # 1. brace expansion.  TODO: Do at parse time.
+    # 1. brace expansion.  Detected at parse time, and expanded once per node
+    # by braces.BraceCache.
     # 2. Tilde detection.  DONE at parse time.  Only if Id.Lit_Tilde is the
     # first WordPart.
     #
@@ -1034,28 +1120,49 @@ class _WordEvaluator(object):
     # off for oil.
     # 5. globbing -- several exec_opts affect this: nullglob, safeglob, etc.
 
-    #log('W %s', words)
-    argv = []
-    for w in words:
-      part_vals = []
-      self._EvalWordToParts(w, False, part_vals)  # not double quoted
-
-      if 0:
-        log('')
-        log('part_vals after _EvalWordToParts:')
-        for entry in part_vals:
-          log('  %s', entry)
-
-      frames = _MakeWordFrames(part_vals)
-      if 0:
-        log('')
-        log('frames after _MakeWordFrames:')
-        for entry in frames:
-          log('  %s', entry)
-
-      # Now each frame will append zero or more args.
-      for frame in frames:
-        self._EvalWordFrame(frame, argv)
+    # Directory listings are cached only while evaluating one sequence of
+    # words, e.g. the argv of one command or one array literal.
+    self.globber.ClearCache()
+    try:
+      #log('W %s', words)
+      argv = []
+      for w in words:
+        # Fast path for constant words like 'rm -f conftest.c'.  Their value is
+        # computed once, and only IFS splitting is checked at runtime.
+        if w.tag == word_e.CompoundWord:
+          key = tuple(w.parts)
+          static = self.static_argv.Get(key, False)
+          if static is False:
+            static = _StaticArgvValue(w)
+            self.static_argv.Put(key, static)
+
+          if static is not None:
+            s, unquoted = static
+            if not unquoted or not self.splitter.CanSplit(unquoted):
+              argv.append(s)
+              continue
+
+        part_vals = []
+        self._EvalWordToParts(w, False, part_vals)  # not double quoted
+
+        if 0:
+          log('')
+          log('part_vals after _EvalWordToParts:')
+          for entry in part_vals:
+            log('  %s', entry)
+
+        frames = _MakeWordFrames(part_vals)
+        if 0:
+          log('')
+          log('frames after _MakeWordFrames:')
+          for entry in frames:
+            log('  %s', entry)
+
+        # Now each frame will append zero or more args.
+        for frame in frames:
+          self._EvalWordFrame(frame, argv)
+    finally:
+      self.globber.ClearCache()
 
     #log('ARGV %s', argv)
     return argv
@@ -1064,9 +1171,72 @@ class _WordEvaluator(object):
     """
     Used in: SimpleCommand, ForEach.
     """
-    # TODO: Remove this stub
     return self._EvalWordSequence(words)
 
+  def IterSplitGlob(self, chunks):
+    """Split and glob the output of a command sub as it's read.
+
+    Like evaluating an unquoted $(cmd), but each chunk is cut at a point where
+    splitting is unaffected (see IfsSplitter.SplitPoint), and the fields
+    before it are returned right away.
+
+    Args:
+      chunks: iterator of strings read from the command sub
+
+    Returns:
+      An iterator over the resulting strings.
+    """
+    pending = []  # chunks that haven't been split yet
+    for chunk in chunks:
+      # The cut can also be right before the chunk.
+      prev = pending[-1][-1:] if pending else ''
+      i = self.splitter.SplitPoint(prev + chunk)
+      if i == 0:
+        pending.append(chunk)
+        continue
+      i -= len(prev)
+      pending.append(chunk[:i])
+      s = ''.join(pending)
+      pending = [chunk[i:]] if i < len(chunk) else []
+      for arg in self._SplitGlobString(s):
+        yield arg
+
+    # The end of the output, where trailing newlines are removed.
+    s = ''.join(pending).rstrip('\n')
+    for arg in self._SplitGlobString(s):
+      yield arg
+
+  def _SplitGlobString(self, s):
+    argv = []
+    self.globber.ClearCache()
+    try:
+      self._EvalWordFrame([(s, True)], argv)
+    finally:
+      self.globber.ClearCache()
+    return argv
+
+  def IterStaticWords(self, words):
+    """Evaluate brace-expanded words lazily, if they're all constant.
+
+    This is for 'for i in {a,b}{1,2,3}...' loops whose expansion is too big to
+    keep in memory.  Every part must be a constant that IFS doesn't split,
+    which is checked before the first word is returned.  So the values don't
+    depend on anything the loop body does.
+
+    Returns:
+      None if the words aren't constant.  Otherwise an iterator over the
+      strings that EvalWordSequence(BraceExpandWords(words)) would return.
+    """
+    unquoted = []
+    for part in braces.LeafParts(words):
+      static = _StaticArgvValue(ast.CompoundWord([part]))
+      if static is None:
+        return None
+      unquoted.append(static[1])
+    if self.splitter.CanSplit(''.join(unquoted)):
+      return None
+    return _IterStaticValues(braces.IterBraceExpandWords(words))
+
 
 class NormalWordEvaluator(_WordEvaluator):
 
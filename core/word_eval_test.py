@@ -10,9 +10,14 @@ word_eval_test.py: Tests for word_eval.py
 """
 from __future__ import print_function
 
+import os
+import shutil
+import tempfile
 import unittest
 
 from core import word_eval  # module under test
+from core import cmd_exec_test
+from core import state
 
 
 class WordEvalTest(unittest.TestCase):
@@ -20,6 +25,78 @@ class WordEvalTest(unittest.TestCase):
   def testWordEval(self):
     print(word_eval)
 
+  def testStaticArgvValue(self):
+    c_parser = cmd_exec_test.InitCommandParser(
+        """echo -f a'b c'"d" $'\\t' \\* x$y *.c ~ @(a|b)""")
+    node = c_parser.ParseLogicalLine()
+    values = [word_eval._StaticArgvValue(w) for w in node.words]
+    self.assertEqual(
+        [('echo', 'echo'), ('-f', '-f'), ('ab cd', 'a'), ('\t', ''),
+         ('*', ''), None, None, None, None],
+        values)
+
+  def testSplitFastPath(self):
+    ex = cmd_exec_test.InitExecutor()
+    state.SetGlobalString(ex.mem, 'x', 'foo.c')
+    state.SetGlobalString(ex.mem, 'y', 'a b')
+    state.SetGlobalString(ex.mem, 'z', '*.c')
+    state.SetGlobalString(ex.mem, 'empty', '')
+
+    CASES = [
+        ('$x', ['foo.c'], True),
+        ('$x"a b"$x', ['foo.ca bfoo.c'], True),
+        ('$empty""', [''], True),
+        ('$y', ['a', 'b'], False),
+        ('$z', ['*.c'], False),  # nothing matches
+        ('"$z"x', ['*.cx'], True),
+    ]
+    for code_str, expected, fast in CASES:
+      c_parser = cmd_exec_test.InitCommandParser('echo ' + code_str)
+      node = c_parser.ParseLogicalLine()
+      before = ex.word_ev.num_fast_frames
+      slow_before = ex.word_ev.num_slow_frames
+      argv = ex.word_ev.EvalWordSequence(node.words[1:])
+      self.assertEqual(expected, argv, code_str)
+      self.assertEqual(fast, ex.word_ev.num_fast_frames > before, code_str)
+      self.assertEqual(not fast, ex.word_ev.num_slow_frames > slow_before,
+                       code_str)
+
+  def testIterSplitGlob(self):
+    ex = cmd_exec_test.InitExecutor()
+    word_ev = ex.word_ev
+
+    outputs = ['', '\n', 'a b\nc\n', ' a  b ', 'a::b:\n\n', 'a : b:', ':a\n:']
+    for ifs in [None, ' ', ':', ' :']:
+      if ifs is not None:
+        state.SetGlobalString(ex.mem, 'IFS', ifs)
+      for s in outputs:
+        expected = word_ev._SplitGlobString(s.rstrip('\n'))
+        # Every way of cutting it into 3 chunks.
+        for i in xrange(len(s) + 1):
+          for j in xrange(i, len(s) + 1):
+            chunks = [s[:i], s[i:j], s[j:]]
+            self.assertEqual(expected, list(word_ev.IterSplitGlob(chunks)),
+                             '%r %r' % (ifs, chunks))
+
+  def testArrayLiteralGlob(self):
+    # Directory listings aren't reused by the next array literal.
+    ex = cmd_exec_test.InitExecutor()
+    d = tempfile.mkdtemp()
+    try:
+      open(os.path.join(d, 'a.c'), 'w').close()
+      c_parser = cmd_exec_test.InitCommandParser('x=(%s/*.c)' % d)
+      node = c_parser.ParseLogicalLine()
+      rhs = node.pairs[0].rhs
+
+      self.assertEqual([d + '/a.c'], ex.word_ev.EvalRhsWord(rhs).strs)
+      self.assertEqual({}, ex.word_ev.globber.listings)
+
+      open(os.path.join(d, 'b.c'), 'w').close()
+      self.assertEqual([d + '/a.c', d + '/b.c'],
+                       ex.word_ev.EvalRhsWord(rhs).strs)
+    finally:
+      shutil.rmtree(d)
+
 
 if __name__ == '__main__':
   unittest.main()
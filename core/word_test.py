@@ -96,6 +96,24 @@ class WordTest(unittest.TestCase):
     #w = assertReadWord(self, 'a[x]=(1 2 3)')
     #w = assertReadWord(self, 'a[x]+=(1 2 3)')
 
+  def testIsPureWord(self):
+    CASES = [
+        ('foo', True),
+        ("'a b'\"$x\"", True),
+        ('${x:-default}', True),
+        ('${x#*/}${a[@]}', True),
+        ('~/src', True),
+        ('${x:=default}', False),
+        ('${x?msg}', False),
+        ('${a[i++]}', False),
+        ('$((i++))', False),
+        ('$(cd /)', False),
+        ('"${x:-$(cd /)}"', False),
+    ]
+    for word_str, expected in CASES:
+      w = word_parse_test._assertReadWord(self, word_str)
+      self.assertEqual(expected, word.IsPureWord(w), word_str)
+
 
 if __name__ == '__main__':
   unittest.main()
@@ -2,25 +2,34 @@
  * Python interface to libc functions.
  */
 
+// Python.h has to come before any standard header.  Its pyconfig.h defines
+// _GNU_SOURCE, which enables GNU extensions in fnmatch.h, and pipe2() in
+// unistd.h.
+// TODO: Need a configure option for this.
+#include <Python.h>
+
 #include <stdarg.h>  // va_list, etc.
+#include <stdint.h>  // uint64_t
 #include <stdio.h>  // printf
 #include <limits.h>
 #include <stdlib.h>
 
-// Enable GNU extensions in fnmatch.h.
-// TODO: Need a configure option for this.
-#define _GNU_SOURCE 1
-
+#include <dirent.h>  // opendir, readdir
+#include <errno.h>
+#include <fcntl.h>  // O_CLOEXEC
 #include <fnmatch.h>
 #include <glob.h>
+#include <signal.h>
+#include <spawn.h>
+#include <string.h>  // memset
+#include <sys/stat.h>  // lstat
+#include <unistd.h>  // pipe2
 #ifdef __FreeBSD__
 #include <gnu/posix/regex.h>
 #else
 #include <regex.h>
 #endif
 
-#include <Python.h>
-
 // Log messages to stderr.
 static void debug(const char* fmt, ...) {
 #ifdef LIBC_VERBOSE
@@ -157,6 +166,128 @@ func_glob(PyObject *self, PyObject *args) {
   return matches;
 }
 
+// Return the names in a list that match a pattern, with the same fnmatch()
+// flags that glob() uses.  This lets the Globber match many patterns against
+// one directory listing, without calling back into Python for every name.
+//
+// With dotglob, a leading dot doesn't have to be matched explicitly, but . and
+// .. still do, like bash's shopt -s dotglob.
+static PyObject *
+func_glob_filter(PyObject *self, PyObject *args) {
+  const char* pattern;
+  PyObject* names;
+  int dotglob = 0;
+  if (!PyArg_ParseTuple(args, "sO!|i", &pattern, &PyList_Type, &names,
+                        &dotglob)) {
+    return NULL;
+  }
+
+  int flags = dotglob ? 0 : FNM_PERIOD;
+  int skip_dot_dirs = dotglob && pattern[0] != '.';
+
+  PyObject* matches = PyList_New(0);
+  if (matches == NULL) {
+    return NULL;
+  }
+
+  Py_ssize_t n = PyList_GET_SIZE(names);
+  Py_ssize_t i;
+  for (i = 0; i < n; i++) {
+    PyObject* name = PyList_GET_ITEM(names, i);
+    const char* s = PyString_AsString(name);
+    if (s == NULL) {
+      Py_DECREF(matches);
+      return NULL;
+    }
+    if (skip_dot_dirs && (strcmp(s, ".") == 0 || strcmp(s, "..") == 0)) {
+      continue;
+    }
+    if (fnmatch(pattern, s, flags) == 0) {
+      if (PyList_Append(matches, name) < 0) {
+        Py_DECREF(matches);
+        return NULL;
+      }
+    }
+  }
+  return matches;
+}
+
+// Like os.listdir(), but also return the names of entries that are
+// directories, from d_type.  We only call lstat() if the file system doesn't
+// fill in d_type.  Symlinks to directories are NOT included, since recursive
+// globbing doesn't follow them.
+static PyObject *
+func_scandir(PyObject *self, PyObject *args) {
+  const char* path;
+  if (!PyArg_ParseTuple(args, "s", &path)) {
+    return NULL;
+  }
+
+  DIR* dir = opendir(path);
+  if (dir == NULL) {
+    return PyErr_SetFromErrnoWithFilename(PyExc_OSError, (char*)path);
+  }
+
+  PyObject* names = PyList_New(0);
+  PyObject* subdirs = PyList_New(0);
+  if (names == NULL || subdirs == NULL) {
+    goto error;
+  }
+
+  size_t path_len = strlen(path);
+  while (1) {
+    errno = 0;
+    struct dirent* ent = readdir(dir);
+    if (ent == NULL) {
+      if (errno != 0) {
+        PyErr_SetFromErrnoWithFilename(PyExc_OSError, (char*)path);
+        goto error;
+      }
+      break;
+    }
+
+    const char* d_name = ent->d_name;
+    if (strcmp(d_name, ".") == 0 || strcmp(d_name, "..") == 0) {
+      continue;  // like os.listdir()
+    }
+
+    int is_dir;
+    if (ent->d_type == DT_UNKNOWN) {
+      size_t n = path_len + 1 + strlen(d_name) + 1;
+      char* full = malloc(n);
+      if (full == NULL) {
+        PyErr_NoMemory();
+        goto error;
+      }
+      snprintf(full, n, "%s/%s", path, d_name);
+      struct stat st;
+      is_dir = lstat(full, &st) == 0 && S_ISDIR(st.st_mode);
+      free(full);
+    } else {
+      is_dir = ent->d_type == DT_DIR;
+    }
+
+    PyObject* name = PyString_FromString(d_name);
+    if (name == NULL) {
+      goto error;
+    }
+    int ok = PyList_Append(names, name) == 0 &&
+             (!is_dir || PyList_Append(subdirs, name) == 0);
+    Py_DECREF(name);
+    if (!ok) {
+      goto error;
+    }
+  }
+  closedir(dir);
+  return Py_BuildValue("(NN)", names, subdirs);
+
+error:
+  closedir(dir);
+  Py_XDECREF(names);
+  Py_XDECREF(subdirs);
+  return NULL;
+}
+
 static PyObject *
 func_regex_parse(PyObject *self, PyObject *args) {
   const char* pattern;
@@ -250,32 +381,20 @@ func_regex_parse(PyObject *self, PyObject *args) {
   }
 }
 
+// Match a compiled regex against a string.  Returns a list of the whole match
+// and each group, or None if there's no match.
 static PyObject *
-func_regex_match(PyObject *self, PyObject *args) {
-  const char* pattern;
-  const char* str;
-  if (!PyArg_ParseTuple(args, "ss", &pattern, &str)) {
-    return NULL;
-  }
-
-  regex_t pat;
-  if (regcomp(&pat, pattern, REG_EXTENDED) != 0) {
-    // When the regex contains a variable, it can't be checked at compile-time.
-    PyErr_SetString(PyExc_RuntimeError, "Invalid regex syntax (func_regex_match)");
-    return NULL;
-  }
-
-  int outlen = pat.re_nsub + 1;
+regex_match_groups(regex_t *pat, const char* str) {
+  int outlen = pat->re_nsub + 1;
   PyObject *ret = PyList_New(outlen);
 
   if (ret == NULL) {
-    regfree(&pat);
     return NULL;
   }
 
   int match;
   regmatch_t *pmatch = (regmatch_t*) malloc(sizeof(regmatch_t) * outlen);
-  if (match = (regexec(&pat, str, outlen, pmatch, 0) == 0)) {
+  if (match = (regexec(pat, str, outlen, pmatch, 0) == 0)) {
     int i;
     for (i = 0; i < outlen; i++) {
       int len = pmatch[i].rm_eo - pmatch[i].rm_so;
@@ -285,15 +404,35 @@ func_regex_match(PyObject *self, PyObject *args) {
   }
 
   free(pmatch);
-  regfree(&pat);
 
   if (!match) {
+    Py_DECREF(ret);
     Py_RETURN_NONE;
   }
 
   return ret;
 }
 
+static PyObject *
+func_regex_match(PyObject *self, PyObject *args) {
+  const char* pattern;
+  const char* str;
+  if (!PyArg_ParseTuple(args, "ss", &pattern, &str)) {
+    return NULL;
+  }
+
+  regex_t pat;
+  if (regcomp(&pat, pattern, REG_EXTENDED) != 0) {
+    // When the regex contains a variable, it can't be checked at compile-time.
+    PyErr_SetString(PyExc_RuntimeError, "Invalid regex syntax (func_regex_match)");
+    return NULL;
+  }
+
+  PyObject *ret = regex_match_groups(&pat, str);
+  regfree(&pat);
+  return ret;
+}
+
 // For ${//}, the number of groups is always 1, so we want 2 match position
 // results -- the whole regex (which we ignore), and then first group.
 //
@@ -301,6 +440,27 @@ func_regex_match(PyObject *self, PyObject *args) {
 
 #define NMATCH 2
 
+// Returns the (start, end) of the first group, matching at offset 'pos', or
+// None if there's no match.
+static PyObject *
+regex_first_group(regex_t *pat, const char* str, int pos) {
+  regmatch_t m[NMATCH];
+
+  debug("first_group_match str %s pos %d", str, pos);
+
+  // Match at offset 'pos'
+  int result = regexec(pat, str + pos, NMATCH, m, 0 /*flags*/);
+
+  if (result != 0) {
+    Py_RETURN_NONE;  // no match
+  }
+
+  // Assume there is a match
+  regoff_t start = m[1].rm_so;
+  regoff_t end = m[1].rm_eo;
+  return Py_BuildValue("(i,i)", pos + start, pos + end);
+}
+
 static PyObject *
 func_regex_first_group_match(PyObject *self, PyObject *args) {
   const char* pattern;
@@ -311,7 +471,6 @@ func_regex_first_group_match(PyObject *self, PyObject *args) {
   }
 
   regex_t pat;
-  regmatch_t m[NMATCH];
 
   // Could have been checked by regex_parse for [[ =~ ]], but not for glob
   // patterns like ${foo/x*/y}.
@@ -322,20 +481,659 @@ func_regex_first_group_match(PyObject *self, PyObject *args) {
     return NULL;
   }
 
-  debug("first_group_match pat %s str %s pos %d", pattern, str, pos);
-
-  // Match at offset 'pos'
-  int result = regexec(&pat, str + pos, NMATCH, m, 0 /*flags*/);
+  PyObject *ret = regex_first_group(&pat, str, pos);
   regfree(&pat);
+  return ret;
+}
 
-  if (result != 0) {
-    Py_RETURN_NONE;  // no match
+// A regex that's compiled once and matched many times, e.g. ${x//a*/b} in a
+// loop.  Returned by regex_compile().
+typedef struct {
+  PyObject_HEAD
+  regex_t pat;
+  int compiled;  // whether pat needs regfree()
+} RegexObject;
+
+static void
+Regex_dealloc(RegexObject *self) {
+  if (self->compiled) {
+    regfree(&self->pat);
   }
+  PyObject_Del(self);
+}
 
-  // Assume there is a match
-  regoff_t start = m[1].rm_so;
-  regoff_t end = m[1].rm_eo;
-  return Py_BuildValue("(i,i)", pos + start, pos + end);
+static PyObject *
+Regex_match(RegexObject *self, PyObject *args) {
+  const char* str;
+  if (!PyArg_ParseTuple(args, "s", &str)) {
+    return NULL;
+  }
+  return regex_match_groups(&self->pat, str);
+}
+
+static PyObject *
+Regex_first_group_match(RegexObject *self, PyObject *args) {
+  const char* str;
+  int pos;
+  if (!PyArg_ParseTuple(args, "si", &str, &pos)) {
+    return NULL;
+  }
+  return regex_first_group(&self->pat, str, pos);
+}
+
+static PyMethodDef Regex_methods[] = {
+  {"match", (PyCFunction)Regex_match, METH_VARARGS,
+   "match(s) -> list of the match and its groups, or None.  Like "
+   "regex_match()."},
+  {"first_group_match", (PyCFunction)Regex_first_group_match, METH_VARARGS,
+   "first_group_match(s, pos) -> (start, end) or None.  Like "
+   "regex_first_group_match()."},
+  {NULL, NULL},
+};
+
+static PyTypeObject RegexType = {
+  PyVarObject_HEAD_INIT(NULL, 0)
+  .tp_name = "libc.Regex",
+  .tp_basicsize = sizeof(RegexObject),
+  .tp_dealloc = (destructor)Regex_dealloc,
+  .tp_flags = Py_TPFLAGS_DEFAULT,
+  .tp_doc = "A compiled POSIX extended regex.",
+  .tp_methods = Regex_methods,
+};
+
+// For ${x##pat} and ${x%%pat}.  'search' is the regex anchored at the start
+// for a prefix, or at the end for a suffix.
+//
+// POSIX regexes find the leftmost-longest match, which directly gives the
+// longest prefix and the longest suffix in one pass.  Like the fnmatch() loop,
+// an empty match doesn't count.
+//
+// Returns the index to cut the string at, or -1 if nothing matched.
+static PyObject *
+func_regex_strip(PyObject *self, PyObject *args) {
+  RegexObject *search;
+  const char* str;
+  int is_suffix;
+  if (!PyArg_ParseTuple(args, "O!si", &RegexType, &search, &str,
+                        &is_suffix)) {
+    return NULL;
+  }
+
+  regmatch_t m[1];
+  if (regexec(&search->pat, str, 1, m, 0) != 0) {
+    return PyInt_FromLong(-1);
+  }
+
+  if (!is_suffix) {
+    int longest = m[0].rm_eo;  // the match starts at 0
+    return PyInt_FromLong(longest == 0 ? -1 : longest);
+  } else {
+    int leftmost = m[0].rm_so;  // the match ends at the end of the string
+    return PyInt_FromLong(str[leftmost] == '\0' ? -1 : leftmost);
+  }
+}
+
+static PyObject *
+func_regex_compile(PyObject *self, PyObject *args) {
+  const char* pattern;
+  if (!PyArg_ParseTuple(args, "s", &pattern)) {
+    return NULL;
+  }
+
+  RegexObject *r = PyObject_New(RegexObject, &RegexType);
+  if (r == NULL) {
+    return NULL;
+  }
+  r->compiled = 0;
+
+  if (regcomp(&r->pat, pattern, REG_EXTENDED) != 0) {
+    Py_DECREF(r);
+    PyErr_SetString(PyExc_RuntimeError,
+                    "Invalid regex syntax (func_regex_compile)");
+    return NULL;
+  }
+  r->compiled = 1;
+  return (PyObject *)r;
+}
+
+// Convert a list of Python strings to a NULL-terminated array for exec().
+// The strings are borrowed from the list.  Returns NULL with an exception set
+// on error.
+static char **
+list_to_argv(PyObject *list) {
+  Py_ssize_t n = PyList_Size(list);
+  char **result = PyMem_New(char *, n + 1);
+  if (result == NULL) {
+    PyErr_NoMemory();
+    return NULL;
+  }
+  Py_ssize_t i;
+  for (i = 0; i < n; ++i) {
+    result[i] = PyString_AsString(PyList_GetItem(list, i));
+    if (result[i] == NULL) {  // not a string
+      PyMem_Free(result);
+      return NULL;
+    }
+  }
+  result[n] = NULL;
+  return result;
+}
+
+// Start a program without forking the interpreter.  glibc implements this with
+// clone(CLONE_VM | CLONE_VFORK), so the cost doesn't grow with the size of our
+// heap, like fork() does.
+//
+// fd_actions is a list of (fd, new_fd) pairs, applied in order in the child.
+// new_fd == -1 means close(fd), and otherwise it's dup2(fd, new_fd).
+static PyObject *
+func_posix_spawn(PyObject *self, PyObject *args) {
+  const char *path;
+  PyObject *py_argv;
+  PyObject *py_envp;
+  PyObject *py_fd_actions;
+
+  if (!PyArg_ParseTuple(args, "sO!O!O!", &path, &PyList_Type, &py_argv,
+                        &PyList_Type, &py_envp, &PyList_Type,
+                        &py_fd_actions)) {
+    return NULL;
+  }
+
+  posix_spawn_file_actions_t file_actions;
+  posix_spawn_file_actions_init(&file_actions);
+
+  // Python ignores SIGPIPE, and the child would inherit that.
+  posix_spawnattr_t attr;
+  posix_spawnattr_init(&attr);
+  sigset_t sig_default;
+  sigemptyset(&sig_default);
+  sigaddset(&sig_default, SIGPIPE);
+  posix_spawnattr_setsigdefault(&attr, &sig_default);
+  posix_spawnattr_setflags(&attr, POSIX_SPAWN_SETSIGDEF);
+
+  char **argv = NULL;
+  char **envp = NULL;
+  PyObject *result = NULL;
+
+  Py_ssize_t n = PyList_Size(py_fd_actions);
+  Py_ssize_t i;
+  for (i = 0; i < n; ++i) {
+    int fd, new_fd;
+    if (!PyArg_ParseTuple(PyList_GetItem(py_fd_actions, i), "ii", &fd,
+                          &new_fd)) {
+      goto done;
+    }
+    if (new_fd == -1) {
+      posix_spawn_file_actions_addclose(&file_actions, fd);
+    } else {
+      posix_spawn_file_actions_adddup2(&file_actions, fd, new_fd);
+    }
+  }
+
+  argv = list_to_argv(py_argv);
+  if (argv == NULL) {
+    goto done;
+  }
+  envp = list_to_argv(py_envp);
+  if (envp == NULL) {
+    goto done;
+  }
+
+  pid_t pid;
+  int ret = posix_spawn(&pid, path, &file_actions, &attr, argv, envp);
+  if (ret != 0) {
+    errno = ret;
+    PyErr_SetFromErrno(PyExc_OSError);
+    goto done;
+  }
+  result = PyInt_FromLong(pid);
+
+done:
+  PyMem_Free(argv);
+  PyMem_Free(envp);
+  posix_spawn_file_actions_destroy(&file_actions);
+  posix_spawnattr_destroy(&attr);
+  return result;
+}
+
+// Create a pipe whose ends aren't inherited across exec().  Unlike os.pipe()
+// followed by fcntl(), there's no window where another child can inherit them.
+static PyObject *
+func_pipe_cloexec(PyObject *self, PyObject *unused) {
+  int fds[2];
+  if (pipe2(fds, O_CLOEXEC) < 0) {
+    return PyErr_SetFromErrno(PyExc_OSError);
+  }
+  return Py_BuildValue("(i,i)", fds[0], fds[1]);
+}
+
+// IFS splitting.  This is the state machine in core/legacy.py, which is the
+// reference implementation.  The character kinds, states, and actions have
+// the same names as the CH, ST, and EMIT enums there.
+
+enum { CH_DE_WHITE, CH_DE_GRAY, CH_BLACK, CH_BACKSLASH };
+
+enum {
+  ST_START, ST_DE_WHITE1, ST_DE_GRAY, ST_DE_WHITE2, ST_BLACK, ST_BACKSLASH,
+  ST_INVALID
+};
+
+enum { EMIT_NOTHING, EMIT_PART, EMIT_DELIM, EMIT_EMPTY, EMIT_ESCAPE };
+
+// The same values as _NATIVE_SPAN_KINDS in core/legacy.py.
+enum { SPAN_BLACK, SPAN_DELIM, SPAN_BACKSLASH };
+
+typedef struct {
+  unsigned char state;
+  unsigned char action;
+} transition_t;
+
+// Indexed by [state][char kind].  Same as legacy.TRANSITIONS.
+static const transition_t kTransitions[6][4] = {
+  /* ST_START */ {
+    {ST_INVALID, EMIT_NOTHING}, {ST_DE_GRAY, EMIT_EMPTY},
+    {ST_BLACK, EMIT_NOTHING}, {ST_BACKSLASH, EMIT_NOTHING},
+  },
+  /* ST_DE_WHITE1 */ {
+    {ST_DE_WHITE1, EMIT_NOTHING}, {ST_DE_GRAY, EMIT_NOTHING},
+    {ST_BLACK, EMIT_DELIM}, {ST_BACKSLASH, EMIT_DELIM},
+  },
+  /* ST_DE_GRAY */ {
+    {ST_DE_WHITE2, EMIT_NOTHING}, {ST_DE_GRAY, EMIT_EMPTY},
+    {ST_BLACK, EMIT_DELIM}, {ST_BLACK, EMIT_DELIM},
+  },
+  /* ST_DE_WHITE2 */ {
+    {ST_DE_WHITE2, EMIT_NOTHING}, {ST_DE_GRAY, EMIT_EMPTY},
+    {ST_BLACK, EMIT_DELIM}, {ST_BACKSLASH, EMIT_DELIM},
+  },
+  /* ST_BLACK */ {
+    {ST_DE_WHITE1, EMIT_PART}, {ST_DE_GRAY, EMIT_PART},
+    {ST_BLACK, EMIT_NOTHING}, {ST_BACKSLASH, EMIT_PART},
+  },
+  /* ST_BACKSLASH */ {
+    {ST_BLACK, EMIT_ESCAPE}, {ST_BLACK, EMIT_ESCAPE},
+    {ST_BLACK, EMIT_ESCAPE}, {ST_BLACK, EMIT_ESCAPE},
+  },
+};
+
+// Same as legacy.LAST_SPAN_ACTION.  ST_START can't be the last state.
+static const unsigned char kLastSpanAction[6] = {
+  EMIT_NOTHING, EMIT_NOTHING, EMIT_DELIM, EMIT_DELIM, EMIT_PART, EMIT_ESCAPE
+};
+
+typedef struct {
+  unsigned char kind;  // SPAN_*
+  Py_ssize_t end;
+} ifs_span_t;
+
+// Split s into spans, like IfsSplitter.Split().  spans must have room for
+// 2 * n + 1 entries.  Returns the number of spans, or -1 with an exception
+// set.
+static Py_ssize_t
+ifs_split_spans(const char *s, Py_ssize_t n, const char *ws, const char *other,
+                int allow_escape, ifs_span_t *spans) {
+  Py_ssize_t num_spans = 0;
+  if (n == 0) {
+    return 0;
+  }
+
+  // Classify the characters once, checking in the same order as Python.
+  unsigned char kinds[256];
+  memset(kinds, CH_BLACK, sizeof(kinds));
+  if (allow_escape) {
+    kinds['\\'] = CH_BACKSLASH;
+  }
+  const char *p;
+  for (p = other; *p; ++p) {
+    kinds[(unsigned char)*p] = CH_DE_GRAY;
+  }
+  for (p = ws; *p; ++p) {
+    kinds[(unsigned char)*p] = CH_DE_WHITE;
+  }
+
+  // Ignore leading whitespace.
+  Py_ssize_t i = 0;
+  while (i < n && kinds[(unsigned char)s[i]] == CH_DE_WHITE) {
+    ++i;
+  }
+  if (i != 0) {
+    spans[num_spans].kind = SPAN_DELIM;
+    spans[num_spans++].end = i;
+  }
+  if (i == n) {
+    return num_spans;
+  }
+
+  int state = ST_START;
+  for (; i < n; ++i) {
+    transition_t t = kTransitions[state][kinds[(unsigned char)s[i]]];
+    if (t.state == ST_INVALID) {
+      PyErr_SetString(PyExc_AssertionError, "Invalid IFS transition");
+      return -1;
+    }
+    switch (t.action) {
+    case EMIT_PART:
+      spans[num_spans].kind = SPAN_BLACK;
+      spans[num_spans++].end = i;
+      break;
+    case EMIT_DELIM:
+      spans[num_spans].kind = SPAN_DELIM;
+      spans[num_spans++].end = i;
+      break;
+    case EMIT_EMPTY:
+      spans[num_spans].kind = SPAN_DELIM;
+      spans[num_spans++].end = i;
+      spans[num_spans].kind = SPAN_BLACK;
+      spans[num_spans++].end = i;
+      break;
+    case EMIT_ESCAPE:
+      spans[num_spans].kind = SPAN_BACKSLASH;
+      spans[num_spans++].end = i;
+      break;
+    }
+    state = t.state;
+  }
+
+  switch (kLastSpanAction[state]) {
+  case EMIT_PART:
+    spans[num_spans].kind = SPAN_BLACK;
+    spans[num_spans++].end = n;
+    break;
+  case EMIT_DELIM:
+    spans[num_spans].kind = SPAN_DELIM;
+    spans[num_spans++].end = n;
+    break;
+  case EMIT_ESCAPE:
+    spans[num_spans].kind = SPAN_BACKSLASH;
+    spans[num_spans++].end = n;
+    break;
+  }
+  return num_spans;
+}
+
+// Returns (s, n, spans, num_spans), or NULL with an exception set.
+static ifs_span_t *
+parse_and_split(PyObject *args, const char **s, Py_ssize_t *n,
+                Py_ssize_t *num_spans) {
+  const char *ws;
+  const char *other;
+  int allow_escape;
+  int len;
+  if (!PyArg_ParseTuple(args, "s#ssi", s, &len, &ws, &other,
+                        &allow_escape)) {
+    return NULL;
+  }
+  *n = len;
+
+  // Each character emits at most 2 spans, but the first one can't emit any,
+  // and there's one more at the end.
+  ifs_span_t *spans = PyMem_New(ifs_span_t, 2 * (*n) + 1);
+  if (spans == NULL) {
+    PyErr_NoMemory();
+    return NULL;
+  }
+  *num_spans = ifs_split_spans(*s, *n, ws, other, allow_escape, spans);
+  if (*num_spans < 0) {
+    PyMem_Free(spans);
+    return NULL;
+  }
+  return spans;
+}
+
+static PyObject *
+func_ifs_spans(PyObject *self, PyObject *args) {
+  const char *s;
+  Py_ssize_t n, num_spans;
+  ifs_span_t *spans = parse_and_split(args, &s, &n, &num_spans);
+  if (spans == NULL) {
+    return NULL;
+  }
+
+  PyObject *result = PyList_New(num_spans);
+  Py_ssize_t i;
+  for (i = 0; result != NULL && i < num_spans; ++i) {
+    PyObject *pair = Py_BuildValue("(i,n)", spans[i].kind, spans[i].end);
+    if (pair == NULL) {
+      Py_CLEAR(result);
+      break;
+    }
+    PyList_SET_ITEM(result, i, pair);
+  }
+  PyMem_Free(spans);
+  return result;
+}
+
+// Append the field in buf to the list.  Returns 0 on success.
+static int
+append_field(PyObject *fields, const char *buf, Py_ssize_t len) {
+  PyObject *field = PyString_FromStringAndSize(buf, len);
+  if (field == NULL) {
+    return -1;
+  }
+  int ret = PyList_Append(fields, field);
+  Py_DECREF(field);
+  return ret;
+}
+
+// Like legacy._SpansToParts(s, IfsSplitter.Split(...)), without creating the
+// spans as Python objects.
+static PyObject *
+func_ifs_split(PyObject *self, PyObject *args) {
+  const char *s;
+  Py_ssize_t n, num_spans;
+  ifs_span_t *spans = parse_and_split(args, &s, &n, &num_spans);
+  if (spans == NULL) {
+    return NULL;
+  }
+
+  PyObject *fields = PyList_New(0);
+  // The current field.  Fields that are joined by backslashes are
+  // concatenated here, and it's never longer than s.
+  char *buf = PyMem_Malloc(n + 1);
+  if (fields == NULL || buf == NULL) {
+    Py_XDECREF(fields);
+    PyMem_Free(buf);
+    PyMem_Free(spans);
+    return PyErr_NoMemory();
+  }
+  Py_ssize_t buf_len = 0;
+  int have_field = 0;
+
+  Py_ssize_t start = 0;
+  int join_next = 0;
+  int last_span_was_black = 0;
+  Py_ssize_t i;
+  for (i = 0; i < num_spans; ++i) {
+    Py_ssize_t end = spans[i].end;
+    switch (spans[i].kind) {
+    case SPAN_BLACK:
+      if (have_field && join_next) {
+        join_next = 0;
+      } else {
+        if (have_field && append_field(fields, buf, buf_len) < 0) {
+          goto error;
+        }
+        buf_len = 0;
+        have_field = 1;
+      }
+      memcpy(buf + buf_len, s + start, end - start);
+      buf_len += end - start;
+      last_span_was_black = 1;
+      break;
+    case SPAN_BACKSLASH:
+      if (last_span_was_black) {
+        join_next = 1;
+      }
+      last_span_was_black = 0;
+      break;
+    default:
+      last_span_was_black = 0;
+      break;
+    }
+    start = end;
+  }
+  if (have_field && append_field(fields, buf, buf_len) < 0) {
+    goto error;
+  }
+
+  PyMem_Free(buf);
+  PyMem_Free(spans);
+  return fields;
+
+error:
+  Py_DECREF(fields);
+  PyMem_Free(buf);
+  PyMem_Free(spans);
+  return NULL;
+}
+
+// UTF-8 for ${#x} and ${x:begin:length}.  These are the same as
+// libstr._NextUtf8Char(), and the error codes map to its messages.
+#define UTF8_INCOMPLETE_CHAR -1
+#define UTF8_INVALID_CONT -2
+#define UTF8_INVALID_START -3
+
+// Returns whether the first n bytes are ASCII.  Checks 8 bytes at a time.
+static int
+is_ascii(const char *s, Py_ssize_t n) {
+  const uint64_t high_bits = 0x8080808080808080ULL;
+  Py_ssize_t i = 0;
+  for (; i + 8 <= n; i += 8) {
+    uint64_t word;
+    memcpy(&word, s + i, 8);  // may be unaligned
+    if (word & high_bits) {
+      return 0;
+    }
+  }
+  for (; i < n; i++) {
+    if (s[i] & 0x80) {
+      return 0;
+    }
+  }
+  return 1;
+}
+
+// Returns the byte offset of the char after the one at i, or a negative error
+// code.
+static Py_ssize_t
+utf8_next(const unsigned char *s, Py_ssize_t n, Py_ssize_t i) {
+  unsigned char c = s[i];
+  int num_cont;
+  if ((c >> 7) == 0x0) {
+    return i + 1;
+  } else if ((c >> 5) == 0x6) {
+    num_cont = 1;
+  } else if ((c >> 4) == 0xE) {
+    num_cont = 2;
+  } else if ((c >> 3) == 0x1E) {
+    num_cont = 3;
+  } else {
+    return UTF8_INVALID_START;
+  }
+  int j;
+  for (j = 1; j <= num_cont; j++) {
+    if (i + j >= n) {
+      return UTF8_INCOMPLETE_CHAR;
+    }
+    if ((s[i + j] >> 6) != 0x2) {
+      return UTF8_INVALID_CONT;
+    }
+  }
+  return i + 1 + num_cont;
+}
+
+// Advance num_chars chars from byte offset i, stopping at the end of the
+// string.  Returns a byte offset, or a negative error code.
+static Py_ssize_t
+utf8_advance(const unsigned char *s, Py_ssize_t n, Py_ssize_t i,
+             Py_ssize_t num_chars) {
+  Py_ssize_t k;
+  for (k = 0; k < num_chars && i < n; k++) {
+    i = utf8_next(s, n, i);
+    if (i < 0) {
+      break;
+    }
+  }
+  return i;
+}
+
+static PyObject *
+utf8_error(Py_ssize_t code) {
+  PyObject *v = PyInt_FromSsize_t(code);
+  if (v != NULL) {
+    PyErr_SetObject(PyExc_ValueError, v);
+    Py_DECREF(v);
+  }
+  return NULL;
+}
+
+static PyObject *
+func_utf8_count(PyObject *self, PyObject *args) {
+  const char *s;
+  int len;
+  if (!PyArg_ParseTuple(args, "s#", &s, &len)) {
+    return NULL;
+  }
+  Py_ssize_t n = len;
+  if (is_ascii(s, n)) {
+    return PyInt_FromSsize_t(n);
+  }
+
+  Py_ssize_t num_chars = 0;
+  Py_ssize_t i = 0;
+  while (i < n) {
+    i = utf8_next((const unsigned char *)s, n, i);
+    if (i < 0) {
+      return utf8_error(i);
+    }
+    num_chars++;
+  }
+  return PyInt_FromSsize_t(num_chars);
+}
+
+// Only the bytes up to the end of the slice are examined, so slicing the
+// front of a long string doesn't depend on its length.
+static PyObject *
+func_utf8_slice(PyObject *self, PyObject *args) {
+  const char *s;
+  int len;
+  Py_ssize_t begin;
+  Py_ssize_t length;
+  if (!PyArg_ParseTuple(args, "s#nn", &s, &len, &begin, &length)) {
+    return NULL;
+  }
+  Py_ssize_t n = len;
+  if (begin < 0) {
+    PyErr_SetString(PyExc_ValueError, "begin can't be negative");
+    return NULL;
+  }
+
+  // In ASCII, chars are bytes.
+  Py_ssize_t byte_begin = begin < n ? begin : n;
+  Py_ssize_t byte_end;
+  if (length < 0) {
+    byte_end = n;
+  } else {
+    byte_end = length < n - byte_begin ? byte_begin + length : n;
+  }
+  Py_ssize_t scan_len = length < 0 ? byte_begin : byte_end;
+  if (is_ascii(s, scan_len)) {
+    return Py_BuildValue("(nn)", byte_begin, byte_end);
+  }
+
+  const unsigned char *u = (const unsigned char *)s;
+  byte_begin = utf8_advance(u, n, 0, begin);
+  if (byte_begin < 0) {
+    return utf8_error(byte_begin);
+  }
+  if (length < 0) {
+    byte_end = n;
+  } else {
+    byte_end = utf8_advance(u, n, byte_begin, length);
+    if (byte_end < 0) {
+      return utf8_error(byte_end);
+    }
+  }
+  return Py_BuildValue("(nn)", byte_begin, byte_end);
 }
 
 // We do this in C so we can remove '%f' % 0.1 from the CPython build.  That
@@ -382,6 +1180,12 @@ static PyMethodDef methods[] = {
   // We need this since Python's glob doesn't have char classes.
   {"glob", func_glob, METH_VARARGS,
    "Return a list of files that match a pattern."},
+  {"glob_filter", func_glob_filter, METH_VARARGS,
+   "glob_filter(pattern, names, dotglob=0) -> the names that match the "
+   "pattern, as glob() would match them in a directory."},
+  {"scandir", func_scandir, METH_VARARGS,
+   "scandir(path) -> (names, subdirs).  Like os.listdir(), but also returns "
+   "the entries that are directories, not including symlinks to them."},
   {"regex_parse", func_regex_parse, METH_VARARGS,
    "Compile a regex in ERE syntax, returning whether it is valid"},
   {"regex_match", func_regex_match, METH_VARARGS,
@@ -391,6 +1195,32 @@ static PyMethodDef methods[] = {
    "If the regex matches the string, return the start and end position of the "
    "first group.  Returns None if there is no match.  Raises RuntimeError if "
    "the regex is invalid."},
+  {"regex_strip", func_regex_strip, METH_VARARGS,
+   "regex_strip(search, s, is_suffix) -> the index where ${x##pat} or "
+   "${x%%pat} cuts s, or -1 if the pattern doesn't match."},
+  {"regex_compile", func_regex_compile, METH_VARARGS,
+   "Compile a regex in ERE syntax to a Regex object, with match() and "
+   "first_group_match() methods.  Raises RuntimeError if the regex is "
+   "invalid."},
+  {"posix_spawn", func_posix_spawn, METH_VARARGS,
+   "posix_spawn(path, argv, envp, fd_actions) -> pid.  Raises OSError if the "
+   "program can't be started."},
+  {"pipe_cloexec", func_pipe_cloexec, METH_NOARGS,
+   "pipe_cloexec() -> (r, w).  Like os.pipe(), but both ends have "
+   "FD_CLOEXEC set."},
+  {"ifs_split", func_ifs_split, METH_VARARGS,
+   "ifs_split(s, ifs_whitespace, ifs_other, allow_escape) -> list of fields.  "
+   "Like legacy.IfsSplitter, but in C."},
+  {"ifs_spans", func_ifs_spans, METH_VARARGS,
+   "ifs_spans(s, ifs_whitespace, ifs_other, allow_escape) -> list of "
+   "(span kind, end index) pairs.  Like legacy.IfsSplitter.Split()."},
+  {"utf8_count", func_utf8_count, METH_VARARGS,
+   "utf8_count(s) -> the number of UTF-8 chars in s.  Raises ValueError with "
+   "a negative error code if s isn't valid UTF-8."},
+  {"utf8_slice", func_utf8_slice, METH_VARARGS,
+   "utf8_slice(s, begin, length) -> (byte_begin, byte_end) for the chars "
+   "s[begin:begin+length], or to the end if length is -1.  Raises ValueError "
+   "like utf8_count()."},
   {"print_time", func_print_time, METH_VARARGS,
    "Print three floating point values for the 'time' builtin."},
   {"gethostname",socket_gethostname, METH_NOARGS, ""},
@@ -398,7 +1228,16 @@ static PyMethodDef methods[] = {
 };
 
 void initlibc(void) {
-  Py_InitModule("libc", methods);
+  PyObject *module = Py_InitModule("libc", methods);
+  if (module == NULL) {
+    return;
+  }
+  if (PyType_Ready(&RegexType) < 0) {
+    return;
+  }
+  Py_INCREF(&RegexType);
+  PyModule_AddObject(module, "Regex", (PyObject *)&RegexType);
+
   socket_error = PyErr_NewException("socket.error",
                                     PyExc_IOError, NULL);
 }
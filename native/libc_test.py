@@ -8,6 +8,8 @@
 """
 libc_test.py: Tests for libc.py
 """
+import fcntl
+import os
 import unittest
 
 import libc  # module under test
@@ -79,6 +81,34 @@ class LibcTest(unittest.TestCase):
     # This one will match a file named \
     print(libc.glob('\\\\'))
 
+  def testGlobFilter(self):
+    names = ['a.py', 'b.txt', '.c.py', '.', '..', '@(a)']
+    self.assertEqual(['a.py'], libc.glob_filter('*.py', names))
+    self.assertEqual(['.c.py'], libc.glob_filter('.*.py', names))
+    self.assertEqual(['.', '..'], libc.glob_filter('.*', names[3:5]))
+    # No extended globs, like glob().
+    self.assertEqual(['@(a)'], libc.glob_filter('@(a)', names))
+    self.assertRaises(TypeError, libc.glob_filter, '*', ('a',))
+
+    # dotglob
+    self.assertEqual(['a.py', '.c.py'], libc.glob_filter('*.py', names, 1))
+    self.assertEqual(['a.py', 'b.txt', '.c.py', '@(a)'],
+                     libc.glob_filter('*', names, 1))
+    self.assertEqual(['.', '..'], libc.glob_filter('.*', names[3:5], 1))
+
+  def testScandir(self):
+    names, subdirs = libc.scandir('native')
+    self.assertEqual(sorted(os.listdir('native')), sorted(names))
+    self.assertEqual([], subdirs)
+
+    names, subdirs = libc.scandir('.')
+    self.assertTrue('native' in subdirs)
+    self.assertTrue('README.md' in names)
+    self.assertFalse('README.md' in subdirs)
+
+    self.assertRaises(OSError, libc.scandir, '_nonexistent_')
+    self.assertRaises(OSError, libc.scandir, 'README.md')
+
   def testRegexParse(self):
     self.assertEqual(True, libc.regex_parse(r'.*\.py'))
 
@@ -125,6 +155,33 @@ class LibcTest(unittest.TestCase):
     self.assertRaises(
         RuntimeError, libc.regex_first_group_match, r'*', 'abcd', 0)
 
+  def testRegexCompile(self):
+    r = libc.regex_compile('(X.)')
+    s = 'oXooXoooXoX'
+    self.assertEqual((1, 3), r.first_group_match(s, 0))
+    self.assertEqual((4, 6), r.first_group_match(s, 3))
+    self.assertEqual(None, r.first_group_match('ooo', 0))
+
+    self.assertEqual(['Xo', 'Xo'], r.match(s))
+    self.assertEqual(None, r.match('ooo'))
+    self.assertTrue(isinstance(r, libc.Regex))
+
+    self.assertRaises(RuntimeError, libc.regex_compile, r'*')
+
+  def testUtf8(self):
+    self.assertEqual(3, libc.utf8_count('abc'))
+    self.assertEqual(2, libc.utf8_count('\xce\xbc\xe2\x82\xac'))
+    self.assertEqual((2, 5), libc.utf8_slice('\xce\xbc\xe2\x82\xac', 1, 5))
+    self.assertEqual((1, 9), libc.utf8_slice('abcdefghi', 1, -1))
+
+    try:
+      libc.utf8_count('a\xce')
+    except ValueError as e:
+      self.assertEqual(-1, e.args[0])  # incomplete
+    else:
+      self.fail('Expected ValueError')
+    self.assertRaises(ValueError, libc.utf8_slice, '\xff', 0, 1)
+
   def testRealpathFailOnNonexistentDirectory(self):
     # This behaviour is actually inconsistent with GNU readlink,
     # but matches behaviour of busybox readlink
@@ -140,6 +197,38 @@ class LibcTest(unittest.TestCase):
   def testGethostname(self):
     print(libc.gethostname())
 
+  def testPosixSpawn(self):
+    r, w = os.pipe()
+    # The child writes to the pipe, and only has the write end open.
+    fd_actions = [(w, 1), (w, -1), (r, -1)]
+    pid = libc.posix_spawn(
+        '/bin/sh', ['sh', '-c', 'echo $FOO; exit 3'], ['FOO=bar'], fd_actions)
+    os.close(w)
+    self.assertEqual('bar\n', os.read(r, 100))
+    os.close(r)
+
+    _, status = os.waitpid(pid, 0)
+    self.assertEqual(3, os.WEXITSTATUS(status))
+
+    self.assertRaises(
+        OSError, libc.posix_spawn, '_tmp/nonexistent', ['x'], [], [])
+
+  def testIfsSplit(self):
+    # More cases in core/legacy_test.py, which compares it with the Python
+    # implementation.
+    self.assertEqual(['a', 'b c'], libc.ifs_split(' a b\\ c ', ' ', '', True))
+    self.assertEqual(['a', '', 'b'], libc.ifs_split('a__b', '', '_', True))
+    self.assertEqual([(1, 1), (0, 2)], libc.ifs_spans(' a', ' ', '', False))
+
+  def testPipeCloExec(self):
+    r, w = libc.pipe_cloexec()
+    self.assertTrue(fcntl.fcntl(r, fcntl.F_GETFD) & fcntl.FD_CLOEXEC)
+    self.assertTrue(fcntl.fcntl(w, fcntl.F_GETFD) & fcntl.FD_CLOEXEC)
+    os.write(w, 'x')
+    self.assertEqual('x', os.read(r, 1))
+    os.close(r)
+    os.close(w)
+
 
 if __name__ == '__main__':
   unittest.main()
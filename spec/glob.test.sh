@@ -247,3 +247,39 @@ echo ${x//[^[z]/<}  # also accepted
 ## END
 ## N-I dash stdout-json: ""
 ## N-I dash status: 2
+
+#### shopt -s globstar
+mkdir -p $TMP/gs/a/b/c $TMP/gs/.hidden
+touch $TMP/gs/a/x.c $TMP/gs/a/b/c/y.c $TMP/gs/.hidden/z.c $TMP/gs/top.c
+cd $TMP/gs
+shopt -s globstar
+echo **/*.c
+echo a/**
+echo **/
+## STDOUT:
+a/b/c/y.c a/x.c top.c
+a/ a/b a/b/c a/b/c/y.c a/x.c
+a/ a/b/ a/b/c/
+## END
+# ** is the same as *
+## N-I dash/mksh STDOUT:
+a/x.c
+a/b a/x.c
+a/
+## END
+
+#### shopt -s dotglob
+mkdir -p $TMP/dg
+touch $TMP/dg/.a $TMP/dg/b
+cd $TMP/dg
+echo *
+shopt -s dotglob
+echo *
+## STDOUT:
+b
+.a b
+## END
+## N-I dash/mksh STDOUT:
+b
+b
+## END